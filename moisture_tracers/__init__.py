@@ -9,13 +9,17 @@ from math import floor
 import datetime
 import pathlib
 
+import numpy as np
 import iris.exceptions
 from dateutil.parser import parse as dateparse
 
 import irise
+from irise import convert
 from irise.interpolate import remap_3d
 from irise.forecast import Forecast, _CubeLoader
 
+from moisture_tracers.precision import set_precision
+
 home = pathlib.Path("~/Documents/meteorology").expanduser()
 datadir = str(home / "data/eurec4a/um/moisture_tracers/") + "/"
 plotdir = str(home / "output/eurec4a/moisture_tracers/") + "/"
@@ -42,6 +46,10 @@ def grey_zone_forecast(
     grid="coarse_grid",
     output_type="default",
     model_setup=None,
+    z_min=None,
+    z_max=None,
+    precision=None,
+    column_integrals=(),
 ):
     """Return an irise.forecast.Forecast for an individual grey-zone simulation
 
@@ -57,6 +65,18 @@ def grey_zone_forecast(
             toolbox" for output.
         model_setup (str): If using RMED files, the filenames also contain the model
             setup used (e.g. CoMorph or GAL8).
+        z_min (float | None): If given, only load model levels from this altitude
+            (m), plus a halo of levels below for vertical derivatives. See
+            limit_vertical_extent
+        z_max (float | None): If given, only load model levels up to this altitude
+            (m), plus a halo of levels above for vertical derivatives. See
+            limit_vertical_extent
+        precision (str | None): If given, convert all floating point fields to
+            "single" or "double" precision when they are loaded
+        column_integrals (list): Names of vertically integrated fields (e.g.
+            total_column_water) to calculate over the full column when each time is
+            loaded, before the levels are limited by z_min or z_max. Otherwise fields
+            integrated over the column after loading only include the levels kept
 
     Returns:
         irise.forecast.Forecast:
@@ -125,6 +145,14 @@ def grey_zone_forecast(
     if output_type.lower() == "rmed":
         forecast._loader.match_timestamp = True
 
+    if z_min is not None:
+        forecast._loader.z_min = float(z_min)
+    if z_max is not None:
+        forecast._loader.z_max = float(z_max)
+    forecast._loader.column_integrals = list(column_integrals)
+
+    forecast._loader.precision = precision
+
     forecast.resolution = resolution
     forecast.grid = grid
     forecast.model_setup = model_setup
@@ -167,9 +195,94 @@ def specific_fixes(cubes):
         cubes.append(cube)
 
 
+def limit_vertical_extent(cubes, z_max, halo=1, z_min=None):
+    """Remove the model levels outside z_min to z_max from all cubes with a height
+    coordinate
+
+    The cubes are sliced in place, so lazy data is only read for the levels that are
+    kept. A halo of levels below z_min and above z_max is kept so that centred vertical
+    derivatives can still be calculated over the whole range. Use trim_halo to remove
+    the halo from the diagnostics once the derivatives have been calculated.
+
+    Args:
+        cubes (iris.cube.CubeList):
+        z_max (float | None): The maximum altitude (m). None for no upper limit
+        halo (int): The number of extra levels to keep below z_min and above z_max
+        z_min (float | None): The minimum altitude (m). None for no lower limit
+    """
+    for n, cube in enumerate(cubes):
+        zdim, z = level_heights(cube)
+        if z is not None:
+            if z_min is None:
+                start = 0
+            else:
+                start = max(np.count_nonzero(z < z_min) - halo, 0)
+            if z_max is None:
+                end = cube.shape[zdim]
+            else:
+                end = min(np.count_nonzero(z <= z_max) + halo, cube.shape[zdim])
+
+            slices = [slice(None)] * cube.ndim
+            slices[zdim] = slice(start, end)
+            cubes[n] = cube[tuple(slices)]
+
+
+def trim_halo(cubes, forecast):
+    """Remove the halo of levels outside the vertical range of a forecast
+
+    Call this on diagnostics calculated from a forecast loaded with z_min or z_max
+    (see grey_zone_forecast), after any vertical derivatives have been taken, so the
+    diagnostics only include levels within the range. Cubes without a height
+    coordinate (e.g. vertically integrated diagnostics) are not changed.
+
+    Args:
+        cubes (iris.cube.CubeList): Modified in place
+        forecast (irise.forecast.Forecast):
+    """
+    z_min = getattr(forecast._loader, "z_min", None)
+    z_max = getattr(forecast._loader, "z_max", None)
+    if z_min is not None or z_max is not None:
+        limit_vertical_extent(cubes, z_max, halo=0, z_min=z_min)
+
+
+def level_heights(cube):
+    """The minimum height of each model level in a cube
+
+    Args:
+        cube (iris.cube.Cube):
+
+    Returns:
+        tuple: The index of the vertical dimension of the cube and an array of the
+            minimum altitude of each level over the other dimensions, or (None, None)
+            if the cube does not have model levels with a height coordinate
+    """
+    zcoords = cube.coords(axis="z", dim_coords=True)
+    zcoords += cube.coords("model_level_number", dim_coords=True)
+    if len(zcoords) == 0:
+        return None, None
+    zdim = cube.coord_dims(zcoords[0])[0]
+
+    for name in ["altitude", "height_above_reference_ellipsoid", "level_height"]:
+        try:
+            z = cube.coord(name)
+        except iris.exceptions.CoordinateNotFoundError:
+            continue
+
+        dims = cube.coord_dims(z)
+        if zdim in dims:
+            z = np.moveaxis(z.points, dims.index(zdim), 0)
+            return zdim, z.reshape(len(z), -1).min(axis=1)
+
+    return None, None
+
+
 class _ApproxLoader(_CubeLoader):
 
     match_timestamp = False
+    z_min = None
+    z_max = None
+    precision = None
+    column_integrals = ()
 
     def _load_new_time(self, time):
         """ Loads a new cubelist and removes others if necessary
@@ -181,6 +294,33 @@ class _ApproxLoader(_CubeLoader):
         self._make_space(time)
 
         # Load data from files with that lead time
+        cubes = self._load_cubes(time)
+
+        limited = self.z_min is not None or self.z_max is not None
+        if limited:
+            # Keep an extra level so that the top and bottom levels can still be
+            # interpolated between staggered grids in specific_fixes
+            limit_vertical_extent(cubes, self.z_max, halo=2, z_min=self.z_min)
+
+        specific_fixes(cubes)
+
+        if self.precision is not None:
+            set_precision(cubes, self.precision)
+
+        if limited and len(self.column_integrals) > 0:
+            # Integrate over the full column from a separate load of the files. The
+            # fields used by the integrals are read on every level
+            full_column = self._load_cubes(time)
+            specific_fixes(full_column)
+            if self.precision is not None:
+                set_precision(full_column, self.precision)
+            for name in self.column_integrals:
+                cubes.append(convert.calc(name, full_column))
+
+        # Add the data to the loaded files
+        self._loaded[time] = cubes
+
+    def _load_cubes(self, time):
         cubes = irise.load(self.files[time])
 
         if self.match_timestamp:
@@ -188,10 +328,7 @@ class _ApproxLoader(_CubeLoader):
                 iris.Constraint(time=lambda cell: get_correct_time(cell, time))
             )
 
-        specific_fixes(cubes)
-
-        # Add the data to the loaded files
-        self._loaded[time] = cubes
+        return cubes
 
 
 def get_correct_time(cell, time):
@@ -0,0 +1,107 @@
+"""
+Numpy implementation of the aggregation terms calculated in
+moisture_tracers.aggregation_terms
+
+The scale decomposition and all of the terms are calculated directly on arrays, rather
+than through cube arithmetic and regridding. The mesoscale is defined by the
+area-weighted average over blocks of coarse_factor x coarse_factor gridpoints (matching
+the AreaWeighted regridding to the grid from generate_1km_grid) and the large scale is
+the domain mean, as in anomaly_scale_decomposition.decompose_scales with
+large_scale_factor=None
+"""
+
+import numpy as np
+
+
+def aggregation_terms(qt, u, v, w, density, metrics, coarse_factor):
+    """Calculate the aggregation terms from arrays on the model grid
+
+    All 3D arrays have dimensions (z, y, x) and must be on the same grid
+
+    Args:
+        qt (np.ndarray): Total water content
+        u (np.ndarray): Zonal wind
+        v (np.ndarray): Meridional wind
+        w (np.ndarray): Vertical velocity
+        density (np.ndarray): Air density
+        metrics (moisture_tracers.grid_metrics.GridMetrics): The metrics for the
+            model grid, including the altitude of each model level
+        coarse_factor (int): Number of gridpoints along each side of a mesoscale box
+
+    Returns:
+        dict: The mesoscale total water anomaly and each aggregation term (qt_meso,
+            a_v, a_h, b_v, b_h, c) on the coarse grid
+    """
+    blocks = _BlockAverage(metrics, coarse_factor)
+    coarse = metrics.coarsen(coarse_factor)
+
+    # Large scale (domain mean) profiles. Accumulate at double precision and then
+    # keep the precision of the input
+    qt_mean = qt.mean(axis=(1, 2), dtype=np.float64).astype(qt.dtype)
+    w_mean = w.mean(axis=(1, 2), dtype=np.float64).astype(w.dtype)
+
+    # Mesoscale + large scale
+    qt_coarse, qt_cu = blocks.decompose(qt)
+    u_coarse, u_cu = blocks.decompose(u)
+    v_coarse, v_cu = blocks.decompose(v)
+    w_coarse, w_cu = blocks.decompose(w)
+
+    qt_meso = qt_coarse - qt_mean[:, None, None]
+    w_meso = w_coarse - w_mean[:, None, None]
+
+    # a - advection of mesoscale variability
+    dqt_dx, dqt_dy, dqt_dz = coarse.gradient(qt_meso)
+
+    a_v = -(w_coarse * dqt_dz)
+    a_h = -(u_coarse * dqt_dx + v_coarse * dqt_dy)
+    del dqt_dx, dqt_dy, dqt_dz
+
+    # b - cumulus fluxes
+    density_coarse = blocks.mean(density)
+    wq = blocks.mean(blocks.chop(density) * w_cu * qt_cu)
+    b_v = coarse.ddz(wq) / density_coarse
+    del wq, w_cu
+
+    uq = blocks.mean(u_cu * qt_cu)
+    vq = blocks.mean(v_cu * qt_cu)
+    b_h = -coarse.divergence(uq, vq)
+    del uq, vq, u_cu, v_cu, qt_cu
+
+    # c - mesoscale vertical advection of background moisture
+    c = -w_meso * coarse.ddz(qt_mean[:, None, None])
+
+    # All terms keep the precision of the input fields
+    return dict(qt_meso=qt_meso, a_v=a_v, a_h=a_h, b_v=b_v, b_h=b_h, c=c)
+
+
+class _BlockAverage(object):
+    """Area-weighted averages over blocks of coarse_factor x coarse_factor gridpoints
+
+    Gridpoints at the end of the domain that do not fill a block are excluded, as in
+    regrid_common.generate_1km_grid
+    """
+
+    def __init__(self, metrics, coarse_factor):
+        self.coarse_factor = coarse_factor
+        self.weights = metrics.block_weights(coarse_factor)
+        self.ny, _, self.nx, _ = self.weights.shape
+
+    def chop(self, x):
+        cf = self.coarse_factor
+        x = x[..., : self.ny * cf, : self.nx * cf]
+        return x.reshape(x.shape[:-2] + (self.ny, cf, self.nx, cf))
+
+    def mean(self, x):
+        """Block average of x. x is either on the full grid or already chopped"""
+        if x.ndim == 3:
+            x = self.chop(x)
+        return np.einsum("...iajb,iajb->...ij", x, self.weights.astype(x.dtype))
+
+    def decompose(self, x):
+        """Split x into the block average (on the coarse grid) and the anomaly from the
+        block average (on the chopped full grid)
+        """
+        x = self.chop(x)
+        x_coarse = self.mean(x)
+
+        return x_coarse, x - x_coarse[..., :, None, :, None]
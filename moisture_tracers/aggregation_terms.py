@@ -7,7 +7,8 @@ Usage:
     aggregation_terms.py
         <path> <start_time> <resolution> <data_grid>
         [<coarse_factor>]
-        [--output_path=<path>]
+        [--output_path=<path>] [--method=<str>]
+        [--z_min=<m>] [--z_max=<m>] [--precision=<str>]
     aggregation_terms.py (-h | --help)
 
 Arguments:
@@ -20,25 +21,45 @@ Arguments:
 Options:
     -h --help
         Show this screen.
+    --method=<str>
+        Either "fused", to calculate the terms with numpy arrays using
+        moisture_tracers.aggregation_kernel, or "iris", to calculate the terms with cube
+        arithmetic [default: fused]
+    --z_min=<m>
+        Only use model levels from this altitude (m)
+    --z_max=<m>
+        Only use model levels up to this altitude (m)
+    --precision=<str>
+        Convert all fields to "single" or "double" precision when they are loaded.
+        By default the precision of the data in the files is kept
 """
 
 import numpy as np
 import iris
-from iris.analysis import AreaWeighted, MEAN, SUM, PERCENTILE, Linear
-from iris.analysis.cartography import area_weights
-from iris.analysis.calculus import differentiate
+from iris.analysis import AreaWeighted, MEAN, SUM, PERCENTILE
 from iris.coords import AuxCoord
 from iris.util import broadcast_to_shape
 import iris.plot as iplt
 import matplotlib.pyplot as plt
 
-from irise import calculus, convert, grid
+from irise import convert, grid
 
 from twinotter.util.scripting import parse_docopt_arguments
-from pylagranto import trajectory
 
-from moisture_tracers import datadir, grey_zone_forecast
+from moisture_tracers import (
+    datadir,
+    grey_zone_forecast,
+    trim_halo,
+    aggregation_kernel,
+    trajectory_store,
+)
 from moisture_tracers.anomaly_scale_decomposition import decompose_scales
+from moisture_tracers.derivatives import differentiate_vertical
+from moisture_tracers.diagnostic_writer import DiagnosticWriter
+from moisture_tracers.grid_metrics import GridMetrics, differentiate_horizontal
+from moisture_tracers.lagrangian_frame import LagrangianFrame
+from moisture_tracers.precision import compare
+from moisture_tracers.regrid_common import generate_1km_grid
 
 
 long_names = dict(
@@ -48,74 +69,107 @@ long_names = dict(
     c="mesoscale_vertical_advection_of_background_moisture",
 )
 
+term_names = dict(
+    a_v="vertical_advection_of_mesoscale_variability",
+    a_h="horizontal_advection_of_mesoscale_variability",
+    b_v="vertical_cumulus_fluxes",
+    b_h="horizontal_cumulus_fluxes",
+    c="mesoscale_vertical_advection_of_background_moisture",
+)
+
 
-def main(path, start_time, resolution, data_grid, coarse_factor=4, output_path="."):
+def main(
+    path,
+    start_time,
+    resolution,
+    data_grid,
+    coarse_factor=4,
+    output_path=".",
+    method="fused",
+    z_min=None,
+    z_max=None,
+    precision=None,
+):
     """
     Calculate the aggregation terms in each quartile of column moisture at each lead
-    time in a forecast and save to a netCDF file
+    time in a forecast and save to a netCDF file. Each lead time is appended to the
+    file when it is completed and rerunning continues from the last completed lead
+    time
     """
     coarse_factor = int(coarse_factor)
 
     forecast = grey_zone_forecast(
-        path=path, start_time=start_time, resolution=resolution, grid=data_grid
+        path=path,
+        start_time=start_time,
+        resolution=resolution,
+        grid=data_grid,
+        z_min=z_min,
+        z_max=z_max,
+        precision=precision,
+        # The quartiles are of the full column water, not just the levels kept
+        column_integrals=["total_column_water"],
     )
 
     if "lagrangian" in data_grid:
-        tr = trajectory.load(
+        tr = trajectory_store.load(
             datadir
-            + "trajectories/trajectories_{}_{}_500m.pkl".format(
+            + "trajectories/trajectories_{}_{}_500m.nc".format(
                 forecast.start_time.strftime("%Y%m%d"),
                 resolution,
             )
         )[0]
+        frame = LagrangianFrame(tr)
 
-    vars_by_quartile = iris.cube.CubeList()
-    for cubes in forecast:
-        print(forecast.lead_time)
-
-        if "lagrangian" in data_grid:
-            subtract_winds(cubes, tr)
-
-        qt_meso, a_v, a_h, b_v, b_h, c = get_aggregation_terms(cubes, coarse_factor)
-
-        qt_column = convert.calc("total_column_water", cubes)
-        qt_column = qt_column.regrid(qt_meso, AreaWeighted())
-
-        rho = convert.calc("air_density", cubes)
-        rho_mean, rho_meso, rho_cu = decompose_scales(rho, coarse_factor=coarse_factor)
-        rho = rho_mean + rho_meso
-        rho.rename("mesoscale_density")
-
-        for cube in average_by_quartile(
-            qt_column,
-            iris.cube.CubeList([a_v, a_h, b_v, b_h, c, qt_column, qt_meso, rho]),
-            rho,
-        ):
-            cube.remove_coord("grid_longitude")
-            cube.remove_coord("grid_latitude")
-            vars_by_quartile.append(cube)
-
-    vars_by_quartile = vars_by_quartile.merge()
-    iris.save(
-        vars_by_quartile,
+    with DiagnosticWriter(
         "{}/aggregation_terms_by_quartile_{}_{}_{}.nc".format(
             output_path,
             forecast.start_time.strftime("%Y%m%d"),
             resolution,
             data_grid,
-        ),
-    )
+        )
+    ) as writer:
+        # Continue from the last completed lead time if the output file already exists
+        completed_times = writer.completed_times()
+
+        for time in forecast._loader.files:
+            if time in completed_times:
+                continue
+            cubes = forecast.set_time(time)
+            print(forecast.lead_time)
+
+            if "lagrangian" in data_grid:
+                cubes = frame.relative_winds(cubes, time)
+
+            if method == "fused":
+                qt_meso, a_v, a_h, b_v, b_h, c = get_aggregation_terms_fused(
+                    cubes, coarse_factor
+                )
+            else:
+                qt_meso, a_v, a_h, b_v, b_h, c = get_aggregation_terms(
+                    cubes, coarse_factor
+                )
 
+            qt_column = convert.calc("total_column_water", cubes)
+            qt_column = qt_column.regrid(qt_meso, AreaWeighted())
 
-def subtract_winds(cubes, tr):
-    u = cubes.extract_cube("x_wind")
-    v = cubes.extract_cube("y_wind")
+            rho = convert.calc("air_density", cubes)
+            rho_mean, rho_meso, rho_cu = decompose_scales(
+                rho, coarse_factor=coarse_factor
+            )
+            rho = rho_mean + rho_meso
+            rho.rename("mesoscale_density")
 
-    time = grid.get_datetime(u)
-    t_index = tr.times.index(time)
+            vars_by_quartile = average_by_quartile(
+                qt_column,
+                iris.cube.CubeList([a_v, a_h, b_v, b_h, c, qt_column, qt_meso, rho]),
+                rho,
+            )
+            for cube in vars_by_quartile:
+                cube.remove_coord("grid_longitude")
+                cube.remove_coord("grid_latitude")
+            trim_halo(vars_by_quartile, forecast)
 
-    u.data -= tr["x_wind"][t_index]
-    v.data -= tr["y_wind"][t_index]
+            writer.append(vars_by_quartile, time)
 
 
 def get_aggregation_terms(cubes, coarse_factor, large_scale_factor=None):
@@ -163,6 +217,88 @@ def get_aggregation_terms(cubes, coarse_factor, large_scale_factor=None):
     return qt_meso, a_v, a_h, b_v, b_h, c
 
 
+def get_aggregation_terms_fused(cubes, coarse_factor):
+    """
+    Calculate the aggregation terms from the cubes using the numpy implementation in
+    aggregation_kernel. This is equivalent to get_aggregation_terms with
+    large_scale_factor=None, but only creates cubes for the final results.
+
+    Args:
+        cubes (iris.cube.CubeList):
+        coarse_factor (int):
+
+    Returns:
+        tuple:
+    """
+    qt = convert.calc("specific_total_water_content", cubes)
+    u = cubes.extract_cube("x_wind")
+    v = cubes.extract_cube("y_wind")
+    w = cubes.extract_cube("upward_air_velocity")
+    density = cubes.extract_cube("air_density")
+
+    terms = aggregation_kernel.aggregation_terms(
+        qt.data,
+        u.data,
+        v.data,
+        w.data,
+        density.data,
+        GridMetrics.from_cube(qt),
+        coarse_factor,
+    )
+
+    # Use a subsample of the original cube, with the horizontal coordinates replaced
+    # by the coarse grid, as a template for the results
+    coarse_grid = generate_1km_grid(qt, coarse_factor=coarse_factor)
+    ny, nx = coarse_grid.shape
+    cf = coarse_factor
+    template = qt[:, : ny * cf : cf, : nx * cf : cf]
+    template.replace_coord(coarse_grid.coord(axis="x", dim_coords=True))
+    template.replace_coord(coarse_grid.coord(axis="y", dim_coords=True))
+
+    qt_meso = template.copy(data=terms["qt_meso"])
+    qt_meso.rename("mesoscale_total_water_content")
+
+    # All terms are tendencies of qt, the same units as get_aggregation_terms
+    units = "{} s-1".format(qt.units)
+    results = [qt_meso]
+    for name in ["a_v", "a_h", "b_v", "b_h", "c"]:
+        cube = template.copy(data=terms[name])
+        cube.rename(term_names[name])
+        cube.units = units
+        results.append(cube)
+
+    return tuple(results)
+
+
+def compare_methods(cubes, coarse_factor):
+    """Compare the aggregation terms from get_aggregation_terms_fused and
+    get_aggregation_terms
+
+    Args:
+        cubes (iris.cube.CubeList):
+        coarse_factor (int):
+
+    Returns:
+        dict: The maximum difference of each term relative to the maximum absolute
+            value from get_aggregation_terms, from moisture_tracers.precision.compare
+
+    Raises:
+        ValueError: If the units of a term differ between the two methods
+    """
+    fused = get_aggregation_terms_fused(cubes, coarse_factor)
+    reference = get_aggregation_terms(cubes, coarse_factor)
+
+    for cube_fused, cube_reference in zip(fused, reference):
+        if cube_fused.units != cube_reference.units:
+            raise ValueError(
+                "Units of {} differ: {} and {}".format(
+                    cube_reference.name(), cube_fused.units, cube_reference.units
+                )
+            )
+
+    return compare(iris.cube.CubeList(fused), iris.cube.CubeList(reference))
+
+
 def average_by_quartile(qt_column, cubes, density):
     """
     Get the average of each of the cubes in the four quartiles of qt_column
@@ -179,9 +315,9 @@ def average_by_quartile(qt_column, cubes, density):
     ycoord = qt_column.coord(axis="y", dim_coords=True).name()
     quartiles = qt_column.collapsed([xcoord, ycoord], PERCENTILE, percent=[25, 50, 75])
 
-    weights_2d = area_weights(qt_column)
+    weights_2d = GridMetrics.from_cube(qt_column).area
     if density is not None:
-        weights_3d = (grid.volume(density) * density).data
+        weights_3d = GridMetrics.from_cube(density).volume * density.data
 
     vars_by_quartile = iris.cube.CubeList()
     for n in range(4):
@@ -246,9 +382,10 @@ def plot_timeseries():
 
 
 def advection_of_mesoscale_variability(qt_meso, u_meso, v_meso, w_meso):
-    dqt_dx, dqt_dy, dqt_dz = calculus.grad(qt_meso)
-
-    dqt_dz.units = "m-1"
+    metrics = GridMetrics.from_cube(qt_meso)
+    dqt_dx = differentiate_horizontal(qt_meso, "x", metrics)
+    dqt_dy = differentiate_horizontal(qt_meso, "y", metrics)
+    dqt_dz = differentiate_vertical(qt_meso, "altitude")
 
     a_v = -(w_meso * dqt_dz)
     a_v.rename("vertical_advection_of_mesoscale_variability")
@@ -262,17 +399,10 @@ def advection_of_mesoscale_variability(qt_meso, u_meso, v_meso, w_meso):
 def cumulus_fluxes(density, qt_meso, qt_cu, u_cu, v_cu, w_cu):
     wq = density * w_cu * qt_cu
     wq = wq.regrid(qt_meso, AreaWeighted())
-
-    z = qt_meso.coord("altitude")
-    dwq_dz = differentiate(wq, "altitude")
-    dwq_dz = dwq_dz.interpolate([(z.name(), z.points)], Linear())
+    dwq_dz = differentiate_vertical(wq, "altitude")
 
     density_meso = density.regrid(qt_meso, AreaWeighted())
 
-    units = dwq_dz.units
-    dwq_dz = density_meso.copy(data=dwq_dz.data)
-    dwq_dz.units = units
-
     b_v = dwq_dz / density_meso
 
     b_v.rename("vertical_cumulus_fluxes")
@@ -280,11 +410,10 @@ def cumulus_fluxes(density, qt_meso, qt_cu, u_cu, v_cu, w_cu):
     uq = (u_cu * qt_cu).regrid(qt_meso, AreaWeighted())
     vq = (v_cu * qt_cu).regrid(qt_meso, AreaWeighted())
 
-    duq_dx = calculus.polar_horizontal(uq, "x")
-    duq_dx = duq_dx.regrid(qt_meso, AreaWeighted())
-
-    dvq_dy = calculus.polar_horizontal(vq, "y")
-    dvq_dy = dvq_dy.regrid(qt_meso, AreaWeighted())
+    # Derivatives on the mesoscale grid, so they don't need regridding back
+    metrics = GridMetrics.from_cube(qt_meso)
+    duq_dx = differentiate_horizontal(uq, "x", metrics)
+    dvq_dy = differentiate_horizontal(vq, "y", metrics)
 
     b_h = -(duq_dx + dvq_dy)
 
@@ -294,13 +423,11 @@ def cumulus_fluxes(density, qt_meso, qt_cu, u_cu, v_cu, w_cu):
 
 
 def mesoscale_vertical_advection_of_mean_state(qt_mean, w_meso):
-    dqt_dz = differentiate(qt_mean, "altitude")
-
-    z = w_meso.coord("altitude")
-    dqt_dz = dqt_dz.interpolate([(z.name(), z.points)], Linear())
+    dqt_dz = differentiate_vertical(qt_mean, "altitude")
 
+    units = dqt_dz.units
     dqt_dz = w_meso[:, 0, 0].copy(data=dqt_dz.data)
-    dqt_dz.units = "m-1"
+    dqt_dz.units = units
 
     dqt_dz = grid.broadcast_to_cube(dqt_dz, w_meso)
 
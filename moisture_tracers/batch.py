@@ -0,0 +1,350 @@
+"""
+Run diagnostics for every combination of start time, resolution and grid in a pool of
+processes. Jobs are started in order of decreasing expected cost (highest resolution
+first) and jobs with output that is already up to date are skipped
+
+Usage:
+    batch.py <path> <diagnostic>...
+        [--start_times=<str>] [--resolutions=<str>] [--grids=<str>]
+        [--output_path=<path>] [--nprocs=<n>]
+        [--z_min=<m>] [--z_max=<m>] [--precision=<str>] [--replace_existing]
+    batch.py (-h | --help)
+
+Arguments:
+    <path>
+        The path to the regridded forecast data
+    <diagnostic>
+        One or more of aggregation_terms, domain_averages, cfads, circle_averages,
+        region_averages or circulation
+
+Options:
+    -h --help
+        Show this screen.
+    --start_times=<str>
+        Comma-separated list of start times. Defaults to all start times in
+        moisture_tracers.start_times
+    --resolutions=<str>
+        Comma-separated list of resolutions. Defaults to all resolutions in
+        moisture_tracers.resolutions
+    --grids=<str>
+        Comma-separated list of grids. Defaults to all grids in moisture_tracers.grids
+    --output_path=<path>
+        Where to save the diagnostics [default: ./]
+    --nprocs=<n>
+        Number of processes to run at once [default: 1]
+    --z_min=<m>
+        Only use model levels from this altitude (m) for diagnostics that support it
+    --z_max=<m>
+        Only use model levels up to this altitude (m) for diagnostics that support it
+    --precision=<str>
+        Calculate diagnostics that support it at "single" or "double" precision
+    --replace_existing
+        Rerun jobs even if the output is up to date, replacing the existing output
+        files. The output files don't record z_min, z_max or precision, so jobs for
+        diagnostics that support an option that is given are always rerun
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import os
+import traceback
+
+from twinotter.util.scripting import parse_docopt_arguments
+
+import moisture_tracers
+from moisture_tracers import (
+    grey_zone_forecast,
+    aggregation_terms,
+    domain_averages,
+    cfad,
+    circle_averages,
+    circulation,
+    regions,
+    diagnostic_writer,
+)
+
+
+# The main function for each diagnostic, the filename it saves to and the optional
+# arguments it accepts. Diagnostics that write with DiagnosticWriter (streamed) are only
+# up to date if all lead times are completed
+diagnostics = dict(
+    aggregation_terms=dict(
+        func=aggregation_terms.main,
+        filename="aggregation_terms_by_quartile_{start_time}_{resolution}_{grid}.nc",
+        streamed=True,
+        options=["z_min", "z_max", "precision"],
+    ),
+    domain_averages=dict(
+        func=domain_averages.main,
+        filename="domain_averages_{start_time}_{resolution}_{grid}.nc",
+        streamed=True,
+        options=["z_min", "z_max", "precision"],
+    ),
+    cfads=dict(
+        func=cfad.main,
+        filename="cfads_{start_time}_{resolution}_{grid}.nc",
+        streamed=True,
+        options=["z_min", "z_max", "precision"],
+    ),
+    circle_averages=dict(
+        func=circle_averages.main,
+        filename="circle_averages_{start_time}_{resolution}_{grid}.nc",
+        streamed=True,
+        options=["z_min", "z_max"],
+    ),
+    region_averages=dict(
+        func=regions.main,
+        filename="region_averages_{start_time}_{resolution}_{grid}.nc",
+        streamed=True,
+        options=["z_min", "z_max"],
+    ),
+    circulation=dict(
+        func=circulation.main,
+        filename="circulation_{start_time}_{resolution}_{grid}.nc",
+        streamed=True,
+        options=[],
+    ),
+)
+
+# Native grid spacing (km) of each simulation, used to estimate the relative cost of
+# each job
+grid_spacing = dict(
+    D100m_150m=0.15,
+    D100m_300m=0.3,
+    D100m_500m=0.5,
+    km1p1=1.1,
+    km2p2=2.2,
+    km4p4=4.4,
+)
+
+
+def main(
+    path,
+    diagnostic,
+    start_times=None,
+    resolutions=None,
+    grids=None,
+    output_path="./",
+    nprocs=1,
+    z_min=None,
+    z_max=None,
+    precision=None,
+    replace_existing=False,
+):
+    options = dict(z_min=z_min, z_max=z_max, precision=precision)
+    jobs = generate_jobs(
+        path,
+        diagnostic,
+        start_times=_split(start_times),
+        resolutions=_split(resolutions),
+        grids=_split(grids),
+        output_path=output_path,
+        replace_existing=replace_existing,
+        options=options,
+    )
+
+    run(jobs, nprocs=int(nprocs), **options)
+
+
+def generate_jobs(
+    path,
+    diagnostic_names,
+    start_times=None,
+    resolutions=None,
+    grids=None,
+    output_path="./",
+    replace_existing=False,
+    options=None,
+):
+    """Expand the matrix of diagnostic x start time x resolution x grid
+
+    Args:
+        path (str): The path to the regridded forecast data
+        diagnostic_names (list): Names of diagnostics in batch.diagnostics
+        start_times (list | None): Defaults to moisture_tracers.start_times
+        resolutions (list | None): Defaults to moisture_tracers.resolutions
+        grids (list | None): Defaults to moisture_tracers.grids
+        output_path (str):
+        replace_existing (bool): If False, exclude jobs with output that is up to date.
+            If True, the existing output is deleted when the job is run
+        options (dict, optional): The optional arguments that will be passed to the
+            diagnostics (see run). The output files don't record these options, so
+            jobs for diagnostics that support any of the options given are never
+            considered up to date and their existing output is replaced
+
+    Returns:
+        list: A dictionary of arguments for each job that needs to be run, sorted by
+            decreasing expected cost
+    """
+    if start_times is None:
+        start_times = moisture_tracers.start_times
+    if resolutions is None:
+        resolutions = moisture_tracers.resolutions
+    if grids is None:
+        grids = moisture_tracers.grids
+
+    if options is None:
+        options = dict()
+
+    jobs = []
+    for name in diagnostic_names:
+        # Existing output may have been calculated with different options
+        replace = replace_existing or any(
+            options.get(key) is not None for key in diagnostics[name]["options"]
+        )
+        for start_time in start_times:
+            for resolution in resolutions:
+                for grid in grids:
+                    job = dict(
+                        diagnostic=name,
+                        path=path,
+                        start_time=start_time,
+                        resolution=resolution,
+                        grid=grid,
+                        output_path=output_path,
+                    )
+                    if replace or not is_up_to_date(**job):
+                        job["replace"] = replace
+                        jobs.append(job)
+                    else:
+                        print("Up to date: {}".format(_describe(job)))
+
+    return sorted(jobs, key=expected_cost, reverse=True)
+
+
+def expected_cost(job):
+    # Cost scales with the number of gridpoints in the native simulation
+    return grid_spacing.get(job["resolution"], 1.0) ** -2
+
+
+def output_filename(diagnostic, path, start_time, resolution, grid, output_path):
+    forecast = grey_zone_forecast(
+        path, start_time=start_time, resolution=resolution, grid=grid
+    )
+    filename = os.path.join(
+        output_path,
+        diagnostics[diagnostic]["filename"].format(
+            start_time=forecast.start_time.strftime("%Y%m%d"),
+            resolution=resolution,
+            grid=grid,
+        ),
+    )
+
+    return forecast, filename
+
+
+def is_up_to_date(diagnostic, path, start_time, resolution, grid, output_path):
+    """Check whether a diagnostic has already been produced from the current data
+
+    The output is up to date if it exists, is newer than all of the forecast files and,
+    for diagnostics written with DiagnosticWriter, contains every lead time. The options
+    used to calculate the output (z_min, z_max, precision) are not checked, see
+    generate_jobs
+
+    Returns:
+        bool:
+    """
+    forecast, filename = output_filename(
+        diagnostic, path, start_time, resolution, grid, output_path
+    )
+    if not os.path.exists(filename):
+        return False
+
+    input_files = [
+        fname
+        for patterns in forecast._loader.files.values()
+        for pattern in patterns
+        for fname in glob.glob(pattern)
+    ]
+    if len(input_files) == 0:
+        return False
+
+    if os.path.getmtime(filename) < max(os.path.getmtime(f) for f in input_files):
+        return False
+
+    if diagnostics[diagnostic]["streamed"]:
+        # Read-only so checking the file doesn't change its modification time
+        completed_times = diagnostic_writer.completed_times(filename)
+        if not all(time in completed_times for time in forecast._loader.files):
+            return False
+
+    return True
+
+
+def run(jobs, nprocs=1, **kwargs):
+    """Run each job in a pool of processes
+
+    Args:
+        jobs (list): Dictionaries of arguments produced by generate_jobs
+        nprocs (int): Number of processes
+        **kwargs: Optional arguments passed to the diagnostics that support them
+    """
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        futures = {executor.submit(run_job, job, **kwargs): job for job in jobs}
+
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                success = future.result()
+            except Exception:
+                # e.g. BrokenProcessPool if a worker process was killed
+                traceback.print_exc()
+                success = False
+
+            if success:
+                print("Finished: {}".format(_describe(job)))
+            else:
+                print("Failed: {}".format(_describe(job)))
+
+
+def run_job(job, **kwargs):
+    import warnings
+
+    warnings.filterwarnings("ignore")
+
+    diagnostic = diagnostics[job["diagnostic"]]
+    kwargs = {
+        key: value
+        for key, value in kwargs.items()
+        if value is not None and key in diagnostic["options"]
+    }
+    kwargs["output_path"] = job["output_path"]
+
+    try:
+        if job.get("replace"):
+            # Otherwise the diagnostic would continue from the times already written
+            forecast, filename = output_filename(
+                job["diagnostic"],
+                job["path"],
+                job["start_time"],
+                job["resolution"],
+                job["grid"],
+                job["output_path"],
+            )
+            if os.path.exists(filename):
+                os.remove(filename)
+
+        diagnostic["func"](
+            job["path"], job["start_time"], job["resolution"], job["grid"], **kwargs
+        )
+    except Exception:
+        # Report the error without stopping the other jobs
+        traceback.print_exc()
+        return False
+
+    return True
+
+
+def _describe(job):
+    return "{diagnostic} {start_time} {resolution} {grid}".format(**job)
+
+
+def _split(arg):
+    if arg is None:
+        return None
+    else:
+        return arg.split(",")
+
+
+if __name__ == "__main__":
+    parse_docopt_arguments(main, __doc__)
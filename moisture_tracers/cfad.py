@@ -0,0 +1,180 @@
+"""
+Calculate contoured frequency by altitude diagrams (CFADs), the histogram of a field on
+each model level, at each lead time in a forecast and save to a netCDF file alongside
+the domain_averages output. Each lead time is appended to the file when it is completed
+and rerunning continues from the last completed lead time
+
+Usage:
+    cfad.py <path> <start_time> <resolution> <grid> [<output_path>]
+        [--z_min=<m>] [--z_max=<m>] [--precision=<str>]
+    cfad.py (-h | --help)
+
+Arguments:
+    <path>
+    <start_time>
+    <resolution>
+    <grid>
+    <output_path>
+
+Options:
+    -h --help
+        Show this screen.
+    --z_min=<m>
+        Only use model levels from this altitude (m)
+    --z_max=<m>
+        Only use model levels up to this altitude (m)
+    --precision=<str>
+        Convert all fields to "single" or "double" precision when they are loaded.
+        By default the precision of the data in the files is kept
+"""
+
+import numpy as np
+import iris
+from iris.coords import DimCoord
+
+from irise import convert
+
+from twinotter.util.scripting import parse_docopt_arguments
+
+from . import grey_zone_forecast
+from .diagnostic_writer import write_diagnostics
+from .sketches import Histogram
+
+
+# Bin edges for each variable
+bins = dict(
+    upward_air_velocity=np.linspace(-5, 5, 101),
+    specific_total_water_content=np.linspace(0, 0.02, 81),
+    mass_fraction_of_cloud_liquid_water_in_air=np.linspace(0, 2e-3, 81),
+)
+
+
+def main(
+    path,
+    start_time,
+    resolution,
+    grid,
+    output_path="./",
+    z_min=None,
+    z_max=None,
+    precision=None,
+):
+    forecast = grey_zone_forecast(
+        path,
+        start_time=start_time,
+        resolution=resolution,
+        grid=grid,
+        z_min=z_min,
+        z_max=z_max,
+        precision=precision,
+    )
+
+    write_diagnostics(
+        forecast,
+        "{}/cfads_{}_{}_{}.nc".format(
+            output_path,
+            forecast.start_time.strftime("%Y%m%d"),
+            resolution,
+            grid,
+        ),
+        generate,
+    )
+
+
+def generate(cubes, variables=None):
+    """Calculate the CFAD of each variable
+
+    Args:
+        cubes (iris.cube.CubeList): The fields at a single time
+        variables (dict, optional): The bin edges for each variable. Defaults to
+            cfad.bins
+
+    Returns:
+        iris.cube.CubeList: <name>_frequency, the number of gridpoints in each bin on
+            each level, and <name>_count, the number of valid gridpoints on each level
+            (including those outside the bins)
+    """
+    if variables is None:
+        variables = bins
+
+    results = iris.cube.CubeList()
+    for name, edges in variables.items():
+        cube = convert.calc(name, cubes)
+        histogram = Histogram(edges, nlevels=cube.shape[0])
+        histogram.add(cube.data)
+
+        results.extend(histogram_to_cubes(cube, histogram))
+
+    return results
+
+
+def histogram_to_cubes(cube, histogram):
+    """Create cubes of the histogram on each level of a 3D cube
+
+    Args:
+        cube (iris.cube.Cube): The field the histogram was calculated from
+        histogram (moisture_tracers.sketches.Histogram):
+
+    Returns:
+        iris.cube.CubeList: <name>_frequency with dimensions (level, bin) and
+            <name>_count with dimension (level)
+    """
+    edges = histogram.edges
+    bin_coord = DimCoord(
+        0.5 * (edges[1:] + edges[:-1]),
+        bounds=np.stack([edges[:-1], edges[1:]], axis=-1),
+        long_name="{}_bin".format(cube.name()),
+        units=cube.units,
+    )
+
+    # Use the first column as a template to keep the vertical coordinates
+    template = cube[:, 0, 0]
+    template.remove_coord(cube.coord(axis="x", dim_coords=True).name())
+    template.remove_coord(cube.coord(axis="y", dim_coords=True).name())
+
+    count = template.copy(data=histogram.counts.sum(axis=1))
+    count.rename("{}_count".format(cube.name()))
+    count.units = "1"
+
+    frequency = iris.cube.Cube(
+        histogram.frequencies(),
+        long_name="{}_frequency".format(cube.name()),
+        units="1",
+        dim_coords_and_dims=[(bin_coord, 1)],
+    )
+    for coord in template.coords(dim_coords=True):
+        frequency.add_dim_coord(coord.copy(), 0)
+    for coord in template.coords(dimensions=0, dim_coords=False):
+        frequency.add_aux_coord(coord.copy(), 0)
+    for coord in template.coords(dimensions=()):
+        frequency.add_aux_coord(coord.copy())
+
+    return iris.cube.CubeList([frequency, count])
+
+
+def accumulate(filename):
+    """Sum the CFADs in a file over all lead times
+
+    Args:
+        filename (str): The output of cfad.main
+
+    Returns:
+        iris.cube.CubeList:
+    """
+    cubes = iris.load(filename)
+
+    results = iris.cube.CubeList()
+    for cube in cubes:
+        if cube.coords("time", dim_coords=True):
+            cube = cube.collapsed("time", iris.analysis.SUM)
+        results.append(cube)
+
+    return results
+
+
+if __name__ == "__main__":
+    import warnings
+
+    warnings.filterwarnings("ignore")
+
+    parse_docopt_arguments(main, __doc__)
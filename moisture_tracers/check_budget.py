@@ -2,7 +2,7 @@
 Plot maps of the moisture tracer budget on all vertical levels
 
 Usage:
-    check_budget.py <filename> <budget>
+    check_budget.py <filename> <budget> [--z_min=<m>] [--z_max=<m>]
     check_budget.py (-h | --help)
 
 Arguments:
@@ -10,6 +10,10 @@ Arguments:
 Options:
     -h --help
         Show help
+    --z_min=<m>
+        Only use model levels from this altitude (m)
+    --z_max=<m>
+        Only use model levels up to this altitude (m)
 """
 
 from math import ceil
@@ -25,7 +29,7 @@ import irise
 from irise import convert
 from twinotter.util.scripting import parse_docopt_arguments
 
-from moisture_tracers import plotdir
+from moisture_tracers import plotdir, limit_vertical_extent, level_heights
 
 budgets = dict(
     total_minus_advection_only_q=[
@@ -41,28 +45,47 @@ budgets = dict(
 )
 
 
-def main(filename, budget):
+def main(filename, budget, z_min=None, z_max=None):
     tracers = irise.load(filename)
 
+    # Number the plots by the model level in the file, before any levels are removed
+    zdim, z = level_heights(tracers[0])
+    if zdim is None:
+        raise ValueError("{} does not have model levels".format(filename))
+    model_levels = np.arange(len(z))
+
+    if z_min is not None or z_max is not None:
+        z_min = None if z_min is None else float(z_min)
+        limit_vertical_extent(
+            tracers,
+            None if z_max is None else float(z_max),
+            halo=0,
+            z_min=z_min,
+        )
+        if z_min is not None:
+            model_levels = model_levels[np.count_nonzero(z < z_min) :]
+    model_levels = model_levels[: tracers[0].shape[zdim]]
+
     for cube in tracers:
         print(cube.name(), cube.data.min(), cube.data.max())
 
-    for k in tqdm(range(40)):
+    for k in tqdm(range(min(40, len(model_levels)))):
         check_budget(
             tracers,
             budget,
             budgets[budget],
             ncols=2,
             k=k,
+            zdim=zdim,
             vmin=-1e-3,
             vmax=1e-3,
             cmap="seismic_r",
         )
-        plt.savefig(plotdir + "{}_budget_k{}.png".format(budget, k))
+        plt.savefig(plotdir + "{}_budget_k{}.png".format(budget, model_levels[k]))
         plt.close()
 
 
-def check_budget(cubes, full, subsets, ncols=4, k=0, **kwargs):
+def check_budget(cubes, full, subsets, ncols=4, k=0, zdim=0, **kwargs):
     """
 
     Args:
@@ -71,6 +94,7 @@ def check_budget(cubes, full, subsets, ncols=4, k=0, **kwargs):
         subsets (list): The names of components that should add up to the full field
         ncols (int): Number of columns for the plot
         k (int): Vertical level index to plot
+        zdim (int): The vertical dimension of the cubes
         **kwargs: Keyword arguments for iplt.pcolormesh
 
     Returns:
@@ -81,29 +105,30 @@ def check_budget(cubes, full, subsets, ncols=4, k=0, **kwargs):
 
     full = convert.calc(full, cubes)
     subsets = convert.calc(subsets, cubes)
+    level = (slice(None),) * zdim + (k,)
 
     fig, axes = plt.subplots(nrows, ncols, figsize=(16, nrows * 5))
 
     # Plot the full field
     plt.axes(axes[0, 0])
-    iplt.pcolormesh(full[k], **kwargs)
+    iplt.pcolormesh(full[level], **kwargs)
     plt.title(full.name())
 
     # Plot the sum of the individual subsets
     subset_total = sum(subsets)
     plt.axes(axes[1 // ncols, 1 % ncols])
-    iplt.pcolormesh(subset_total[k], **kwargs)
+    iplt.pcolormesh(subset_total[level], **kwargs)
     plt.title("Sum of subsets")
 
     # Plot the residual
     plt.axes(axes[2 // ncols, 2 % ncols])
-    im = iplt.pcolormesh((full - subset_total)[k], **kwargs)
+    im = iplt.pcolormesh((full - subset_total)[level], **kwargs)
     plt.title("Residual")
 
     # Plot the individual subsets
     for i, cube in enumerate(subsets):
         plt.axes(axes[(i + 3) // ncols, (i + 3) % ncols])
-        iplt.pcolormesh(cube[k], **kwargs)
+        iplt.pcolormesh(cube[level], **kwargs)
         plt.title(cube.name())
 
     plt.subplots_adjust(bottom=0.2)
@@ -3,6 +3,7 @@ Create a netCDF with all variables averaged over a EUREC4A circle area
 
 Usage:
     circle_averages.py <path> <start_time> <resolution> <grid> [<output_path>]
+        [--z_min=<m>] [--z_max=<m>] [--subsamples=<n>]
     circle_averages.py (-h | --help)
 
 Arguments:
@@ -15,74 +16,101 @@ Arguments:
 Options:
     -h --help
         Show this screen.
+    --z_min=<m>
+        Only use model levels from this altitude (m)
+    --z_max=<m>
+        Only use model levels up to this altitude (m)
+    --subsamples=<n>
+        Weight each gridpoint by the fraction of an n x n grid of points within the
+        gridbox that are inside the circle. The default only checks whether the
+        centre of each gridbox is inside the circle [default: 1]
 """
 
-import numpy as np
 import iris
-from iris.analysis import MEAN, RMS
 
 from twinotter.external.eurec4a import lon, lat, r
 from twinotter.util.scripting import parse_docopt_arguments
 
 from . import grey_zone_forecast
-
-
-def main(path, start_time, resolution, grid, output_path="./"):
+from .diagnostic_writer import write_diagnostics
+from .moments import horizontal_moments
+from .regions import Circle
+
+
+def main(
+    path,
+    start_time,
+    resolution,
+    grid,
+    output_path="./",
+    z_min=None,
+    z_max=None,
+    subsamples=1,
+):
     forecast = grey_zone_forecast(
-        path, start_time=start_time, resolution=resolution, grid=grid
+        path,
+        start_time=start_time,
+        resolution=resolution,
+        grid=grid,
+        z_min=z_min,
+        z_max=z_max,
     )
 
-    results = generate(forecast)
+    # The gridpoints in the circle are the same for all 2D and 3D fields
+    first_time = next(iter(forecast._loader.files))
+    example_cube = forecast.set_time(first_time).extract_cube("air_pressure")
+    indices, weights = circle_points(example_cube, subsamples=int(subsamples))
 
-    iris.save(
-        results,
+    write_diagnostics(
+        forecast,
         "{}/circle_averages_{}_{}_{}.nc".format(
             output_path,
             forecast.start_time.strftime("%Y%m%d"),
             resolution,
             grid,
         ),
+        lambda cubes: generate(cubes, indices, weights),
     )
 
 
-def generate(forecast):
+def generate(cubes, indices, weights):
+    """Mean and standard deviation of every 2D and 3D field in the circle
+
+    Args:
+        cubes (iris.cube.CubeList): The fields at a single time
+        indices (np.ndarray): The output of circle_points
+        weights (np.ndarray): The output of circle_points
+
+    Returns:
+        iris.cube.CubeList:
+    """
     results = iris.cube.CubeList()
+    for cube in cubes:
+        # Don't try to collapse coordinate cubes
+        if cube.ndim in (2, 3):
+            results.extend(horizontal_moments(cube, weights, indices=indices))
+
+    return results
+
+
+def circle_points(cube, subsamples=1):
+    """Find the gridpoints inside the EUREC4A circle
+
+    Args:
+        cube (iris.cube.Cube): A cube on the grid_longitude/grid_latitude grid
+        subsamples (int): Weight each gridpoint by the fraction of a subsamples x
+            subsamples grid of points within the gridbox that are inside the circle.
+            With subsamples=1 each gridpoint has a weight of 1 if its centre is inside
+            the circle
+
+    Returns:
+        tuple: The indices of the gridpoints inside the circle, in the flattened
+            horizontal grid, and the weight of each gridpoint
+    """
+    glon = cube.coord("grid_longitude").points - 360
+    glat = cube.coord("grid_latitude").points
 
-    for n, cubes in enumerate(forecast):
-        print(forecast.lead_time)
-        if n == 0:
-            example_cube = cubes.extract_cube("air_pressure")
-            glon = example_cube.coord("grid_longitude").points - 360
-            glat = example_cube.coord("grid_latitude").points
-
-            nz, ny, nx = example_cube.shape
-
-            glon = np.broadcast_to(glon, [ny, nx])
-            glat = np.broadcast_to(glat, [nx, ny]).transpose()
-
-            in_circle = (np.sqrt((glon - lon) ** 2 + (glat - lat) ** 2) < r).astype(int)
-            in_circle_3d = np.broadcast_to(in_circle, [nz, ny, nx])
-
-            weights = {2: in_circle, 3: in_circle_3d}
-
-        for cube in cubes:
-            # Don't try to collapse coordinate cubes
-            if cube.ndim in (2, 3):
-                mean = cube.collapsed(
-                    ["grid_latitude", "grid_longitude"],
-                    MEAN,
-                    weights=weights[cube.ndim],
-                )
-
-                std_dev = (cube - mean).collapsed(
-                    ["grid_latitude", "grid_longitude"], RMS, weights=weights[cube.ndim]
-                )
-                mean.rename(cube.name() + "_mean")
-                std_dev.rename(cube.name() + "_std_dev")
-                results.append(mean)
-                results.append(std_dev)
-
-    return results.merge()
+    return Circle("eurec4a", lon, lat, r).points(glon, glat, subsamples=subsamples)
 
 
 if __name__ == "__main__":
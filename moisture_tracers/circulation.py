@@ -1,4 +1,13 @@
 """
+Calculate the circulation, and the equivalent area-mean relative vorticity, around
+boxes centred on the domain, evenly spaced from the domain boundary to the centre, at
+each lead time in a forecast and save to a netCDF file. Each lead time is appended to
+the file when it is completed
+
+Only the winds on the box boundaries are interpolated to pressure levels. The line
+integrals along each boundary row and column are accumulated once, so the circulation
+around any axis-aligned box with edges on those rows and columns is the sum of four
+differences of the cumulative sums
 
 Usage:
     circulation.py <path> <start_time> <resolution> <grid> [<output_path>]
@@ -20,82 +29,326 @@ import pathlib
 import parse
 import numpy as np
 import matplotlib.pyplot as plt
+import iris
+from iris.coords import AuxCoord, DimCoord
 
 from irise import convert
 from irise.constants import omega
 from twinotter.util.scripting import parse_docopt_arguments
 
 from . import grey_zone_forecast
+from .diagnostic_writer import write_diagnostics
 
 
 a = 6378100
 
+plevs = np.arange(100000, 70000, -5000)
+
 
 def main(path, start_time, resolution, grid, output_path="./"):
     forecast = grey_zone_forecast(
         path, start_time=start_time, resolution=resolution, grid=grid
     )
-    circulation = get_circulations(forecast, plevs=np.arange(100000, 70000, -5000))
 
-    np.save(
-        "{}/circulation_{}_{}_{}.npy".format(
+    write_diagnostics(
+        forecast,
+        "{}/circulation_{}_{}_{}.nc".format(
             output_path,
             forecast.start_time.strftime("%Y%m%d"),
             resolution,
             grid,
         ),
-        np.array(circulation),
+        lambda cubes: generate(cubes, plevs),
     )
 
 
-def get_circulations(forecast, plevs):
+def generate(cubes, plevs, insets=None, ninsets=10):
+    """Calculate the circulation around boxes centred on the domain
+
+    Only the rows and columns on the box edges are read, so the cost increases with
+    the number of boxes. Calculating every centred box would read and interpolate the
+    whole domain, so by default a few boxes evenly spaced between the domain boundary
+    and the centre are used
+
+    Args:
+        cubes (iris.cube.CubeList):
+        plevs (array_like): The pressure levels (Pa) to calculate the circulation on
+        insets (list, optional): The number of gridpoints each box is inset from the
+            domain boundary. Overrides ninsets
+        ninsets (int): The number of evenly spaced boxes used if insets is not given
+
+    Returns:
+        iris.cube.CubeList: The relative circulation and mean relative vorticity with
+            dimensions (box_inset, air_pressure), and the planetary circulation with
+            dimension (box_inset)
+    """
+    # Only the grid and scalar coordinates of x_wind are needed here, so take them
+    # from the loaded cube rather than calculating x_wind again
+    u = cubes.extract_cube("x_wind")
+    ny, nx = u.shape[-2:]
+    if insets is None:
+        max_inset = (min(ny, nx) - 1) // 2 - 1
+        insets = np.unique(np.linspace(0, max_inset, ninsets).astype(int))
+    boxes = centred_boxes(ny, nx, insets)
+
+    circ, circ_p, area = calc_circulation(
+        cubes, levels=("air_pressure", plevs), boxes=boxes, return_area=True
+    )
+
+    box_coord = DimCoord(np.asarray(insets), long_name="box_inset", units="1")
+    area_coord = AuxCoord(area, long_name="box_area", units="m2")
+    pressure_coord = DimCoord(
+        np.asarray(plevs, dtype=float), standard_name="air_pressure", units="Pa"
+    )
+
+    results = iris.cube.CubeList()
+    for data, name, units in [
+        (circ, "relative_circulation", "m2 s-1"),
+        (circ / area[:, None], "mean_relative_vorticity", "s-1"),
+        (circ_p, "planetary_circulation", "m2 s-1"),
+    ]:
+        cube = iris.cube.Cube(
+            data,
+            long_name=name,
+            units=units,
+            dim_coords_and_dims=[(box_coord.copy(), 0)],
+            aux_coords_and_dims=[(area_coord.copy(), 0)],
+        )
+        if data.ndim == 2:
+            cube.add_dim_coord(pressure_coord.copy(), 1)
+        for coord in u.coords(dimensions=()):
+            cube.add_aux_coord(coord.copy())
+        results.append(cube)
+
+    return results
+
+
+def get_circulations(forecast, plevs, boxes=None):
+    """Calculate the circulation around the domain at every lead time in the forecast
+
+    Args:
+        forecast (irise.forecast.Forecast):
+        plevs (array_like): The pressure levels (Pa) to calculate the circulation on
+        boxes (np.ndarray, optional): The boxes to calculate the circulation around.
+            See calc_circulation. By default only use the domain boundary
+
+    Returns:
+        list: The circulation at each lead time. Each circulation has shape (nz,) or
+            (len(boxes), nz) if boxes are given
+    """
     circulation = []
     for cubes in forecast:
-        circ, circ_p = calc_circulation(cubes, levels=("air_pressure", plevs))
+        circ, circ_p = calc_circulation(
+            cubes, levels=("air_pressure", plevs), boxes=boxes
+        )
         circulation.append(circ)
     return circulation
 
 
-def calc_circulation(cubes, levels):
-    u = convert.calc("x_wind", cubes, levels=levels).data
-    v = convert.calc("y_wind", cubes, levels=levels).data
+def calc_circulation(cubes, levels, boxes=None, return_area=False):
+    """Calculate the circulation around axis-aligned boxes in the domain
+
+    Only the columns on the box boundaries are extracted and interpolated to the
+    requested levels, rather than the full 3D winds. The line integrals along each
+    boundary row and column are accumulated once, then the circulation around each box
+    is calculated from the differences of the cumulative sums at its corners
+
+    Args:
+        cubes (iris.cube.CubeList):
+        levels (tuple): The name of the vertical coordinate and the levels to
+            calculate the circulation on (e.g. ("air_pressure", plevs))
+        boxes (np.ndarray, optional): Array with shape (nboxes, 4) of the gridpoint
+            indices (j0, j1, i0, i1) of the bottom, top, left and right edges of each
+            box. See centred_boxes. By default only use the domain boundary
+        return_area (bool): Also return the area of each box
+
+    Returns:
+        tuple: The relative circulation with shape (nz,) and the planetary circulation,
+            or with an extra leading dimension for each box if boxes are given, and
+            the box areas if return_area is True
+    """
+    u = convert.calc("x_wind", cubes)
+    v = convert.calc("y_wind", cubes)
+    z = convert.calc(levels[0], cubes)
+    ny, nx = u.shape[-2:]
+
+    single_box = boxes is None
+    if single_box:
+        boxes = centred_boxes(ny, nx, [0])
+    j0, j1, i0, i1 = np.asarray(boxes).T
 
-    nz, ny, nx = u.shape
+    lon = np.deg2rad(u.coord("grid_longitude").points)
+    lat = np.deg2rad(u.coord("grid_latitude").points)
 
-    p = convert.calc("air_pressure", cubes)
-    lon = np.deg2rad(p.coord("grid_longitude").points)
-    lat = np.deg2rad(p.coord("grid_latitude").points)
+    rows = np.unique(np.concatenate([j0, j1]))
+    cols = np.unique(np.concatenate([i0, i1]))
+    row_index = np.searchsorted(rows, [j0, j1])
+    col_index = np.searchsorted(cols, [i0, i1])
 
-    dx_1 = np.broadcast_to(a * np.cos(lat[0]) * np.diff(lon), [nz, nx - 1])
-    dx_2 = np.broadcast_to(a * np.cos(lat[-1]) * np.diff(lon), [nz, nx - 1])
-    dy = np.broadcast_to(a * np.diff(lat), [nz, ny - 1])
+    # Cumulative line integrals of u along each boundary row and v along each
+    # boundary column
+    dx = a * np.cos(lat[rows])[:, None] * np.diff(lon)
+    dy = a * np.diff(lat)[:, None]
+    u_rows = boundary_columns(u, z, levels[1], rows=rows)
+    v_cols = boundary_columns(v, z, levels[1], cols=cols)
+    cu = _cumulative_line_integral(u_rows, dx, axis=-1)
+    cv = _cumulative_line_integral(v_cols, dy, axis=-2)
 
-    # Calculate circulation anticlockwise along each boundary of the domain
+    # Calculate circulation anticlockwise along each boundary of each box
     # bottom + right - top - left
-    circ_u = np.sum((u[:, 0, :-1] + u[:, 0, 1:]) * 0.5 * dx_1, axis=1)
-    circ_v = np.sum((v[:, :-1, -1] + v[:, 1:, -1]) * 0.5 * dy, axis=1)
-    circ_u_2 = np.sum((u[:, -1, :-1] + u[:, -1, 1:]) * 0.5 * dx_2, axis=1)
-    circ_v_2 = np.sum((v[:, :-1, 0] + v[:, 1:, 0]) * 0.5 * dy, axis=1)
+    z_all = slice(None)
+    circ = (
+        _segment_integral(cu, (z_all, row_index[0], i0), (z_all, row_index[0], i1))
+        + _segment_integral(cv, (z_all, j0, col_index[1]), (z_all, j1, col_index[1]))
+        - _segment_integral(cu, (z_all, row_index[1], i0), (z_all, row_index[1], i1))
+        - _segment_integral(cv, (z_all, j0, col_index[0]), (z_all, j1, col_index[0]))
+    ).T
 
     # Calculate the planetary circulation
     # This should be constant as we are using a fixed domain but it is a useful
     # comparison for strength of the relative circulation
-    u_planetary = omega.data * a * np.cos([lat[0], lat[-1]])
-    circ_p = np.sum((u_planetary[0]) * dx_1)
-    circ_p_2 = np.sum((u_planetary[1]) * dx_2)
+    width = lon[i1] - lon[i0]
+    circ_p = omega.data * a ** 2 * width * (np.cos(lat[j0]) ** 2 - np.cos(lat[j1]) ** 2)
+    area = a ** 2 * width * (np.sin(lat[j1]) - np.sin(lat[j0]))
+
+    if single_box:
+        circ, circ_p, area = circ[0], circ_p[0], area[0]
+
+    if return_area:
+        return circ, circ_p, area
+    else:
+        return circ, circ_p
+
+
+def centred_boxes(ny, nx, insets):
+    """Boxes centred on the domain, inset from the domain boundary
+
+    Args:
+        ny (int):
+        nx (int):
+        insets (list): The number of gridpoints each box is inset from the domain
+            boundary
+
+    Returns:
+        np.ndarray: Array with shape (len(insets), 4) of the gridpoint indices
+            (j0, j1, i0, i1) of the bottom, top, left and right edges of each box
+    """
+    insets = np.asarray(insets)
+    if (insets < 0).any() or (2 * insets >= min(ny, nx) - 1).any():
+        raise ValueError("Insets {} do not fit in the domain".format(insets))
 
-    return circ_u + circ_v - circ_u_2 - circ_v_2, circ_p - circ_p_2
+    return np.stack([insets, ny - 1 - insets, insets, nx - 1 - insets], axis=-1)
+
+
+def boundary_columns(cube, z, levels, rows=None, cols=None):
+    """Extract rows or columns of a 3D field and interpolate them to new levels
+
+    Only the requested rows or columns of the data are read
+
+    Args:
+        cube (iris.cube.Cube): 3D field with dimensions (z, y, x)
+        z (iris.cube.Cube): The vertical coordinate to interpolate on with the same
+            dimensions as cube (e.g. air_pressure)
+        levels (array_like): The levels to interpolate to
+        rows (np.ndarray, optional): The indices of the rows to extract
+        cols (np.ndarray, optional): The indices of the columns to extract
+
+    Returns:
+        np.ndarray: The rows with shape (nlevels, nrows, nx) or the columns with shape
+            (nlevels, ny, ncols)
+    """
+    if rows is not None:
+        index = (slice(None), rows, slice(None))
+    else:
+        index = (slice(None), slice(None), cols)
+
+    data = np.ma.filled(np.asarray(cube.core_data()[index], dtype=float), np.nan)
+    z = np.ma.filled(np.asarray(z.core_data()[index], dtype=float), np.nan)
+
+    return interpolate_columns(data, z, levels)
+
+
+def interpolate_columns(data, z, levels):
+    """Linearly interpolate every column of data to levels of z
+
+    Args:
+        data (np.ndarray): Array with the vertical dimension first
+        z (np.ndarray): The vertical coordinate with the same shape as data. It must be
+            monotonic in each column
+        levels (array_like): The levels to interpolate to
+
+    Returns:
+        np.ndarray: Array with shape (len(levels),) + data.shape[1:]. Levels outside
+            the range of z in a column are NaN
+    """
+    levels = np.asarray(levels, dtype=float)
+    nz = len(z)
+
+    # Make the vertical coordinate increase with index
+    if np.nanmean(z[0]) > np.nanmean(z[-1]):
+        z = z[::-1]
+        data = data[::-1]
+
+    # Index of the level below each requested level in each column
+    shape = (len(levels),) + (1,) * (z.ndim - 1)
+    k = (z[None] <= levels.reshape((-1,) + (1,) * z.ndim)).sum(axis=1) - 1
+    outside = (k < 0) | (k >= nz - 1)
+    k = np.clip(k, 0, nz - 2)
+
+    z0 = np.take_along_axis(z, k, axis=0)
+    z1 = np.take_along_axis(z, k + 1, axis=0)
+    x0 = np.take_along_axis(data, k, axis=0)
+    x1 = np.take_along_axis(data, k + 1, axis=0)
+
+    weight = (levels.reshape(shape) - z0) / (z1 - z0)
+    result = x0 + weight * (x1 - x0)
+
+    # Keep values exactly on the top level
+    on_top = levels.reshape(shape) == z[-1]
+    result = np.where(on_top, data[-1], result)
+    result[outside & ~on_top] = np.nan
+
+    return result
+
+
+def _cumulative_line_integral(x, dx, axis):
+    # Integrate x along an axis with the trapezium rule, starting from zero at the
+    # first point. NaN segments (e.g. levels below the surface) are skipped, and the
+    # cumulative number of NaN segments is also returned so integrals that include
+    # them can be identified by _segment_integral
+    n = x.shape[axis]
+    x0 = np.take(x, range(n - 1), axis=axis)
+    x1 = np.take(x, range(1, n), axis=axis)
+    segments = (x0 + x1) * 0.5 * dx
+
+    pad = [(0, 0)] * x.ndim
+    pad[axis] = (1, 0)
+    integral = np.pad(np.nancumsum(segments, axis=axis), pad)
+    nans = np.pad(np.cumsum(np.isnan(segments), axis=axis), pad)
+
+    return integral, nans
+
+
+def _segment_integral(cumulative, start, end):
+    # The integral between two points from a cumulative integral. NaN if any segment
+    # between the two points is NaN
+    integral, nans = cumulative
+    result = integral[end] - integral[start]
+
+    return np.where(nans[end] - nans[start] > 0, np.nan, result)
 
 
 def plot_all():
     path = pathlib.Path(".")
-    filenames = path.glob("circulation_*.npy")
+    filenames = path.glob("circulation_*.nc")
 
     for filename in filenames:
         print(filename)
-        circulation = np.load(str(filename))
-        resolution = parse.parse("circulation_{}.npy", str(filename))[0]
-        plt.plot(circulation[:, 0], label=resolution)
+        circulation = iris.load_cube(str(filename), "relative_circulation")
+        resolution = parse.parse("circulation_{}.nc", str(filename))[0]
+
+        # Circulation around the domain boundary on the lowest pressure level
+        plt.plot(circulation[:, 0, 0].data, label=resolution)
 
     plt.legend()
     plt.show()
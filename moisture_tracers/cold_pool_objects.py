@@ -0,0 +1,227 @@
+"""
+Identify cold pools as connected regions of the surface evaporation tracer
+
+Unlike cold_pool_tracking.get_cold_pool_contours, this works directly on the model grid
+without contouring with matplotlib, so it can run in batch jobs at native resolution.
+Gridpoints where the evaporation tracer exceeds a threshold are labelled as connected
+objects with scipy.ndimage.label. The area of each object and its area-weighted centroid
+in true longitude/latitude are then calculated with one pass over the labelled
+gridpoints. For objects joined across the boundaries of a periodic domain the centroid
+is the circular mean of the grid indices, so it lies within the object
+
+>>> cold_pools = detect_cold_pools(cubes.extract_cube("microphysics_evaporation_q")[0])
+>>> for slices, mask in cold_pools["masks"]:
+...     evaporation_tracer[slices].data[mask]
+"""
+
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from iris.analysis.cartography import unrotate_pole
+from iris.coord_systems import RotatedGeogCS
+
+from moisture_tracers.grid_metrics import GridMetrics
+
+
+def detect_cold_pools(
+    evaporation_tracer, threshold=1e-4, periodic=False, diagonal=False, min_size=1
+):
+    """Label connected regions of the evaporation tracer above a threshold
+
+    Args:
+        evaporation_tracer (iris.cube.Cube): The 2D surface evaporation tracer
+            (microphysics_evaporation_q) with x and y dimension coordinates
+        threshold (float): Gridpoints with the evaporation tracer greater than this
+            value are part of a cold pool
+        periodic (bool): Join objects across opposite boundaries of the domain
+        diagonal (bool): Also connect gridpoints that only touch at corners
+        min_size (int): Remove objects with fewer gridpoints than this
+
+    Returns:
+        dict: labels, an integer array the same shape as the cube that is zero outside
+            cold pools and numbers each cold pool from one; masks, a list of the
+            (y, x) slices of the box containing each cold pool and the boolean mask of
+            the cold pool within that box; area (m2); longitude and latitude of the
+            centroid (degrees, unrotated); npoints; and edge, whether each cold pool
+            touches the domain boundary (always False if periodic)
+    """
+    mask = np.ma.filled(evaporation_tracer.data > threshold, False)
+
+    structure = ndimage.generate_binary_structure(2, 2 if diagonal else 1)
+    labels, nlabels = ndimage.label(mask, structure=structure)
+
+    if periodic:
+        labels, nlabels = _join_periodic(labels, nlabels, diagonal)
+
+    npoints = np.bincount(labels.ravel(), minlength=nlabels + 1)
+    if min_size > 1:
+        keep = npoints >= min_size
+        keep[0] = False
+        labels, nlabels = _relabel(labels, keep)
+        npoints = np.bincount(labels.ravel(), minlength=nlabels + 1)
+
+    gridbox_area = GridMetrics.from_cube(evaporation_tracer).area
+    area = np.bincount(
+        labels.ravel(), weights=gridbox_area.ravel(), minlength=nlabels + 1
+    )
+    lon, lat = _centroids(evaporation_tracer, gridbox_area, labels, nlabels, periodic)
+
+    if periodic:
+        edge = np.zeros(nlabels, dtype=bool)
+    else:
+        edge_labels = np.concatenate(
+            [labels[0], labels[-1], labels[:, 0], labels[:, -1]]
+        )
+        edge = np.isin(np.arange(1, nlabels + 1), edge_labels)
+
+    masks = [
+        (slices, labels[slices] == n + 1)
+        for n, slices in enumerate(ndimage.find_objects(labels, max_label=nlabels))
+    ]
+
+    return dict(
+        labels=labels,
+        masks=masks,
+        area=area[1:],
+        longitude=lon,
+        latitude=lat,
+        npoints=npoints[1:],
+        edge=edge,
+    )
+
+
+def true_coordinates(cube):
+    """The unrotated longitude and latitude of each gridpoint
+
+    Args:
+        cube (iris.cube.Cube): A cube with x and y dimension coordinates as the last
+            two dimensions
+
+    Returns:
+        tuple: 2D arrays of longitude and latitude (degrees)
+    """
+    x = cube.coord(axis="x", dim_coords=True)
+    y = cube.coord(axis="y", dim_coords=True)
+    xg, yg = np.meshgrid(x.points, y.points)
+
+    return _unrotate(x.coord_system, xg, yg)
+
+
+def _unrotate(cs, x, y):
+    # Convert grid coordinates to true longitude and latitude
+    if isinstance(cs, RotatedGeogCS):
+        return unrotate_pole(
+            x, y, cs.grid_north_pole_longitude, cs.grid_north_pole_latitude
+        )
+    else:
+        return x, y
+
+
+def _centroids(cube, weights, labels, nlabels, periodic=False):
+    if periodic:
+        return _periodic_centroids(cube, weights, labels, nlabels)
+
+    # Area-weighted mean of the unit vectors of the gridpoints in each object, so
+    # objects crossing the dateline are handled correctly
+    lon, lat = np.deg2rad(true_coordinates(cube))
+
+    vectors = [
+        np.cos(lat) * np.cos(lon),
+        np.cos(lat) * np.sin(lon),
+        np.sin(lat),
+    ]
+    x, y, z = [
+        np.bincount(
+            labels.ravel(), weights=(weights * v).ravel(), minlength=nlabels + 1
+        )[1:]
+        for v in vectors
+    ]
+
+    return (
+        np.rad2deg(np.arctan2(y, x)),
+        np.rad2deg(np.arctan2(z, np.sqrt(x ** 2 + y ** 2))),
+    )
+
+
+def _periodic_centroids(cube, weights, labels, nlabels):
+    # Objects joined across opposite boundaries of the domain are split between both
+    # sides, so take the area-weighted circular mean of the grid indices over the
+    # period of each dimension, then convert the mean indices to longitude/latitude
+    x = cube.coord(axis="x", dim_coords=True)
+    y = cube.coord(axis="y", dim_coords=True)
+    j, i = np.indices(labels.shape)
+
+    coords = []
+    for coord, index in [(x, i), (y, j)]:
+        mean = _circular_mean(index, len(coord.points), weights, labels, nlabels)
+        coords.append(_index_to_coord(coord.points, mean))
+    lon, lat = _unrotate(x.coord_system, *coords)
+
+    # Longitudes from -180 to 180, as for non-periodic domains
+    return (lon + 180) % 360 - 180, lat
+
+
+def _circular_mean(index, period, weights, labels, nlabels):
+    # Area-weighted mean of the indices in each object, treating the indices as angles
+    # around the period of the dimension
+    angle = 2 * np.pi * index / period
+    sums = [
+        np.bincount(
+            labels.ravel(), weights=(weights * f(angle)).ravel(), minlength=nlabels + 1
+        )[1:]
+        for f in (np.cos, np.sin)
+    ]
+
+    return (np.arctan2(sums[1], sums[0]) * period / (2 * np.pi)) % period
+
+
+def _index_to_coord(points, index):
+    # Linearly interpolate the coordinate to fractional indices. Indices between the
+    # last and first gridpoint (across the periodic boundary) continue past the last
+    # gridpoint
+    points = np.append(points, 2 * points[-1] - points[-2])
+
+    return np.interp(index, np.arange(len(points)), points)
+
+
+def _join_periodic(labels, nlabels, diagonal):
+    # Join labels that touch across opposite boundaries of the domain
+    pairs = [(labels[:, 0], labels[:, -1]), (labels[0, :], labels[-1, :])]
+    if diagonal:
+        # Neighbouring rows/columns across the boundary also touch at corners
+        pairs += [
+            (labels[1:, 0], labels[:-1, -1]),
+            (labels[:-1, 0], labels[1:, -1]),
+            (labels[0, 1:], labels[-1, :-1]),
+            (labels[0, :-1], labels[-1, 1:]),
+        ]
+    label1 = np.concatenate([a for a, b in pairs])
+    label2 = np.concatenate([b for a, b in pairs])
+    touching = (label1 > 0) & (label2 > 0)
+
+    graph = coo_matrix(
+        (np.ones(touching.sum()), (label1[touching], label2[touching])),
+        shape=(nlabels + 1, nlabels + 1),
+    )
+    _, components = connected_components(graph, directed=False)
+
+    # Renumber the joined objects from one in order of their first label, keeping
+    # zero as the background
+    _, first, inverse = np.unique(
+        components[1:], return_index=True, return_inverse=True
+    )
+    rank = np.empty(len(first), dtype=labels.dtype)
+    rank[np.argsort(first)] = np.arange(1, len(first) + 1)
+    new_labels = np.zeros(nlabels + 1, dtype=labels.dtype)
+    new_labels[1:] = rank[inverse]
+
+    return new_labels[labels], len(first)
+
+
+def _relabel(labels, keep):
+    # Remove the labels that are not kept and renumber the rest from one
+    new_labels = np.zeros(len(keep), dtype=labels.dtype)
+    new_labels[keep] = np.arange(1, keep.sum() + 1)
+
+    return new_labels[labels], keep.sum()
@@ -1,4 +1,5 @@
 from shapely.geometry.polygon import Polygon
+from shapely.strtree import STRtree
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -7,6 +8,9 @@ import iris.plot as iplt
 
 from irise import plot
 
+from moisture_tracers import contour_geometry
+from moisture_tracers.contour_geometry import haversine
+
 colours = plt.rcParams["axes.prop_cycle"].by_key()["color"]
 
 
@@ -51,6 +55,12 @@ def identify_possibles(forecast):
 
 
 def get_cold_pool_contours(evaporation_tracer, threshold=1e-4):
+    """Contour the evaporation tracer with matplotlib
+
+    This needs a figure to draw the contours on. See
+    moisture_tracers.cold_pool_objects.detect_cold_pools to identify cold pools on the
+    model grid without plotting
+    """
     cs = iplt.contour(evaporation_tracer, [threshold])
 
     return cs.allsegs[0]
@@ -66,27 +76,27 @@ def filter_invalid(contours):
 
     """
     # Sort contours by distance
-    contours = sorted(
-        [contour for contour in contours if len(contour) > 2], key=contour_length
-    )
+    contours = [contour for contour in contours if len(contour) > 2]
+    points, offsets = contour_geometry.pack(contours)
+    order = np.argsort(contour_geometry.lengths(points, offsets), kind="stable")
+    contours = [contours[n] for n in order]
+    closed = contour_geometry.is_closed(points, offsets)[order]
+    if len(contours) == 0:
+        return contours
     polygons = [Polygon(contour) for contour in contours]
 
-    # Check whether the shorter contours are contained by the longer contours
-    to_be_removed = []
-    for n, poly1 in enumerate(polygons):
-        for m, poly2 in enumerate(polygons):
-            if n != m and poly2.contains(poly1):
-                to_be_removed.append(n)
+    # Check whether each contour is contained by any other contour. The spatial index
+    # only tests pairs of contours with overlapping bounding boxes. The query returns
+    # the indices of pairs (m, n) where polygons[m] contains polygons[n]
+    tree = STRtree(polygons)
+    container, contained = tree.query(polygons, predicate="contains")
+    to_be_removed = np.zeros(len(contours), dtype=bool)
+    to_be_removed[contained[container != contained]] = True
 
     # Remove open contours
-    for n, contour in enumerate(contours):
-        if not is_closed_contour(contour):
-            to_be_removed.append(n)
-
-    for n in reversed(sorted(set(to_be_removed))):
-        del contours[n]
+    to_be_removed |= ~closed
 
-    return contours
+    return [contour for contour, remove in zip(contours, to_be_removed) if not remove]
 
 
 def contour_length(points):
@@ -98,11 +108,7 @@ def contour_length(points):
     Returns:
         float: The total length of the contour in kilometres
     """
-    conlen = haversine(points[-1], points[0])
-    for n in range(len(points) - 1):
-        conlen += haversine(points[n], points[n + 1])
-
-    return conlen
+    return contour_geometry.lengths(*contour_geometry.pack([points]))[0]
 
 
 def is_closed_contour(contour_section, threshold=0.1):
@@ -126,22 +132,6 @@ def is_closed_contour(contour_section, threshold=0.1):
     return haversine(contour_section[0], contour_section[-1]) < threshold
 
 
-def haversine(x1, x2):
-    """Calculate the great circle distance between two points on the earth
-    (specified in decimal degrees)
-    """
-    # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(np.deg2rad, [x1[0], x1[1], x2[0], x2[1]])
-
-    # haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
-    c = 2 * np.arcsin(np.sqrt(a))
-    r = 6371  # Radius of earth in kilometers
-    return c * r
-
-
 if __name__ == "__main__":
     import datetime
     from . import grey_zone_forecast
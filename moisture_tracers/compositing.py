@@ -0,0 +1,371 @@
+"""
+Composite every variable in "moisture space". The domain is sorted by a 2D variable
+(e.g. column relative humidity) and each field is averaged over bins containing equal
+numbers of gridpoints, ordered from the lowest to the highest value of the sorting
+variable
+
+Usage:
+    compositing.py
+        <path> <start_time> <resolution> <grid> <sort_variable>
+        [<nbins>] [--output_path=<path>]
+    compositing.py (-h | --help)
+
+Arguments:
+    <path>
+    <start_time>
+    <resolution>
+    <grid>
+    <sort_variable>
+        The 2D variable used to sort the domain. Either a variable that can be
+        calculated with irise.convert (e.g. atmosphere_boundary_layer_thickness) or
+        one of column_relative_humidity or mesoscale_total_column_water
+    <nbins>
+        The number of rank bins [Default: 10]
+
+Options:
+    -h --help
+        Show this screen.
+"""
+
+import numpy as np
+import iris
+from iris.analysis import Nearest
+from iris.coords import AuxCoord
+from iris.exceptions import CoordinateNotFoundError
+
+from irise import convert, grid
+
+from twinotter.util.scripting import parse_docopt_arguments
+
+from moisture_tracers import grey_zone_forecast
+from moisture_tracers.anomaly_scale_decomposition import decompose_scales
+from moisture_tracers.diagnostic_writer import write_diagnostics
+from moisture_tracers.grid_metrics import GridMetrics
+
+
+def main(path, start_time, resolution, grid, sort_variable, nbins=10, output_path="."):
+    """
+    Calculate composites of all variables binned by rank of the sort variable at each
+    lead time in a forecast and save to a netCDF file. Each lead time is appended to
+    the file when it is completed
+    """
+    nbins = int(nbins)
+
+    forecast = grey_zone_forecast(
+        path=path, start_time=start_time, resolution=resolution, grid=grid
+    )
+
+    write_diagnostics(
+        forecast,
+        "{}/composites_by_{}_{}_{}_{}.nc".format(
+            output_path,
+            sort_variable,
+            forecast.start_time.strftime("%Y%m%d"),
+            resolution,
+            grid,
+        ),
+        lambda cubes: generate(cubes, sort_variable, nbins),
+    )
+
+
+def generate(cubes, sort_variable, nbins):
+    """Composite all 2D and 3D variables in the cubelist by the sort variable
+
+    Args:
+        cubes (iris.cube.CubeList):
+        sort_variable (str): The name of the variable to sort by
+        nbins (int): The number of rank bins
+
+    Returns:
+        iris.cube.CubeList: The composite of each variable and the moisture-space
+            streamfunction
+    """
+    if sort_variable in sort_variables:
+        sort_cube = sort_variables[sort_variable](cubes)
+    else:
+        sort_cube = convert.calc(sort_variable, cubes)
+
+    density = cubes.extract_cube("air_density")
+    to_composite = iris.cube.CubeList(
+        [
+            cube
+            for cube in cubes
+            if cube.ndim in (2, 3) and cube.shape[-2:] == sort_cube.shape
+        ]
+    )
+    if sort_cube.name() not in [cube.name() for cube in to_composite]:
+        to_composite.append(sort_cube)
+
+    # Rank the sort variable once and use the same bins for both diagnostics
+    bins = rank_bins(sort_cube.data, nbins)
+    results = composite(sort_cube, to_composite, nbins, density=density, bins=bins)
+    results.append(
+        streamfunction(
+            sort_cube,
+            density,
+            cubes.extract_cube("upward_air_velocity"),
+            nbins,
+            bins=bins,
+        )
+    )
+
+    return results
+
+
+def rank_bins(sort_field, nbins):
+    """Sort a 2D field and split it into bins with equal numbers of gridpoints
+
+    Args:
+        sort_field (np.ndarray): 2D array to sort by
+        nbins (int): Number of bins
+
+    Returns:
+        tuple: The indices that sort the flattened field and the offset of the first
+            sorted index in each bin
+    """
+    order = np.argsort(sort_field, axis=None, kind="stable")
+    offsets = (np.arange(nbins) * order.size) // nbins
+
+    return order, offsets
+
+
+def bin_sums(data, order, offsets):
+    """Sum data over each rank bin
+
+    Args:
+        data (np.ndarray): Array with the last two dimensions matching the sort field
+        order (np.ndarray): Indices that sort the flattened sort field
+        offsets (np.ndarray): Offset of the first sorted index in each bin
+
+    Returns:
+        np.ndarray: Array with the last two dimensions replaced by the bins
+    """
+    data = np.reshape(data, data.shape[:-2] + (-1,))
+    return np.add.reduceat(data[..., order], offsets, axis=-1, dtype=np.float64)
+
+
+def composite(sort_cube, cubes, nbins, density=None, bins=None):
+    """Average each cube in bins of the ranked sort_cube
+
+    2D cubes are area weighted. 3D cubes are mass weighted if density is given,
+    otherwise they are area weighted.
+
+    Args:
+        sort_cube (iris.cube.Cube): 2D cube to sort by
+        cubes (iris.cube.CubeList): Cubes with the same horizontal grid as sort_cube
+        nbins (int): Number of bins
+        density (iris.cube.Cube): The mass weights of each 3D cube are taken from the
+            levels of density with the same vertical coordinate as the cube
+        bins (tuple, optional): The output of rank_bins for sort_cube, if it has
+            already been calculated
+
+    Returns:
+        iris.cube.CubeList: Each cube averaged in bins with a leading rank coordinate
+
+    Raises:
+        ValueError: If a 3D cube has levels that are not levels of density
+    """
+    if bins is None:
+        bins = rank_bins(sort_cube.data, nbins)
+    order, offsets = bins
+
+    weights_2d = GridMetrics.from_cube(sort_cube).area
+    weight_sums = {2: bin_sums(weights_2d, order, offsets)}
+    if density is not None:
+        weights_3d = GridMetrics.from_cube(density).volume * density.data
+        weight_sums[3] = bin_sums(weights_3d, order, offsets)
+    else:
+        weights_3d = np.broadcast_to(weights_2d, (1,) + weights_2d.shape)
+        weight_sums[3] = weight_sums[2]
+    weights = {2: weights_2d, 3: weights_3d}
+
+    results = iris.cube.CubeList()
+    for cube in cubes:
+        if cube.ndim == 3 and density is not None:
+            index = _matching_levels(cube, density)
+            cube_weights = weights[3][index]
+            cube_weight_sums = weight_sums[3][index]
+        else:
+            cube_weights = weights[cube.ndim]
+            cube_weight_sums = weight_sums[cube.ndim]
+
+        mean = bin_sums(cube.data * cube_weights, order, offsets) / cube_weight_sums
+        for cube_binned in _bins_to_cubes(cube, mean.astype(cube.dtype)):
+            results.append(cube_binned)
+
+    return results.merge()
+
+
+def _matching_levels(cube, density):
+    # Indices of the levels of density with the same points of the vertical coordinate
+    # as each level of the cube
+    zcoords = cube.coords(axis="z", dim_coords=True)
+    zcoords += cube.coords("model_level_number", dim_coords=True)
+    if len(zcoords) == 0 or cube.coord_dims(zcoords[0]) != (0,):
+        raise ValueError(
+            "{} does not have levels as its first dimension".format(cube.name())
+        )
+    z = zcoords[0]
+
+    try:
+        z_density = density.coord(z.name(), dim_coords=True)
+    except CoordinateNotFoundError:
+        raise ValueError(
+            "{} does not have the vertical coordinate of {} ({})".format(
+                density.name(), cube.name(), z.name()
+            )
+        )
+
+    index = {point: n for n, point in enumerate(z_density.points)}
+    missing = [point for point in z.points if point not in index]
+    if missing:
+        raise ValueError(
+            "{} has levels that are not levels of {}, {} = {}".format(
+                cube.name(),
+                density.name(),
+                z.name(),
+                ", ".join(str(point) for point in missing),
+            )
+        )
+
+    return np.array([index[point] for point in z.points])
+
+
+def streamfunction(sort_cube, density, w, nbins, bins=None):
+    """Calculate the moisture-space streamfunction
+
+    The streamfunction is the cumulative upward mass flux, summed from the bin with the
+    lowest value of the sort variable, with each bin weighted by its fraction of the
+    domain area
+
+    Args:
+        sort_cube (iris.cube.Cube): 2D cube to sort by
+        density (iris.cube.Cube):
+        w (iris.cube.Cube): Vertical velocity on the same grid as density
+        nbins (int): Number of bins
+        bins (tuple, optional): The output of rank_bins for sort_cube, if it has
+            already been calculated
+
+    Returns:
+        iris.cube.Cube:
+    """
+    if bins is None:
+        bins = rank_bins(sort_cube.data, nbins)
+    order, offsets = bins
+    weights = GridMetrics.from_cube(sort_cube).area
+    area_fraction = bin_sums(weights, order, offsets) / weights.sum()
+
+    mass_flux = bin_sums(density.data * w.data * weights, order, offsets)
+    psi = np.cumsum(mass_flux / weights.sum(), axis=-1)
+
+    results = iris.cube.CubeList(_bins_to_cubes(w, psi.astype(w.dtype)))
+    psi = results.merge_cube()
+    psi.rename("moisture_space_streamfunction")
+    psi.units = density.units * w.units
+    psi.add_aux_coord(
+        AuxCoord(area_fraction, long_name="area_fraction", units="1"),
+        psi.coord_dims("rank_bin"),
+    )
+
+    return psi
+
+
+def _bins_to_cubes(cube, data):
+    # Slice out a single column of the cube to use as a template for each bin
+    nbins = data.shape[-1]
+    template = cube[..., 0, 0]
+    for axis in ["x", "y"]:
+        template.remove_coord(cube.coord(axis=axis, dim_coords=True).name())
+
+    for n in range(nbins):
+        cube_binned = template.copy(data=data[..., n])
+        cube_binned.add_aux_coord(AuxCoord(points=n + 1, long_name="rank_bin"))
+        cube_binned.add_aux_coord(
+            AuxCoord(
+                points=100 * (n + 0.5) / nbins,
+                long_name="percentile_rank",
+                units="percent",
+            )
+        )
+        yield cube_binned
+
+
+def column_relative_humidity(cubes):
+    """The ratio of water vapour path to saturated water vapour path
+
+    The paths are integrated over the levels in cubes, so the forecast should be
+    loaded without z_min or z_max for the full column
+
+    Args:
+        cubes (iris.cube.CubeList):
+
+    Returns:
+        iris.cube.Cube:
+    """
+    density = cubes.extract_cube("air_density")
+    q = cubes.extract_cube("specific_humidity")
+    temperature = convert.calc("air_temperature", cubes)
+    pressure = cubes.extract_cube("air_pressure")
+
+    qs = saturation_specific_humidity(temperature.data, pressure.data)
+
+    column_mass = (density * grid.thickness(density)).data
+    crh = (column_mass * q.data).sum(axis=0) / (column_mass * qs).sum(axis=0)
+
+    crh = q[0].copy(data=crh)
+    crh.rename("column_relative_humidity")
+    crh.units = "1"
+
+    return crh
+
+
+def saturation_specific_humidity(temperature, pressure):
+    """Saturation specific humidity over liquid water using Bolton (1980)
+
+    Args:
+        temperature (np.ndarray): Temperature (K)
+        pressure (np.ndarray): Pressure (Pa)
+
+    Returns:
+        np.ndarray:
+    """
+    es = 611.2 * np.exp(17.67 * (temperature - 273.15) / (temperature - 29.65))
+
+    return 0.622 * es / (pressure - 0.378 * es)
+
+
+def mesoscale_total_column_water(cubes, coarse_factor=4):
+    """The mesoscale anomaly of total column water on the native grid
+
+    Uses total_column_water from cubes if it is there. Otherwise it is integrated over
+    the levels in cubes, so a forecast loaded with z_min or z_max needs
+    column_integrals=["total_column_water"] (see grey_zone_forecast)
+
+    Args:
+        cubes (iris.cube.CubeList):
+        coarse_factor (int):
+
+    Returns:
+        iris.cube.Cube:
+    """
+    qt_column = convert.calc("total_column_water", cubes)
+    qt_mean, qt_meso, qt_cu = decompose_scales(qt_column, coarse_factor=coarse_factor)
+
+    qt_meso = qt_meso.regrid(qt_column, Nearest())
+    qt_meso.rename("mesoscale_total_column_water")
+
+    return qt_meso
+
+
+sort_variables = dict(
+    column_relative_humidity=column_relative_humidity,
+    mesoscale_total_column_water=mesoscale_total_column_water,
+)
+
+
+if __name__ == "__main__":
+    import warnings
+
+    warnings.filterwarnings("ignore")
+
+    parse_docopt_arguments(main, __doc__)
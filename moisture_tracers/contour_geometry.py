@@ -0,0 +1,157 @@
+"""
+Geometry of many contours at once
+
+A list of contours, each an (N, 2) array of longitude and latitude points (degrees), is
+packed into a single array of points and an array of offsets, where the points of
+contour n are points[offsets[n]:offsets[n + 1]]. The lengths, areas, centroids and
+closure of all contours are then calculated with vectorised operations over the packed
+points rather than looping over each contour and point
+
+>>> points, offsets = pack(contours)
+>>> lengths(points, offsets)
+"""
+
+import numpy as np
+
+# Radius of the earth (km)
+r = 6371
+
+
+def pack(contours):
+    """Pack a list of contours into a single array
+
+    Args:
+        contours (list): (N, 2) arrays of longitude and latitude points (degrees). Each
+            contour must have at least one point
+
+    Returns:
+        tuple: An (M, 2) array of all points and an array of the offsets of the first
+            point of each contour, with the total number of points as the last element
+    """
+    offsets = np.zeros(len(contours) + 1, dtype=int)
+    offsets[1:] = np.cumsum([len(contour) for contour in contours])
+    if len(contours) == 0:
+        return np.zeros((0, 2)), offsets
+
+    return np.concatenate([np.asarray(contour) for contour in contours]), offsets
+
+
+def haversine(x1, x2):
+    """Calculate the great circle distance between two points on the earth
+    (specified in decimal degrees)
+
+    Args:
+        x1, x2 (array_like): Longitude and latitude of the points with shape (2, ...)
+
+    Returns:
+        np.ndarray: The distance (km)
+    """
+    # convert decimal degrees to radians
+    lon1, lat1, lon2, lat2 = map(np.deg2rad, [x1[0], x1[1], x2[0], x2[1]])
+
+    # haversine formula
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arcsin(np.sqrt(a))
+    return c * r
+
+
+def lengths(points, offsets):
+    """Length of each contour, including the segment from the last point to the first
+
+    Args:
+        points (np.ndarray): The (M, 2) longitude and latitude points from pack
+        offsets (np.ndarray): The offsets of the first point of each contour from pack
+
+    Returns:
+        np.ndarray: The length of each contour (km)
+    """
+    return _sum_segments(haversine(points.T, _next_points(points, offsets).T), offsets)
+
+
+def areas(points, offsets):
+    """Area enclosed by each contour on a sphere
+
+    Uses the approximation to the spherical polygon area of Chamberlain and Duquette
+    (2007), treating each contour as closed
+
+    Args:
+        points (np.ndarray): The (M, 2) longitude and latitude points from pack
+        offsets (np.ndarray): The offsets of the first point of each contour from pack
+
+    Returns:
+        np.ndarray: The area of each contour (km2)
+    """
+    lon, lat = np.deg2rad(points.T)
+    lon_next, lat_next = np.deg2rad(_next_points(points, offsets).T)
+
+    segments = (lon_next - lon) * (2 + np.sin(lat) + np.sin(lat_next))
+
+    return np.abs(_sum_segments(segments, offsets)) * r ** 2 / 2
+
+
+def centroids(points, offsets):
+    """Centroid of the area enclosed by each contour in longitude/latitude
+
+    Contours that enclose no area (e.g. a line) use the mean of their points
+
+    Args:
+        points (np.ndarray): The (M, 2) longitude and latitude points from pack
+        offsets (np.ndarray): The offsets of the first point of each contour from pack
+
+    Returns:
+        np.ndarray: Array of shape (ncontours, 2) of the longitude and latitude
+            (degrees) of each centroid
+    """
+    # Shift each contour to its first point to reduce rounding errors
+    origin = np.repeat(points[offsets[:-1]], np.diff(offsets), axis=0)
+    x, y = (points - origin).T
+    x_next, y_next = (_next_points(points, offsets) - origin).T
+
+    cross = x * y_next - x_next * y
+    area = _sum_segments(cross, offsets) / 2
+    cx = _sum_segments((x + x_next) * cross, offsets)
+    cy = _sum_segments((y + y_next) * cross, offsets)
+
+    npoints = np.diff(offsets)[:, None]
+    mean = np.stack([_sum_segments(x, offsets), _sum_segments(y, offsets)], axis=-1)
+    mean = mean / npoints
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centroid = np.stack([cx, cy], axis=-1) / (6 * area[:, None])
+    centroid = np.where((area == 0)[:, None], mean, centroid)
+
+    return centroid + points[offsets[:-1]]
+
+
+def is_closed(points, offsets, threshold=0.1):
+    """Check whether the last point of each contour is close to the first point
+
+    Args:
+        points (np.ndarray): The (M, 2) longitude and latitude points from pack
+        offsets (np.ndarray): The offsets of the first point of each contour from pack
+        threshold (float): The maximum distance (km) between the first and last point
+            of a closed contour
+
+    Returns:
+        np.ndarray: Boolean array, True for each closed contour
+    """
+    return haversine(points[offsets[:-1]].T, points[offsets[1:] - 1].T) < threshold
+
+
+def _next_points(points, offsets):
+    # The next point along each contour, wrapping around to the first point of the
+    # contour after the last point
+    index = np.arange(1, len(points) + 1)
+    index[offsets[1:] - 1] = offsets[:-1]
+
+    return points[index]
+
+
+def _sum_segments(x, offsets):
+    # Sum a value for each point over each contour
+    if len(offsets) == 1:
+        return np.zeros(0)
+
+    return np.add.reduceat(x, offsets[:-1])
@@ -0,0 +1,143 @@
+"""
+Finite-difference derivatives calculated on the native grid points
+
+Unlike iris.analysis.calculus.differentiate, which calculates derivatives at the
+midpoints between levels, these return the derivative on the same levels as the input
+so the result does not need to be interpolated back to the original grid
+"""
+
+import numpy as np
+from iris.util import broadcast_to_shape
+
+
+def vertical_derivative(x, z, axis=0):
+    """Second-order finite-difference derivative of x with respect to z
+
+    Uses centred differences for non-uniformly spaced levels at interior points and
+    second-order one-sided differences at the first and last levels
+
+    Args:
+        x (np.ndarray): The field to differentiate
+        z (np.ndarray): The vertical coordinate. Either 1D, with one value for each
+            level, or with the same shape as x
+        axis (int): The vertical dimension of x
+
+    Returns:
+        np.ndarray: The derivative on the same levels as x
+    """
+    z = np.asarray(z, dtype=np.float64)
+    if z.ndim > 1:
+        z = np.moveaxis(z, axis, 0)
+
+    if len(z) == 2:
+        x = np.moveaxis(np.asarray(x), axis, 0)
+        result = (x[1] - x[0]) / (z[1] - z[0])
+        return np.moveaxis(np.stack([result, result]), 0, axis)
+
+    return apply_stencil(x, stencil(z), axis=axis)
+
+
+def stencil(points):
+    """Coefficients for second-order finite differences with respect to points
+
+    Args:
+        points (np.ndarray): The coordinate to differentiate with respect to, with the
+            dimension to differentiate along first. At least three points are needed
+
+    Returns:
+        np.ndarray: Coefficients with shape (3,) + points.shape. At interior points the
+            coefficients multiply x[k-1], x[k] and x[k+1]. At the first point they
+            multiply x[0], x[1] and x[2] and at the last point x[-3], x[-2] and x[-1]
+    """
+    z = np.asarray(points, dtype=np.float64)
+    dz = np.diff(z, axis=0)
+    coefficients = np.empty((3,) + z.shape)
+
+    # Centred differences for interior points
+    h1 = dz[:-1]
+    h2 = dz[1:]
+    coefficients[0, 1:-1] = -h2 / (h1 * (h1 + h2))
+    coefficients[1, 1:-1] = (h2 - h1) / (h1 * h2)
+    coefficients[2, 1:-1] = h1 / (h2 * (h1 + h2))
+
+    # One-sided differences for the first point
+    h1 = dz[0]
+    h2 = dz[1]
+    coefficients[0, 0] = -(2 * h1 + h2) / (h1 * (h1 + h2))
+    coefficients[1, 0] = (h1 + h2) / (h1 * h2)
+    coefficients[2, 0] = -h1 / (h2 * (h1 + h2))
+
+    # One-sided differences for the last point
+    h1 = dz[-2]
+    h2 = dz[-1]
+    coefficients[0, -1] = h2 / (h1 * (h1 + h2))
+    coefficients[1, -1] = -(h1 + h2) / (h1 * h2)
+    coefficients[2, -1] = (2 * h2 + h1) / (h2 * (h1 + h2))
+
+    return coefficients
+
+
+def apply_stencil(x, coefficients, axis=0):
+    """Calculate a derivative using the coefficients from stencil
+
+    Args:
+        x (np.ndarray): The field to differentiate
+        coefficients (np.ndarray): The output of stencil for either a 1D coordinate
+            along the axis, or a coordinate with the same shape as x (with the axis
+            moved to the first dimension)
+        axis (int): The dimension of x to differentiate along
+
+    Returns:
+        np.ndarray: The derivative at the same points as x
+    """
+    x = np.moveaxis(np.asarray(x), axis, 0)
+    if coefficients.ndim == 2:
+        coefficients = coefficients.reshape(coefficients.shape + (1,) * (x.ndim - 1))
+
+    # Coefficients are calculated at double precision and then converted to the
+    # precision of the data
+    if x.dtype.kind == "f":
+        dtype = x.dtype
+    else:
+        dtype = np.float64
+    c = coefficients.astype(dtype, copy=False)
+
+    result = np.empty(np.broadcast_shapes(x.shape, c.shape[1:]), dtype=dtype)
+
+    result[1:-1] = c[0, 1:-1] * x[:-2]
+    result[1:-1] += c[1, 1:-1] * x[1:-1]
+    result[1:-1] += c[2, 1:-1] * x[2:]
+
+    result[0] = c[0, 0] * x[0] + c[1, 0] * x[1] + c[2, 0] * x[2]
+    result[-1] = c[0, -1] * x[-3] + c[1, -1] * x[-2] + c[2, -1] * x[-1]
+
+    return np.moveaxis(result, 0, axis)
+
+
+def differentiate_vertical(cube, coord="altitude"):
+    """Vertical derivative of a cube on its native levels
+
+    Args:
+        cube (iris.cube.Cube):
+        coord (str | iris.coords.Coord): The vertical coordinate to differentiate
+            with respect to. Either a 1D coordinate or a multidimensional coordinate
+            (e.g. altitude over orography) spanning the vertical dimension of the cube
+
+    Returns:
+        iris.cube.Cube: The derivative with the same coordinates as the input cube
+    """
+    z = cube.coord(coord)
+    dims = cube.coord_dims(z)
+
+    if z.ndim == 1:
+        axis = dims[0]
+        z_points = z.points
+    else:
+        axis = cube.coord_dims(cube.coord(axis="z", dim_coords=True))[0]
+        z_points = broadcast_to_shape(z.points, cube.shape, dims)
+
+    result = cube.copy(data=vertical_derivative(cube.data, z_points, axis=axis))
+    result.rename("derivative_of_{}_wrt_{}".format(cube.name(), z.name()))
+    result.units = cube.units / z.units
+
+    return result
@@ -0,0 +1,300 @@
+"""
+Write diagnostics to a netCDF file one time at a time
+
+Each call to DiagnosticWriter.append writes the cubes for a single time to variables
+with an unlimited time dimension and flushes the file, so the output is kept up to date
+as a diagnostic runs. The time is written last, so a time is only marked as completed
+once all the cubes for that time have been written. Reopening an existing file
+continues from the last completed time.
+
+Variables are created the first time a cube with that name is appended, with one chunk
+for each time, so each append only writes new data and memory use does not grow with
+the number of times. Scalar coordinates (e.g. forecast_period) are written as
+timeseries. The coordinates of each variable are linked with its "coordinates" attribute
+as soon as they are written, so a file from a job that was killed can still be loaded
+and continued.
+
+>>> writer = DiagnosticWriter("output.nc")
+>>> for time in forecast._loader.files:
+...     if time in writer.completed_times():
+...         continue
+...     cubes = forecast.set_time(time)
+...     writer.append(calculate_diagnostics(cubes), time)
+>>> writer.close()
+
+or equivalently
+
+>>> write_diagnostics(forecast, "output.nc", calculate_diagnostics)
+"""
+
+import os
+
+import numpy as np
+import netCDF4
+import cftime
+from iris.exceptions import CoordinateNotFoundError
+
+from moisture_tracers import trim_halo
+
+time_units = "hours since 1970-01-01 00:00:00"
+calendar = "standard"
+
+
+class DiagnosticWriter(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+        if os.path.exists(filename):
+            self.dataset = netCDF4.Dataset(filename, "a")
+        else:
+            self.dataset = netCDF4.Dataset(filename, "w")
+            self.dataset.createDimension("time", None)
+            time = self.dataset.createVariable("time", "f8", ("time",))
+            time.standard_name = "time"
+            time.units = time_units
+            time.calendar = calendar
+
+        # Coordinates in the "coordinates" attribute of each variable
+        self._coordinates = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def completed_times(self):
+        """The times that have been fully written to the file
+
+        Returns:
+            list: datetime.datetime for each completed time
+        """
+        return _completed_times(self.dataset)
+
+    def append(self, cubes, time):
+        """Write the cubes as the values at the given time
+
+        If the time has already been written, the values are overwritten.
+
+        Args:
+            cubes (iris.cube.CubeList): The diagnostics at a single time. Each cube is
+                written to the variable with the same name
+            time (datetime.datetime):
+        """
+        time_var = self.dataset.variables["time"]
+        value = cftime.date2num(time, time_var.units, calendar=time_var.calendar)
+
+        points = np.ma.masked_invalid(np.ma.asarray(time_var[:]))
+        matches = np.flatnonzero(points == value)
+        if len(matches) > 0:
+            index = matches[0]
+        elif np.ma.is_masked(points):
+            # Overwrite a time that was started but not completed
+            index = np.flatnonzero(np.ma.getmaskarray(points))[0]
+        else:
+            index = len(points)
+
+        # Scalar coordinates are shared by all variables, so use the value from the
+        # first cube with each coordinate
+        scalar_coords_written = set()
+        for cube in cubes:
+            variable = self._get_variable(cube)
+            variable[index, ...] = cube.data
+
+            for coord in cube.coords(dimensions=()):
+                if _is_scalar_coord(coord):
+                    scalar_coord = self._get_scalar_coord(coord)
+                    if scalar_coord.name not in scalar_coords_written:
+                        scalar_coord[index] = coord.points[0]
+                        scalar_coords_written.add(scalar_coord.name)
+                    self._link_coordinates(variable, [scalar_coord.name])
+
+        time_var[index] = value
+        self.dataset.sync()
+
+    def close(self):
+        if self.dataset.isopen():
+            self.dataset.close()
+
+    def _get_variable(self, cube):
+        name = cube.name()
+        if name in self.dataset.variables:
+            variable = self.dataset.variables[name]
+            if name not in self._coordinates:
+                self._coordinates[name] = set(
+                    getattr(variable, "coordinates", "").split()
+                )
+            return variable
+
+        dims = ["time"] + [self._get_dimension(cube, n) for n in range(cube.ndim)]
+        variable = self.dataset.createVariable(
+            name, cube.dtype, dims, chunksizes=(1,) + cube.shape
+        )
+        _add_metadata(variable, cube)
+
+        # Link the auxiliary and scalar coordinates with the variable
+        self._coordinates[name] = set()
+        coordinates = set()
+        for coord in cube.coords(dim_coords=False):
+            dims = cube.coord_dims(coord)
+            if len(dims) == 0 and _is_scalar_coord(coord):
+                coordinates.add(self._get_scalar_coord(coord).name)
+            elif len(dims) == 1:
+                coordinates.add(
+                    self._get_aux_coord(coord, variable.dimensions[dims[0] + 1])
+                )
+        self._link_coordinates(variable, coordinates)
+
+        return variable
+
+    def _link_coordinates(self, variable, names):
+        # Add coordinates to the "coordinates" attribute of the variable. The attribute
+        # is written immediately so it is kept if the file is not closed
+        coordinates = self._coordinates[variable.name]
+        if not coordinates.issuperset(names):
+            coordinates.update(names)
+            variable.coordinates = " ".join(sorted(coordinates))
+
+    def _get_dimension(self, cube, n):
+        try:
+            coord = cube.coord(dimensions=n, dim_coords=True)
+            name = coord.name()
+        except CoordinateNotFoundError:
+            coord = None
+            name = "dim{}".format(n)
+
+        # Reuse an existing dimension with the same size and coordinate, otherwise
+        # create a new dimension with a numbered name
+        size = cube.shape[n]
+        for candidate in _candidate_names(name):
+            if candidate not in self.dataset.dimensions:
+                break
+            if len(self.dataset.dimensions[candidate]) == size:
+                if coord is None or _matches(self.dataset, candidate, coord):
+                    return candidate
+
+        self.dataset.createDimension(candidate, size)
+        if coord is not None:
+            variable = self.dataset.createVariable(candidate, coord.dtype, (candidate,))
+            variable[:] = coord.points
+            _add_metadata(variable, coord)
+
+        return candidate
+
+    def _get_aux_coord(self, coord, dimension):
+        # Reuse an existing coordinate with the same values on the same dimension,
+        # otherwise create a new variable with a numbered name
+        for candidate in _candidate_names(coord.name()):
+            if candidate not in self.dataset.variables:
+                break
+            variable = self.dataset.variables[candidate]
+            if variable.dimensions == (dimension,) and _matches(
+                self.dataset, candidate, coord
+            ):
+                return candidate
+
+        variable = self.dataset.createVariable(candidate, coord.dtype, (dimension,))
+        variable[:] = coord.points
+        _add_metadata(variable, coord)
+
+        return candidate
+
+    def _get_scalar_coord(self, coord):
+        # Scalar coordinates are stored as timeseries. Don't reuse a variable with the
+        # same name on a different dimension (e.g. altitude for a single level)
+        for candidate in _candidate_names(coord.name()):
+            if candidate not in self.dataset.variables:
+                break
+            variable = self.dataset.variables[candidate]
+            if variable.dimensions == ("time",):
+                return variable
+
+        variable = self.dataset.createVariable(candidate, coord.dtype, ("time",))
+        _add_metadata(variable, coord)
+
+        return variable
+
+
+def write_diagnostics(forecast, filename, calculate):
+    """Calculate diagnostics at each time in a forecast and append them to a file
+
+    Times already completed in the file are skipped. Levels loaded as a halo for
+    vertical derivatives are removed from the diagnostics before they are written
+
+    Args:
+        forecast (irise.forecast.Forecast):
+        filename (str):
+        calculate (callable): Function that takes the cubes at a single time and
+            returns an iris.cube.CubeList of diagnostics
+    """
+    with DiagnosticWriter(filename) as writer:
+        completed_times = writer.completed_times()
+
+        for time in forecast._loader.files:
+            if time in completed_times:
+                continue
+            cubes = forecast.set_time(time)
+            print(forecast.lead_time)
+
+            results = calculate(cubes)
+            trim_halo(results, forecast)
+            writer.append(results, time)
+
+
+def completed_times(filename):
+    """The times that have been fully written to a file, without modifying the file
+
+    Args:
+        filename (str): A file written with DiagnosticWriter
+
+    Returns:
+        list: datetime.datetime for each completed time
+    """
+    with netCDF4.Dataset(filename, "r") as dataset:
+        return _completed_times(dataset)
+
+
+def _completed_times(dataset):
+    time = dataset.variables["time"]
+    points = np.ma.masked_invalid(np.ma.asarray(time[:]))
+
+    return list(
+        cftime.num2date(
+            points.compressed(),
+            time.units,
+            calendar=time.calendar,
+            only_use_cftime_datetimes=False,
+            only_use_python_datetimes=True,
+        )
+    )
+
+
+def _candidate_names(name):
+    yield name
+    n = 1
+    while True:
+        yield "{}_{}".format(name, n)
+        n += 1
+
+
+def _matches(dataset, name, coord):
+    variable = dataset.variables.get(name)
+    if variable is None or variable.shape != coord.shape:
+        return False
+    return np.array_equal(np.ma.getdata(variable[:]), coord.points)
+
+
+def _add_metadata(variable, cube_or_coord):
+    if cube_or_coord.standard_name is not None:
+        variable.standard_name = cube_or_coord.standard_name
+    if cube_or_coord.long_name is not None:
+        variable.long_name = cube_or_coord.long_name
+    if not cube_or_coord.units.is_unknown():
+        variable.units = str(cube_or_coord.units)
+    if cube_or_coord.units.is_time_reference():
+        variable.calendar = cube_or_coord.units.calendar
+
+
+def _is_scalar_coord(coord):
+    # Scalar coordinates, other than time, that can be stored as a timeseries
+    return coord.name() != "time" and coord.dtype.kind in "iuf"
@@ -3,6 +3,8 @@ Create a netCDF with all variables averaged over a EUREC4A circle area
 
 Usage:
     domain_averages.py <path> <start_time> <resolution> <grid> [<output_path>]
+        [--z_min=<m>] [--z_max=<m>] [--precision=<str>]
+        [--moments=<n>] [--percentiles=<list>]
     domain_averages.py (-h | --help)
 
 Arguments:
@@ -15,68 +17,147 @@ Arguments:
 Options:
     -h --help
         Show this screen.
+    --z_min=<m>
+        Only use model levels from this altitude (m)
+    --z_max=<m>
+        Only use model levels up to this altitude (m)
+    --precision=<str>
+        Convert all fields to "single" or "double" precision when they are loaded.
+        By default the precision of the data in the files is kept
+    --moments=<n>
+        The number of moments to calculate: 2 for the mean and standard deviation,
+        3 to add the skewness and 4 to add the kurtosis [default: 2]
+    --percentiles=<list>
+        Comma-separated list of percentiles to calculate for each variable (e.g.
+        25,50,75). Percentiles are estimated from a quantile sketch rather than by
+        sorting each field. The sketch works with the difference, d, of each value from
+        a fixed reference value for the variable (see percentile_offsets, zero for
+        other variables). The estimate of a percentile is within 1% of |d| for the
+        value at that rank of the area-weighted distribution. Negative differences have
+        the same relative accuracy as positive ones, and |d| below 1e-12 is treated as
+        zero, so those percentiles are returned as the reference value
 """
 import datetime
 
 import iris
-from iris.analysis import MEAN, RMS
-from iris.analysis.cartography import area_weights
 
 from twinotter.util.scripting import parse_docopt_arguments
 
 from . import grey_zone_forecast
+from .diagnostic_writer import write_diagnostics
+from .grid_metrics import GridMetrics
+from .moments import horizontal_moments
+from .sketches import horizontal_percentiles
+
+# Fixed reference values subtracted from variables with a large mean relative to their
+# variability before estimating percentiles. The same values are used at every time, so
+# the sketches are comparable between times
+percentile_offsets = dict(
+    air_temperature=273.15,
+    air_potential_temperature=300.0,
+    equivalent_potential_temperature=330.0,
+    air_pressure=5e4,
+    surface_air_pressure=1e5,
+)
+
+
+def main(
+    path,
+    start_time,
+    resolution,
+    grid,
+    output_path="./",
+    z_min=None,
+    z_max=None,
+    precision=None,
+    moments=2,
+    percentiles=None,
+):
+    if percentiles is not None:
+        percentiles = [float(p) for p in percentiles.split(",")]
 
-
-def main(path, start_time, resolution, grid, output_path="./"):
     forecast = grey_zone_forecast(
         path,
         start_time=start_time,
         resolution=resolution,
         grid=grid,
+        z_min=z_min,
+        z_max=z_max,
+        precision=precision,
     )
 
-    results = generate(forecast)
-
-    iris.save(
-        results,
+    write(
+        forecast,
         "{}/domain_averages_{}_{}_{}.nc".format(
             output_path,
             forecast.start_time.strftime("%Y%m%d"),
             resolution,
             grid,
         ),
+        moments=int(moments),
+        percentiles=percentiles,
     )
 
 
-def generate(forecast):
-    results = iris.cube.CubeList()
+def write(forecast, filename, moments=2, percentiles=None):
+    """Calculate the domain averages at each lead time and append them to a file
+
+    Args:
+        forecast (irise.forecast.Forecast):
+        filename (str):
+        moments (int): See generate
+        percentiles (list, optional): See generate
+    """
+    write_diagnostics(
+        forecast,
+        filename,
+        lambda cubes: generate(
+            cubes, forecast.current_time, moments=moments, percentiles=percentiles
+        ),
+    )
+
 
-    for n, cubes in enumerate(forecast):
-        print(forecast.lead_time)
-        rad = cubes.extract(iris.Constraint(
-            time=lambda x: x.point.second != 0 and
-                           x.point.hour == (forecast.current_time - datetime.timedelta(hours=1)).hour)
-        )
-        cubes = cubes.extract(iris.Constraint(time=lambda x: x.point == forecast.current_time))
-
-        for cube in rad:
-            cubes.append(cube)
-
-        for cube in cubes:
-            # Don't try to collapse coordinate cubes
-            if cube.ndim in (2, 3):
-                lon = cube.coord(axis="x", dim_coords=True)
-                lat = cube.coord(axis="y", dim_coords=True)
-                weights = area_weights(cube)
-                mean = cube.collapsed([lon, lat], MEAN, weights=weights)
-
-                std_dev = (cube - mean).collapsed([lon, lat], RMS, weights=weights)
-                mean.rename(cube.name() + "_mean")
-                std_dev.rename(cube.name() + "_std_dev")
-                results.append(mean)
-                results.append(std_dev)
-
-    return results.merge()
+def generate(cubes, time, moments=2, percentiles=None):
+    """Area-weighted moments of every 2D and 3D field at a single time
+
+    Args:
+        cubes (iris.cube.CubeList):
+        time (datetime.datetime): The time to calculate the averages for. Radiation
+            diagnostics from the previous hour are also included
+        moments (int): 2 for the mean and standard deviation, 3 to add the skewness and
+            4 to add the kurtosis
+        percentiles (list, optional): Percentiles to estimate for each field
+
+    Returns:
+        iris.cube.CubeList:
+    """
+    rad = cubes.extract(iris.Constraint(
+        time=lambda x: x.point.second != 0 and
+                       x.point.hour == (time - datetime.timedelta(hours=1)).hour)
+    )
+    cubes = cubes.extract(iris.Constraint(time=lambda x: x.point == time))
+
+    for cube in rad:
+        cubes.append(cube)
+
+    results = iris.cube.CubeList()
+    for cube in cubes:
+        # Don't try to collapse coordinate cubes
+        if cube.ndim in (2, 3):
+            # The area weights are only calculated once for each grid
+            weights = GridMetrics.from_cube(cube).area
+            results.extend(horizontal_moments(cube, weights, moments=moments))
+            if percentiles is not None:
+                results.append(
+                    horizontal_percentiles(
+                        cube,
+                        percentiles,
+                        weights=weights,
+                        offset=percentile_offsets.get(cube.name(), 0.0),
+                    )
+                )
+
+    return results
 
 
 if __name__ == "__main__":
@@ -3,6 +3,7 @@ import iris
 from irise import grid
 
 from moisture_tracers import grey_zone_forecast, datadir, era5
+from moisture_tracers.derivatives import differentiate_vertical
 
 
 def main():
@@ -56,11 +57,7 @@ def calculate_vertical_velocity(era5_cubes):
     w.coord("pressure_level").convert_units("Pa")
 
     # Calulate vertical velocity from pressure vertical velocity
-    dz_dp = iris.analysis.calculus.differentiate(z, "pressure_level")
-    dz_dp = dz_dp.interpolate(
-        [("pressure_level", z.coord("pressure_level").points)],
-        iris.analysis.Linear()
-    )
+    dz_dp = differentiate_vertical(z, "pressure_level")
     dz_dt = dz_dp * w
 
     # Calculate depth-averaged vertical velocity to 3km
@@ -7,14 +7,13 @@ import warnings
 import iris
 from iris.cube import CubeList
 
-import pylagranto.trajectory
-
 from moisture_tracers import (
     datadir,
     regridded_filename,
     grey_zone_forecast,
     regrid_common,
     trajectory,
+    trajectory_store,
     regrid_trajectory,
     aggregation_terms,
     domain_averages,
@@ -70,17 +69,17 @@ def main():
 
             # 1. Calculate trajectories from full domain
             trajectory_filename = (
-                f"trajectory_{start_time}_{resolution}_{model_setup}_"
-                f"{x0}E_{y0}N_{z0}hPa_T+{t0}.pkl"
+                f"{datadir}trajectories/trajectory_{start_time}_{resolution}_{model_setup}_"
+                f"{x0}E_{y0}N_{z0}hPa_T+{t0}.nc"
             )
 
             traout = trajectory.calculate_trajectory(
                 forecast, x0, y0, z0, t0, trajectory_zcoord
             )
-            traout.save(datadir + "trajectories/" + trajectory_filename)
+            trajectory_store.save(traout, trajectory_filename)
 
             # 2. Regrid data following trajectory
-            traout = pylagranto.trajectory.load(datadir + "trajectories/" + trajectory_filename)
+            traout = trajectory_store.load(trajectory_filename)
             common_grid = iris.load_cube(target)
 
             for newcubes in regrid_trajectory.from_forecast(forecast, traout, grid=common_grid):
@@ -116,9 +115,8 @@ def main():
             )
 
             # 4. Domain Averages
-            results = domain_averages.generate(forecast_lagrangian)
-            iris.save(
-                results,
+            domain_averages.write(
+                forecast_lagrangian,
                 diags_path + f"domain_averages_"
                              f"{start_time}_"
                              f"{forecast_lagrangian.resolution}_"
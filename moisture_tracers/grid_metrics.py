@@ -0,0 +1,277 @@
+"""
+Geometry of the model grid, calculated once and reused for every lead time
+
+irise.calculus.polar_horizontal and iris.analysis.cartography.area_weights recalculate
+the grid spacing, cos(latitude) factors and areas every time they are called. A
+GridMetrics holds these for a single (rotated) latitude-longitude grid along with the
+finite-difference stencils, so derivatives and area or mass weighted means only need
+to apply them.
+
+>>> metrics = GridMetrics.from_cube(cube)
+>>> dq_dx = metrics.ddx(q.data)
+>>> mass = metrics.volume * density.data
+
+GridMetrics.from_cube returns the same object for every cube on the same grid, so the
+metrics are only calculated once per simulation.
+"""
+
+import numpy as np
+
+from moisture_tracers.derivatives import stencil, apply_stencil
+
+# Earth radius (m), matching the Met Office Unified Model
+a = 6371229.0
+
+# GridMetrics already calculated, identified by the grid coordinates
+_cache = dict()
+
+
+class GridMetrics(object):
+    """Grid spacing, areas, volumes and finite-difference stencils for a grid
+
+    Arrays follow the dimension order of the model output, (z, y, x), with horizontal
+    derivatives calculated over the last two dimensions.
+
+    Attributes:
+        lon (np.ndarray): Longitude of each column (radians)
+        lat (np.ndarray): Latitude of each row (radians)
+        dx (np.ndarray): Width of each gridbox (m), shape (ny, nx)
+        dy (np.ndarray): Length of each gridbox (m), shape (ny,)
+        area (np.ndarray): Area of each gridbox (m2), shape (ny, nx)
+        z (np.ndarray | None): Altitude of each level (m)
+        dz (np.ndarray | None): Thickness of each level (m)
+        volume (np.ndarray | None): Volume of each gridbox (m3), shape (nz, ny, nx).
+            None unless the grid has a 1D vertical coordinate
+    """
+
+    def __init__(self, lon, lat, lon_bounds, lat_bounds, z=None, z_bounds=None):
+        """
+        Args:
+            lon (np.ndarray): Longitude of each column (degrees)
+            lat (np.ndarray): Latitude of each row (degrees)
+            lon_bounds (np.ndarray): Longitude bounds of each column, shape (nx, 2)
+            lat_bounds (np.ndarray): Latitude bounds of each row, shape (ny, 2)
+            z (np.ndarray, optional): Altitude of each level (m). Needed for vertical
+                derivatives and volumes
+            z_bounds (np.ndarray, optional): Altitude bounds of each level, shape
+                (nz, 2). Guessed from z if not given
+        """
+        self.lon = np.deg2rad(np.asarray(lon, dtype=np.float64))
+        self.lat = np.deg2rad(np.asarray(lat, dtype=np.float64))
+        self.lon_bounds = np.deg2rad(np.asarray(lon_bounds, dtype=np.float64))
+        self.lat_bounds = np.deg2rad(np.asarray(lat_bounds, dtype=np.float64))
+
+        dlon = self.lon_bounds[:, 1] - self.lon_bounds[:, 0]
+        dlat = self.lat_bounds[:, 1] - self.lat_bounds[:, 0]
+        cos_lat = np.cos(self.lat)
+
+        self.dx = a * cos_lat[:, None] * dlon[None, :]
+        self.dy = a * dlat
+        self.area = (
+            a ** 2
+            * (np.sin(self.lat_bounds[:, 1]) - np.sin(self.lat_bounds[:, 0]))[:, None]
+            * dlon[None, :]
+        )
+
+        # Derivatives with respect to longitude/latitude (radians) and the factors to
+        # convert them to derivatives with respect to distance
+        self.x_stencil = stencil(self.lon)
+        self.y_stencil = stencil(self.lat)
+        self.x_scale = (1 / (a * cos_lat))[:, None]
+        self.y_scale = 1 / a
+
+        if z is None:
+            self.z = None
+            self.z_bounds = None
+            self.dz = None
+            self.volume = None
+            self.z_stencil = None
+        else:
+            self.z = np.asarray(z, dtype=np.float64)
+            if z_bounds is None:
+                z_bounds = _guess_bounds(self.z)
+            self.z_bounds = np.asarray(z_bounds, dtype=np.float64)
+            self.dz = self.z_bounds[:, 1] - self.z_bounds[:, 0]
+            self.volume = self.dz[:, None, None] * self.area[None, :, :]
+            self.z_stencil = stencil(self.z)
+
+        self._coarse = dict()
+
+    @classmethod
+    def from_cube(cls, cube, z="altitude"):
+        """The GridMetrics for the grid of a cube
+
+        Args:
+            cube (iris.cube.Cube): A cube with x and y dimension coordinates as the
+                last two dimensions
+            z (str): The name of the vertical coordinate. Only used if it is a 1D
+                coordinate
+
+        Returns:
+            GridMetrics: The same object is returned for all cubes on the same grid
+        """
+        lon = cube.coord(axis="x", dim_coords=True)
+        lat = cube.coord(axis="y", dim_coords=True)
+        z_coord = None
+        if cube.ndim == 3 and len(cube.coords(z)) > 0:
+            z_coord = cube.coord(z)
+            if z_coord.ndim != 1:
+                z_coord = None
+
+        key = (
+            lon.points.tobytes(),
+            lat.points.tobytes(),
+            None if z_coord is None else z_coord.points.tobytes(),
+        )
+        if key not in _cache:
+            if z_coord is None:
+                z_points, z_bounds = None, None
+            else:
+                z_points, z_bounds = z_coord.points, z_coord.bounds
+            _cache[key] = cls(
+                lon.points,
+                lat.points,
+                _bounds(lon),
+                _bounds(lat),
+                z=z_points,
+                z_bounds=z_bounds,
+            )
+
+        return _cache[key]
+
+    @property
+    def shape(self):
+        return len(self.lat), len(self.lon)
+
+    def ddx(self, x):
+        """Derivative of x along the last dimension (m-1)"""
+        return apply_stencil(x, self.x_stencil, axis=-1) * self.x_scale.astype(
+            _dtype(x)
+        )
+
+    def ddy(self, x):
+        """Derivative of x along the second last dimension (m-1)"""
+        return apply_stencil(x, self.y_stencil, axis=-2) * _dtype(x).type(self.y_scale)
+
+    def ddz(self, x):
+        """Derivative of x along the third last dimension (m-1)"""
+        if self.z_stencil is None:
+            raise ValueError("GridMetrics has no vertical coordinate")
+        return apply_stencil(x, self.z_stencil, axis=-3)
+
+    def gradient(self, x):
+        """Derivatives of x along each dimension
+
+        Returns:
+            tuple: d/dx, d/dy and d/dz
+        """
+        return self.ddx(x), self.ddy(x), self.ddz(x)
+
+    def divergence(self, u, v):
+        """Horizontal divergence of (u, v)"""
+        return self.ddx(u) + self.ddy(v)
+
+    def coarsen(self, coarse_factor):
+        """The GridMetrics for blocks of coarse_factor x coarse_factor gridpoints
+
+        Gridpoints at the end of the domain that do not fill a block are excluded, as
+        in regrid_common.generate_1km_grid
+
+        Args:
+            coarse_factor (int):
+
+        Returns:
+            GridMetrics:
+        """
+        if coarse_factor not in self._coarse:
+            lon = np.rad2deg(_coarsen_points(self.lon, coarse_factor))
+            lat = np.rad2deg(_coarsen_points(self.lat, coarse_factor))
+            lon_bounds = np.rad2deg(_coarsen_bounds(self.lon_bounds, coarse_factor))
+            lat_bounds = np.rad2deg(_coarsen_bounds(self.lat_bounds, coarse_factor))
+            self._coarse[coarse_factor] = GridMetrics(
+                lon, lat, lon_bounds, lat_bounds, z=self.z, z_bounds=self.z_bounds
+            )
+
+        return self._coarse[coarse_factor]
+
+    def block_weights(self, coarse_factor):
+        """Area weights normalised over each block of coarse_factor x coarse_factor
+        gridpoints
+
+        Returns:
+            np.ndarray: Shape (ny // coarse_factor, coarse_factor,
+                nx // coarse_factor, coarse_factor)
+        """
+        ny, nx = self.shape
+        ny, nx = ny // coarse_factor, nx // coarse_factor
+        weights = self.area[: ny * coarse_factor, : nx * coarse_factor].reshape(
+            ny, coarse_factor, nx, coarse_factor
+        )
+
+        return weights / weights.sum(axis=(1, 3), keepdims=True)
+
+
+def differentiate_horizontal(cube, axis, metrics=None):
+    """Horizontal derivative of a cube on its native grid
+
+    Args:
+        cube (iris.cube.Cube): A cube with y and x as the last two dimensions
+        axis (str): "x" or "y"
+        metrics (GridMetrics, optional): The metrics for the grid of the cube.
+            Calculated from the cube if not given
+
+    Returns:
+        iris.cube.Cube: The derivative with the same coordinates as the input cube
+    """
+    if metrics is None:
+        metrics = GridMetrics.from_cube(cube)
+
+    if axis == "x":
+        data = metrics.ddx(cube.data)
+    elif axis == "y":
+        data = metrics.ddy(cube.data)
+    else:
+        raise ValueError("Can only differentiate along x or y, not {}".format(axis))
+
+    result = cube.copy(data=data)
+    result.rename("derivative_of_{}_wrt_{}".format(cube.name(), axis))
+    result.units = cube.units / "m"
+
+    return result
+
+
+def _dtype(x):
+    if x.dtype.kind == "f":
+        return x.dtype
+    else:
+        return np.dtype(np.float64)
+
+
+def _bounds(coord):
+    if coord.has_bounds():
+        return coord.bounds
+    else:
+        coord = coord.copy()
+        coord.guess_bounds()
+        return coord.bounds
+
+
+def _guess_bounds(points):
+    # Midpoints between levels, extrapolated at the ends, as in
+    # iris.coords.Coord.guess_bounds
+    midpoints = 0.5 * (points[1:] + points[:-1])
+    lower = np.concatenate([[2 * points[0] - midpoints[0]], midpoints])
+    upper = np.concatenate([midpoints, [2 * points[-1] - midpoints[-1]]])
+
+    return np.stack([lower, upper], axis=-1)
+
+
+def _coarsen_points(points, coarse_factor):
+    n = len(points) // coarse_factor
+    return points[: n * coarse_factor].reshape(n, coarse_factor).mean(axis=1)
+
+
+def _coarsen_bounds(bounds, coarse_factor):
+    n = len(bounds) // coarse_factor
+    bounds = bounds[: n * coarse_factor].reshape(n, coarse_factor, 2)
+    return np.stack([bounds[:, 0, 0], bounds[:, -1, 1]], axis=-1)
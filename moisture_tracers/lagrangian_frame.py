@@ -0,0 +1,129 @@
+"""
+Transform winds to a frame of reference moving with a trajectory
+
+>>> frame = LagrangianFrame(trajectory_store.load(filename)[0])
+>>> for time in forecast._loader.files:
+...     cubes = frame.relative_winds(forecast.set_time(time), time)
+
+The velocity of the frame at each time is taken from the winds along the trajectory
+and the time of each index is stored in a dictionary, so looking up the frame velocity
+does not depend on the length of the trajectory. The shifted winds are new cubes with
+the frame velocity subtracted lazily, so the cubes loaded by the forecast are not
+modified and lazy data is not realised
+"""
+
+import datetime
+
+import cftime
+import numpy as np
+import iris.cube
+
+from irise import grid
+
+
+class LagrangianFrame(object):
+    """The frame of reference moving with a trajectory
+
+    Args:
+        tr (moisture_tracers.trajectory_store.Trajectory): A single trajectory
+        x_wind (str): The name of the trajectory variable with the x velocity of the
+            frame
+        y_wind (str): The name of the trajectory variable with the y velocity of the
+            frame
+    """
+
+    def __init__(self, tr, x_wind="x_wind", y_wind="y_wind"):
+        self.times = list(tr.times)
+        self._time_index = {time: n for n, time in enumerate(self.times)}
+        self.x_wind = np.asarray(tr[x_wind])
+        self.y_wind = np.asarray(tr[y_wind])
+
+    def time_index(self, time):
+        """Return the index of the time in the trajectory
+
+        Args:
+            time (datetime.datetime | cftime.datetime): cftime datetimes, as given by
+                time coordinates, are converted to datetime.datetime to match the
+                trajectory times
+
+        Returns:
+            int:
+
+        Raises:
+            ValueError: If the time is not one of the trajectory times
+        """
+        try:
+            return self._time_index[_as_datetime(time)]
+        except KeyError:
+            raise ValueError("{} is not a time of the trajectory".format(time))
+
+    def velocity(self, time):
+        """Return the (x, y) velocity of the frame at the time
+
+        Args:
+            time (datetime.datetime):
+
+        Returns:
+            tuple:
+        """
+        n = self.time_index(time)
+
+        return self.x_wind[n], self.y_wind[n]
+
+    def shift(self, cube, component, time=None):
+        """Subtract the frame velocity from a wind component
+
+        Args:
+            cube (iris.cube.Cube): Any field with the units of velocity (e.g. x_wind
+                or a wind interpolated to pressure levels)
+            component (str): "x" or "y"
+            time (datetime.datetime, optional): The time of the cube. Defaults to the
+                time coordinate of the cube
+
+        Returns:
+            iris.cube.Cube: A copy of the cube relative to the frame. The data are
+                lazy if the data of the original cube are lazy
+        """
+        if time is None:
+            time = grid.get_datetime(cube)[0]
+        velocity = self.velocity(time)[dict(x=0, y=1)[component]]
+
+        return cube.copy(data=cube.core_data() - np.asarray(velocity, cube.dtype))
+
+    def relative_winds(self, cubes, time=None, x_wind="x_wind", y_wind="y_wind"):
+        """Replace the winds in a cubelist with winds relative to the frame
+
+        Args:
+            cubes (iris.cube.CubeList):
+            time (datetime.datetime, optional): The time of the cubes. Defaults to the
+                time coordinate of the x_wind cube
+            x_wind (str): The name of the x_wind cube
+            y_wind (str): The name of the y_wind cube
+
+        Returns:
+            iris.cube.CubeList: A new cubelist with the shifted winds. The other cubes
+                are the same cubes as in the original cubelist
+        """
+        shifted = dict()
+        for name, component in [(x_wind, "x"), (y_wind, "y")]:
+            shifted[name] = self.shift(cubes.extract_cube(name), component, time)
+
+        return iris.cube.CubeList([shifted.get(cube.name(), cube) for cube in cubes])
+
+
+def _as_datetime(time):
+    # cftime datetimes don't match datetime.datetime keys for all calendars and
+    # versions of cftime, so convert them. Dates that don't exist in the standard
+    # calendar (e.g. 30th February) raise a ValueError
+    if isinstance(time, cftime.datetime):
+        return datetime.datetime(
+            time.year,
+            time.month,
+            time.day,
+            time.hour,
+            time.minute,
+            time.second,
+            time.microsecond,
+        )
+
+    return time
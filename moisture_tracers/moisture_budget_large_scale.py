@@ -1,13 +1,15 @@
+import datetime
 import warnings
 
 from tqdm import tqdm
 import iris
-from iris.analysis import AreaWeighted
 
 import irise
 
 from moisture_tracers import grey_zone_forecast, datadir
 from moisture_tracers import datadir
+from moisture_tracers.diagnostic_writer import DiagnosticWriter
+from moisture_tracers.grid_metrics import GridMetrics
 
 
 def main():
@@ -30,25 +32,30 @@ def main():
                 grid="{}_large_scale".format(grid),
             )
 
-            results = iris.cube.CubeList()
+            fname = "moisture_budget_large_scale_{}_{}_{}.nc".format(
+                start_time, resolution, grid
+            )
+            writer = DiagnosticWriter(datadir + "diagnostics_vn12/" + fname)
+            completed_times = writer.completed_times()
 
             if start_time == "20200202":
                 lead_times = range(1, 24 + 1)
             else:
                 lead_times = range(24, 48 + 1)
             for lead_time in tqdm(lead_times):
+                time = fcst.start_time + datetime.timedelta(hours=lead_time)
+                if time in completed_times:
+                    continue
+
                 cubes = fcst.set_lead_time(hours=lead_time)
                 cubes = cubes.extract(
                     iris.Constraint(time=lambda x: x.point == fcst.current_time)
                 )
 
                 f, d = get_fluxes(cubes)
-                results.append(f)
-                results.append(d)
-            fname = "moisture_budget_large_scale_{}_{}_{}.nc".format(
-                start_time, resolution, grid
-            )
-            iris.save(results.merge(), datadir + "diagnostics_vn12/" + fname)
+                writer.append(iris.cube.CubeList([f, d]), fcst.current_time)
+
+            writer.close()
 
 
 def get_fluxes(cubes):
@@ -58,27 +65,27 @@ def get_fluxes(cubes):
     v = cubes.extract_cube("y_wind")
 
     moisture = rho * q
-    dm_dx = irise.calculus.polar_horizontal(moisture, "x")
-    dm_dy = irise.calculus.polar_horizontal(moisture, "y")
+    moisture_c = moisture[:, 1, 1]
 
-    dm_dx_c = dm_dx.regrid(u[:, 1, 1], AreaWeighted())
-    dm_dy_c = dm_dy.regrid(v[:, 1, 1], AreaWeighted())
+    # Derivatives at the central column
+    metrics = GridMetrics.from_cube(moisture)
+    dm_dx_c = metrics.ddx(moisture.data)[:, 1, 1]
+    dm_dy_c = metrics.ddy(moisture.data)[:, 1, 1]
 
-    flx = -(dm_dx_c * u[:, 1, 1].data + dm_dy_c * v[:, 1, 1].data)
+    flx = moisture_c.copy(
+        data=-(dm_dx_c * u[:, 1, 1].data + dm_dy_c * v[:, 1, 1].data)
+    )
 
     dz = irise.grid.thickness(flx)
     flx_z = (flx * dz).collapsed("altitude", iris.analysis.SUM)
     flx_z.units = "kg m-3 s-1"
     flx_z.rename("moisture_advection")
 
-    du_dx = irise.calculus.polar_horizontal(u, "x")
-    dv_dy = irise.calculus.polar_horizontal(v, "y")
-
-    du_dx_c = du_dx.regrid(moisture[:, 1, 1], AreaWeighted())
-    dv_dy_c = dv_dy.regrid(moisture[:, 1, 1], AreaWeighted())
+    du_dx_c = GridMetrics.from_cube(u).ddx(u.data)[:, 1, 1]
+    dv_dy_c = GridMetrics.from_cube(v).ddy(v.data)[:, 1, 1]
 
     div = du_dx_c + dv_dy_c
-    div_m = -(div * moisture[:, 1, 1].data)
+    div_m = moisture_c.copy(data=-(div * moisture_c.data))
 
     dz = irise.grid.thickness(div_m)
     div_m_z = (div_m * dz).collapsed("altitude", iris.analysis.SUM)
@@ -0,0 +1,138 @@
+"""
+Weighted moments over the horizontal dimensions calculated in a single pass
+
+The data are read once, one horizontal slice at a time. For each slice the weighted
+sums of powers of (x - K) are accumulated at double precision, where the shift K is
+the first value in the slice. Shifting by a value close to the mean avoids the loss of
+precision when subtracting sums of squares for fields with a large mean relative to
+their variability (e.g. temperature or pressure). The central moments are then
+calculated from these sums without creating anomaly fields.
+"""
+
+import numpy as np
+import iris.cube
+from iris.coords import CellMethod
+
+# Names of the statistics calculated for each number of moments
+statistics = ["mean", "std_dev", "skewness", "kurtosis"]
+
+
+def weighted_moments(data, weights, moments=2):
+    """Calculate weighted moments over the last two dimensions of data
+
+    Args:
+        data (np.ndarray): Array with shape (..., ny, nx). Masked points are excluded
+        weights (np.ndarray): Weights with shape (ny, nx)
+        moments (int): The number of moments to calculate (1 to 4)
+
+    Returns:
+        dict: Arrays with shape data.shape[:-2] for the mean and, depending on the
+            number of moments, std_dev, skewness and kurtosis. The kurtosis is the
+            fourth standardised moment, which is 3 for a normal distribution
+    """
+    if not 1 <= moments <= 4:
+        raise ValueError("Can only calculate 1 to 4 moments, not {}".format(moments))
+
+    weights = np.asarray(weights, dtype=np.float64)
+    shape = data.shape[:-2]
+    data = data.reshape((-1,) + data.shape[-2:])
+
+    # Weighted sums of powers of (x - K) for each slice
+    sums = np.zeros((moments + 1, len(data)))
+    shift = np.zeros(len(data))
+    for n, x in enumerate(data):
+        if np.ma.is_masked(x):
+            w = np.where(np.ma.getmaskarray(x), 0.0, weights)
+            x = np.ma.getdata(x)
+            if w.any():
+                shift[n] = x[w > 0].flat[0]
+        else:
+            w = weights
+            x = np.ma.getdata(x)
+            shift[n] = x.flat[0]
+
+        dx = x.astype(np.float64) - shift[n]
+        wdx = w
+        sums[0, n] = w.sum()
+        for m in range(1, moments + 1):
+            wdx = wdx * dx
+            sums[m, n] = wdx.sum()
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        raw = sums[1:] / sums[0]
+    mean = raw[0]
+
+    result = dict(mean=(mean + shift).reshape(shape))
+    if moments >= 2:
+        var = np.maximum(raw[1] - mean ** 2, 0)
+        result["std_dev"] = np.sqrt(var).reshape(shape)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if moments >= 3:
+            m3 = raw[2] - 3 * mean * raw[1] + 2 * mean ** 3
+            result["skewness"] = (m3 / var ** 1.5).reshape(shape)
+        if moments >= 4:
+            m4 = raw[3] - 4 * mean * raw[2] + 6 * mean ** 2 * raw[1] - 3 * mean ** 4
+            result["kurtosis"] = (m4 / var ** 2).reshape(shape)
+
+    return result
+
+
+def horizontal_moments(cube, weights, moments=2, indices=None):
+    """Calculate weighted moments of a cube over its horizontal dimensions
+
+    Args:
+        cube (iris.cube.Cube): A cube with x and y as the last two dimensions
+        weights (np.ndarray): Weights with shape (ny, nx), or the weight of each
+            gridpoint in indices
+        moments (int): The number of moments to calculate (1 to 4)
+        indices (np.ndarray, optional): Indices of gridpoints in the flattened
+            (ny, nx) horizontal grid. If given, only the rows and columns spanned by
+            these gridpoints are read from the data, so the moments over a small
+            region of a large domain only cost as much as the size of the region
+
+    Returns:
+        iris.cube.CubeList: A cube for each statistic named <name>_<statistic> (e.g.
+            air_temperature_mean), with the collapsed horizontal coordinates as
+            scalar coordinates as in iris.cube.Cube.collapsed
+    """
+    lon = cube.coord(axis="x", dim_coords=True)
+    lat = cube.coord(axis="y", dim_coords=True)
+
+    if indices is None:
+        data = cube.data
+    else:
+        # Slice the box around the gridpoints before reading the data, so lazy data
+        # is only read for the region
+        j, i = np.unravel_index(indices, cube.shape[-2:])
+        box = (Ellipsis, slice(j.min(), j.max() + 1), slice(i.min(), i.max() + 1))
+        data = cube[box].data
+        indices = (j - j.min()) * data.shape[-1] + (i - i.min())
+
+        data = data.reshape(data.shape[:-2] + (-1,))[..., None, indices]
+        weights = np.asarray(weights)[None, :]
+
+    results = weighted_moments(data, weights, moments=moments)
+
+    # Keep the precision of floating point data
+    if cube.dtype.kind == "f":
+        dtype = cube.dtype
+    else:
+        dtype = np.float64
+
+    template = cube[..., 0, 0]
+    template.replace_coord(lon.collapsed())
+    template.replace_coord(lat.collapsed())
+
+    cubes = iris.cube.CubeList()
+    for statistic in statistics[:moments]:
+        result = template.copy(data=results[statistic].astype(dtype))
+        result.rename("{}_{}".format(cube.name(), statistic))
+        if statistic in ["skewness", "kurtosis"]:
+            result.units = "1"
+        method = dict(mean="mean", std_dev="standard_deviation").get(
+            statistic, statistic
+        )
+        result.add_cell_method(CellMethod(method, coords=[lon.name(), lat.name()]))
+        cubes.append(result)
+
+    return cubes
@@ -8,9 +8,7 @@ import iris.plot as iplt
 import matplotlib.pyplot as plt
 import cmcrameri
 
-from pylagranto import trajectory
-
-from moisture_tracers import datadir, plotdir, grey_zone_forecast
+from moisture_tracers import datadir, plotdir, grey_zone_forecast, trajectory_store
 from moisture_tracers.plot.figures import add_halo_circle
 
 
@@ -28,7 +26,9 @@ variable = "total_column_water"
 def main():
     plt.figure(figsize=(8, 6))
 
-    tr = trajectory.load(datadir + "trajectories/trajectories_20200201_km1p1_500m.pkl")
+    tr = trajectory_store.load(
+        datadir + "trajectories/trajectories_20200201_km1p1_500m.nc"
+    )[0]
 
     for lead_time in lead_times:
         cubes = forecast.set_lead_time(hours=lead_time)
@@ -40,7 +40,7 @@ def main():
 
         # For some reason the x coordinate ends up offset by 180
         plt.plot(
-            tr[0].x[48 - lead_time] - 180, tr[0].y[48 - lead_time], "kx", alpha=0.75
+            tr.x[48 - lead_time] - 180, tr.y[48 - lead_time], "kx", alpha=0.75
         )
 
         x = cube.coord("grid_longitude").points
@@ -63,7 +63,7 @@ def main():
     cbar = plt.colorbar(orientation="horizontal", extend="both")
     cbar.set_label("Total column water (kg m$^{-2}$)")
 
-    plt.plot(tr[0].x - 180, tr[0].y, "--k", alpha=0.75)
+    plt.plot(tr.x - 180, tr.y, "--k", alpha=0.75)
 
     ax = plt.gca()
     gl = ax.gridlines()
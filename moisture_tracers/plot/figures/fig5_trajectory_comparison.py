@@ -3,9 +3,7 @@ import cartopy.crs as ccrs
 
 import irise
 from irise.diagnostics.contours import haversine
-from pylagranto import trajectory
-
-from moisture_tracers import datadir, plotdir, grey_zone_forecast
+from moisture_tracers import datadir, plotdir, grey_zone_forecast, trajectory_store
 from moisture_tracers.plot.figures import linestyles, date_format, add_halo_circle
 
 from matplotlib.lines import Line2D
@@ -34,16 +32,16 @@ def main():
         plt.subplot2grid((2, 1), (1, 0)),
     ]
 
-    tr0 = trajectory.load(
-        datadir + "trajectories/trajectories_20200201_km1p1_500m.pkl"
+    tr0 = trajectory_store.load(
+        datadir + "trajectories/trajectories_20200201_km1p1_500m.nc"
     )[0]
     times = tr0.times[:24]
 
     for n, (start_time, grid) in enumerate(simulations):
         for m, resolution in enumerate(resolutions):
-            tr = trajectory.load(
+            tr = trajectory_store.load(
                 datadir
-                + "trajectories/trajectories_{}_{}_500m{}.pkl".format(
+                + "trajectories/trajectories_{}_{}_500m{}.nc".format(
                     start_time, resolution, grid
                 )
             )[0]
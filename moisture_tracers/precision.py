@@ -0,0 +1,163 @@
+"""
+Compare diagnostics calculated at single and double precision
+
+The precision used to calculate diagnostics is set when loading the forecast with
+grey_zone_forecast(precision="single") or the --precision option of the diagnostic
+scripts. Single precision keeps the float32 model output as float32 throughout, with
+sums over the domain accumulated at double precision.
+
+Usage:
+    precision.py <single_precision_file> <double_precision_file> [--rtol=<x>]
+    precision.py (-h | --help)
+
+Arguments:
+    <single_precision_file>
+    <double_precision_file>
+        The same diagnostic calculated with --precision=single and
+        --precision=double
+
+Options:
+    -h --help
+        Show this screen.
+    --rtol=<x>
+        The maximum difference, relative to the largest absolute value of each
+        variable, that is accepted [default: 1e-4]
+"""
+
+import numpy as np
+import iris
+
+from twinotter.util.scripting import parse_docopt_arguments
+
+
+precisions = dict(single=np.float32, double=np.float64)
+
+
+def main(single_precision_file, double_precision_file, rtol=1e-4):
+    cubes_single = iris.load(single_precision_file)
+    cubes_double = iris.load(double_precision_file)
+
+    differences = compare(cubes_single, cubes_double)
+
+    rtol = float(rtol)
+    failed = False
+    for name, difference in sorted(differences.items()):
+        if difference > rtol:
+            failed = True
+            flag = "FAIL"
+        else:
+            flag = ""
+        print("{:80s} {:.2e} {}".format(name, difference, flag))
+
+    if failed:
+        raise SystemExit("Single precision results differ by more than {}".format(rtol))
+
+
+def set_precision(cubes, precision):
+    """Convert all floating point cubes to the given precision
+
+    Lazy data is converted lazily so the data is still only read when it is needed
+
+    Args:
+        cubes (iris.cube.CubeList):
+        precision (str): single or double
+    """
+    dtype = precisions[precision]
+    for cube in cubes:
+        if cube.dtype.kind == "f" and cube.dtype != dtype:
+            cube.data = cube.core_data().astype(dtype)
+
+
+def compare(cubes_single, cubes_double):
+    """Find the maximum difference between each variable calculated at single and
+    double precision, relative to the maximum absolute value of the double precision
+    variable
+
+    Cubes are matched by name and coordinates, so files with several cubes of the same
+    name (e.g. on different grids) can be compared
+
+    Args:
+        cubes_single (iris.cube.CubeList):
+        cubes_double (iris.cube.CubeList):
+
+    Returns:
+        dict: The maximum relative difference for each variable. Keyed by the variable
+            name, with the scalar coordinates added for names shared by several cubes
+
+    Raises:
+        ValueError: If a cube in cubes_double does not have exactly one matching cube
+            in cubes_single
+    """
+    names = [cube.name() for cube in cubes_double]
+
+    differences = dict()
+    for cube_double in cubes_double:
+        matches = [
+            cube
+            for cube in cubes_single
+            if cube.name() == cube_double.name() and _same_coords(cube, cube_double)
+        ]
+        if len(matches) != 1:
+            raise ValueError(
+                "Found {} single precision cubes matching {}".format(
+                    len(matches), _describe(cube_double)
+                )
+            )
+        cube_single = matches[0]
+
+        if names.count(cube_double.name()) > 1:
+            key = _describe(cube_double)
+        else:
+            key = cube_double.name()
+
+        x = cube_double.data.astype(np.float64)
+        diff = np.abs(cube_single.data.astype(np.float64) - x).max()
+        scale = np.abs(x).max()
+
+        if scale > 0:
+            differences[key] = diff / scale
+        else:
+            differences[key] = diff
+
+    return differences
+
+
+def _same_coords(cube1, cube2):
+    # The same coordinates on the same dimensions. Points are compared with a
+    # tolerance because coordinates calculated at single precision are not exact
+    if cube1.shape != cube2.shape:
+        return False
+
+    coords1 = sorted(cube1.coords(), key=lambda coord: coord.name())
+    coords2 = sorted(cube2.coords(), key=lambda coord: coord.name())
+    if [coord.name() for coord in coords1] != [coord.name() for coord in coords2]:
+        return False
+
+    for coord1, coord2 in zip(coords1, coords2):
+        if cube1.coord_dims(coord1) != cube2.coord_dims(coord2):
+            return False
+        if coord1.shape != coord2.shape or coord1.units != coord2.units:
+            return False
+        if coord1.dtype.kind in "iuf" and coord2.dtype.kind in "iuf":
+            if not np.allclose(coord1.points, coord2.points, rtol=1e-6, atol=0):
+                return False
+        elif not np.array_equal(coord1.points, coord2.points):
+            return False
+
+    return True
+
+
+def _describe(cube):
+    # The name of the cube and the values of its scalar coordinates
+    scalar_coords = [
+        "{}={}".format(coord.name(), coord.points[0])
+        for coord in cube.coords(dimensions=())
+    ]
+    if scalar_coords:
+        return "{} ({})".format(cube.name(), ", ".join(scalar_coords))
+    else:
+        return cube.name()
+
+
+if __name__ == "__main__":
+    parse_docopt_arguments(main, __doc__)
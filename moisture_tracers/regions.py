@@ -0,0 +1,424 @@
+"""
+Create a netCDF with all variables averaged over many regions at once
+
+The gridpoints in each region are found once and stored as a sparse
+(region x gridpoint) weight matrix, so the mean and standard deviation in every region
+are calculated with a single sparse matrix product for each field. Adding regions only
+adds rows to the matrix.
+
+Usage:
+    regions.py <path> <start_time> <resolution> <grid> [<region>...]
+        [--output_path=<path>] [--subsamples=<n>] [--z_min=<m>] [--z_max=<m>]
+    regions.py (-h | --help)
+
+Arguments:
+    <path>
+    <start_time>
+    <resolution>
+    <grid>
+    <region>
+        Regions to average over. Either "eurec4a" for the EUREC4A circle,
+        "eurec4a_quadrants" for the four quadrants of the EUREC4A circle, or a
+        region defined as
+            circle:<name>:<lon>,<lat>,<radius>
+            box:<name>:<lon0>,<lon1>,<lat0>,<lat1>
+            polygon:<name>:<lon>,<lat>,<lon>,<lat>,...
+        with all values in degrees. Defaults to eurec4a and eurec4a_quadrants
+
+Options:
+    -h --help
+        Show this screen.
+    --output_path=<path>
+        Where to save the output [default: ./]
+    --subsamples=<n>
+        Weight each gridpoint by the fraction of an n x n grid of points within the
+        gridbox that are inside the region. The default only checks whether the
+        centre of each gridbox is inside the region [default: 1]
+    --z_min=<m>
+        Only use model levels from this altitude (m)
+    --z_max=<m>
+        Only use model levels up to this altitude (m)
+"""
+
+import numpy as np
+import scipy.sparse
+import iris
+from iris.coords import AuxCoord
+from matplotlib.path import Path
+
+from twinotter.external import eurec4a
+from twinotter.util.scripting import parse_docopt_arguments
+
+from . import grey_zone_forecast
+from .diagnostic_writer import write_diagnostics
+
+
+def main(
+    path,
+    start_time,
+    resolution,
+    grid,
+    region=None,
+    output_path="./",
+    subsamples=1,
+    z_min=None,
+    z_max=None,
+):
+    if region is None or len(region) == 0:
+        region = ["eurec4a", "eurec4a_quadrants"]
+    regions = RegionSet(parse_regions(region))
+
+    forecast = grey_zone_forecast(
+        path,
+        start_time=start_time,
+        resolution=resolution,
+        grid=grid,
+        z_min=z_min,
+        z_max=z_max,
+    )
+
+    # The gridpoints in each region are the same for all 2D and 3D fields
+    first_time = next(iter(forecast._loader.files))
+    example_cube = forecast.set_time(first_time).extract_cube("air_pressure")
+    weights = regions.weights(example_cube, subsamples=int(subsamples))
+
+    write_diagnostics(
+        forecast,
+        "{}/region_averages_{}_{}_{}.nc".format(
+            output_path,
+            forecast.start_time.strftime("%Y%m%d"),
+            resolution,
+            grid,
+        ),
+        lambda cubes: generate(cubes, regions, weights),
+    )
+
+
+def generate(cubes, regions, weights):
+    """Mean and standard deviation of every 2D and 3D field in each region
+
+    Args:
+        cubes (iris.cube.CubeList): The fields at a single time
+        regions (RegionSet):
+        weights (tuple): The output of RegionSet.weights
+
+    Returns:
+        iris.cube.CubeList:
+    """
+    results = iris.cube.CubeList()
+    for cube in cubes:
+        # Don't try to collapse coordinate cubes
+        if cube.ndim in (2, 3):
+            results.extend(regions.average(cube, weights))
+
+    return results
+
+
+class Region(object):
+    """A region defined in longitude/latitude (degrees)"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def extent(self):
+        """The bounding box of the region
+
+        Returns:
+            tuple: lon0, lon1, lat0, lat1
+        """
+        raise NotImplementedError
+
+    def contains(self, lon, lat):
+        """Check which points are inside the region
+
+        Args:
+            lon (np.ndarray):
+            lat (np.ndarray): Same shape as lon
+
+        Returns:
+            np.ndarray: Boolean array with the same shape as lon
+        """
+        raise NotImplementedError
+
+    def points(self, glon, glat, subsamples=1):
+        """Find the gridpoints inside the region
+
+        Args:
+            glon (np.ndarray): Longitude of each column
+            glat (np.ndarray): Latitude of each row
+            subsamples (int): Weight each gridpoint by the fraction of a subsamples x
+                subsamples grid of points within the gridbox that are inside the
+                region. With subsamples=1 each gridpoint has a weight of 1 if its
+                centre is inside the region
+
+        Returns:
+            tuple: The indices of the gridpoints inside the region, in the flattened
+                horizontal grid, and the weight of each gridpoint
+        """
+        lon0, lon1, lat0, lat1 = self.extent()
+
+        # Only check gridpoints that can overlap the region
+        dlon = np.abs(np.gradient(glon))
+        dlat = np.abs(np.gradient(glat))
+        cols = np.flatnonzero((glon + dlon > lon0) & (glon - dlon < lon1))
+        rows = np.flatnonzero((glat + dlat > lat0) & (glat - dlat < lat1))
+
+        offsets = (np.arange(subsamples) + 0.5) / subsamples - 0.5
+        xs = glon[cols, None] + offsets * dlon[cols, None]
+        ys = glat[rows, None] + offsets * dlat[rows, None]
+
+        shape = (len(rows), subsamples, len(cols), subsamples)
+        inside = self.contains(
+            np.broadcast_to(xs[None, None, :, :], shape),
+            np.broadcast_to(ys[:, :, None, None], shape),
+        )
+        fraction = inside.mean(axis=(1, 3))
+
+        row_index, col_index = np.nonzero(fraction)
+        indices = rows[row_index] * len(glon) + cols[col_index]
+
+        return indices, fraction[row_index, col_index]
+
+
+class Circle(Region):
+    def __init__(self, name, lon, lat, r):
+        super().__init__(name)
+        self.lon = lon
+        self.lat = lat
+        self.r = r
+
+    def extent(self):
+        return (
+            self.lon - self.r,
+            self.lon + self.r,
+            self.lat - self.r,
+            self.lat + self.r,
+        )
+
+    def contains(self, lon, lat):
+        return np.sqrt((lon - self.lon) ** 2 + (lat - self.lat) ** 2) < self.r
+
+
+class Box(Region):
+    def __init__(self, name, lon0, lon1, lat0, lat1):
+        super().__init__(name)
+        self.lon0 = lon0
+        self.lon1 = lon1
+        self.lat0 = lat0
+        self.lat1 = lat1
+
+    def extent(self):
+        return self.lon0, self.lon1, self.lat0, self.lat1
+
+    def contains(self, lon, lat):
+        return (
+            (self.lon0 <= lon)
+            & (lon < self.lon1)
+            & (self.lat0 <= lat)
+            & (lat < self.lat1)
+        )
+
+
+class Polygon(Region):
+    def __init__(self, name, vertices):
+        """
+        Args:
+            name (str):
+            vertices (np.ndarray): (lon, lat) of each vertex, shape (n, 2)
+        """
+        super().__init__(name)
+        self.vertices = np.asarray(vertices)
+        self.path = Path(self.vertices)
+
+    def extent(self):
+        lon0, lat0 = self.vertices.min(axis=0)
+        lon1, lat1 = self.vertices.max(axis=0)
+        return lon0, lon1, lat0, lat1
+
+    def contains(self, lon, lat):
+        points = np.stack([lon.ravel(), lat.ravel()], axis=-1)
+        return self.path.contains_points(points).reshape(lon.shape)
+
+
+class RegionSet(object):
+    def __init__(self, regions):
+        """
+        Args:
+            regions (list): The Region objects to average over
+        """
+        self.regions = list(regions)
+
+    def weights(self, cube, subsamples=1):
+        """Calculate the sparse (region x gridpoint) weights for the grid of cube
+
+        Args:
+            cube (iris.cube.Cube): A cube with grid_longitude and grid_latitude as the
+                last two dimensions
+            subsamples (int): See Region.points
+
+        Returns:
+            tuple: The indices, in the flattened horizontal grid, of the gridpoints in
+                any region and a scipy.sparse.csr_matrix of the weight of each of
+                those gridpoints in each region
+        """
+        glon = cube.coord("grid_longitude").points
+        glon = (glon + 180) % 360 - 180
+        glat = cube.coord("grid_latitude").points
+
+        rows, cols, values = [], [], []
+        for n, region in enumerate(self.regions):
+            indices, weights = region.points(glon, glat, subsamples=subsamples)
+            rows.append(np.full(len(indices), n))
+            cols.append(indices)
+            values.append(weights)
+
+        # Only keep columns for gridpoints in at least one region
+        indices, cols = np.unique(np.concatenate(cols), return_inverse=True)
+        matrix = scipy.sparse.csr_matrix(
+            (np.concatenate(values), (np.concatenate(rows), cols)),
+            shape=(len(self.regions), len(indices)),
+        )
+
+        return indices, matrix
+
+    def average(self, cube, weights):
+        """Calculate the mean and standard deviation of a cube in each region
+
+        Args:
+            cube (iris.cube.Cube): A cube with x and y as the last two dimensions
+            weights (tuple): The output of RegionSet.weights
+
+        Returns:
+            iris.cube.CubeList: <name>_mean and <name>_std_dev, each with a leading
+                region dimension
+        """
+        indices, matrix = weights
+
+        data = cube.data
+        shape = data.shape[:-2]
+        x = data.reshape((-1, data.shape[-2] * data.shape[-1]))[:, indices]
+
+        # Masked points are excluded by giving them zero weight
+        valid = ~np.ma.getmaskarray(x)
+        x = np.ma.getdata(x).astype(np.float64)
+
+        # Sum the weights, (x - K) and (x - K)^2, where K is the first valid value on
+        # each level, with a single sparse matrix product
+        first = np.argmax(valid, axis=1)
+        shift = x[np.arange(len(x)), first]
+        dx = np.where(valid, x - shift[:, None], 0.0)
+
+        nlev = len(x)
+        sums = matrix @ np.concatenate([valid, dx, dx ** 2]).transpose()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = sums[:, nlev : 2 * nlev] / sums[:, :nlev]
+            var = np.maximum(sums[:, 2 * nlev :] / sums[:, :nlev] - mean ** 2, 0)
+        mean = mean + shift
+
+        # Keep the precision of floating point data
+        if cube.dtype.kind == "f":
+            dtype = cube.dtype
+        else:
+            dtype = np.float64
+
+        template = cube[..., 0, 0]
+        template.remove_coord(cube.coord(axis="x", dim_coords=True).name())
+        template.remove_coord(cube.coord(axis="y", dim_coords=True).name())
+
+        results = iris.cube.CubeList()
+        for statistic, values in [("mean", mean), ("std_dev", np.sqrt(var))]:
+            by_region = iris.cube.CubeList()
+            for n, region in enumerate(self.regions):
+                result = template.copy(data=values[n].reshape(shape).astype(dtype))
+                result.rename("{}_{}".format(cube.name(), statistic))
+                result.add_aux_coord(AuxCoord(n, long_name="region_number"))
+                result.add_aux_coord(AuxCoord(region.name, long_name="region"))
+                by_region.append(result)
+            results.append(by_region.merge_cube())
+
+        return results
+
+
+def parse_regions(specifications):
+    """Create the regions from the command line arguments
+
+    Args:
+        specifications (list): Strings defining each region. See module docstring
+
+    Returns:
+        list: Region objects
+    """
+    regions = []
+    for specification in specifications:
+        if specification == "eurec4a":
+            regions.append(Circle("eurec4a", eurec4a.lon, eurec4a.lat, eurec4a.r))
+        elif specification == "eurec4a_quadrants":
+            regions.extend(
+                circle_quadrants("eurec4a", eurec4a.lon, eurec4a.lat, eurec4a.r)
+            )
+        else:
+            kind, name, values = specification.split(":")
+            values = [float(x) for x in values.split(",")]
+            if kind == "circle":
+                regions.append(Circle(name, *values))
+            elif kind == "box":
+                regions.append(Box(name, *values))
+            elif kind == "polygon":
+                regions.append(Polygon(name, np.reshape(values, (-1, 2))))
+            else:
+                raise ValueError("Unknown region type {}".format(kind))
+
+    return regions
+
+
+def circle_quadrants(name, lon, lat, r):
+    """The NE, NW, SW and SE quadrants of a circle
+
+    Args:
+        name (str): The name of the circle. The quadrants are named <name>_NE etc.
+        lon (float):
+        lat (float):
+        r (float):
+
+    Returns:
+        list: Region for each quadrant
+    """
+    circle = Circle(name, lon, lat, r)
+    boxes = dict(
+        NE=(lon, lon + r, lat, lat + r),
+        NW=(lon - r, lon, lat, lat + r),
+        SW=(lon - r, lon, lat - r, lat),
+        SE=(lon, lon + r, lat - r, lat),
+    )
+
+    return [
+        _Intersection(
+            "{}_{}".format(name, label), circle, Box(name, *boxes[label])
+        )
+        for label in ["NE", "NW", "SW", "SE"]
+    ]
+
+
+class _Intersection(Region):
+    def __init__(self, name, *regions):
+        super().__init__(name)
+        self.regions = regions
+
+    def extent(self):
+        extents = np.array([region.extent() for region in self.regions])
+        return (
+            extents[:, 0].max(),
+            extents[:, 1].min(),
+            extents[:, 2].max(),
+            extents[:, 3].min(),
+        )
+
+    def contains(self, lon, lat):
+        result = self.regions[0].contains(lon, lat)
+        for region in self.regions[1:]:
+            result &= region.contains(lon, lat)
+        return result
+
+
+if __name__ == "__main__":
+    parse_docopt_arguments(main, __doc__)
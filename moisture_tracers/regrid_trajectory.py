@@ -15,7 +15,7 @@ Arguments:
     <forecast_path>
     <forecast_start>
     <forecast_resolution>
-    <trajectory_filename> The trajectoryEnsemble .pkl file produced by pylagranto
+    <trajectory_filename> The trajectory ensemble saved by trajectory.py (.nc)
     <output_path> Where to save the data
 
 Options:
@@ -30,10 +30,9 @@ from iris.analysis import AreaWeighted
 from iris.cube import Cube
 
 from irise.diagnostics.contours import haversine
-from pylagranto import trajectory
 from twinotter.util.scripting import parse_docopt_arguments
 
-from moisture_tracers import grey_zone_forecast
+from moisture_tracers import grey_zone_forecast, trajectory_store
 
 
 def _command_line_interface(
@@ -49,7 +48,7 @@ def _command_line_interface(
     initial_grid=None,
     output_path=".",
 ):
-    tr = trajectory.load(trajectory_filename)
+    tr = trajectory_store.load(trajectory_filename)
 
     forecast = grey_zone_forecast(
         forecast_path,
@@ -0,0 +1,416 @@
+"""
+Streaming histograms and quantile sketches
+
+Both accumulate statistics of a field separately for each level (or any other leading
+dimension) in a single pass over the data, and can be combined with merge, so the
+statistics for many lead times, or from parallel workers, can be combined without
+keeping the original fields.
+
+Histogram counts values in fixed bins. QuantileSketch counts values in bins that are
+evenly spaced in log(|x|) (as in DDSketch, Masson et al., 2019,
+https://arxiv.org/abs/1908.10693), so the value it returns for a quantile is within a
+fixed relative error of |x| for the value at that rank, whatever the range of the data.
+
+>>> sketch = QuantileSketch(nlevels=cube.shape[0])
+>>> for cubes in forecast:
+...     sketch.add(cubes.extract_cube(name).data)
+>>> quartiles = sketch.quantiles([0.25, 0.5, 0.75])
+"""
+
+import numpy as np
+import iris.cube
+from iris.coords import AuxCoord
+
+# Maximum number of values binned at once by Histogram.add and QuantileSketch.add
+chunk_size = 2 ** 24
+
+
+class Histogram(object):
+    def __init__(self, edges, nlevels=1):
+        """
+        Args:
+            edges (np.ndarray): The bin edges (monotonically increasing). Values
+                outside the bins are counted separately as underflow and overflow
+            nlevels (int): The number of levels to keep separate histograms for
+        """
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.nlevels = nlevels
+
+        # Each level has an underflow bin, len(edges) - 1 bins and an overflow bin
+        self.counts = np.zeros((nlevels, len(self.edges) + 1))
+
+        widths = np.diff(self.edges)
+        self.uniform = np.allclose(widths, widths[0], rtol=1e-9, atol=0)
+
+    @property
+    def nbins(self):
+        return len(self.edges) - 1
+
+    def add(self, data, weights=None):
+        """Add data to the histogram
+
+        All levels are binned together, in blocks of levels with up to chunk_size
+        values, so large 3D fields are binned without a loop over levels or creating
+        index arrays the size of the full field
+
+        Args:
+            data (np.ndarray): Array with the levels as the first dimension (or any
+                shape if nlevels=1). Masked and NaN values are ignored
+            weights (np.ndarray, optional): Weight of each value, broadcastable to the
+                shape of data
+        """
+        if weights is not None:
+            weights = np.broadcast_to(weights, data.shape).reshape((self.nlevels, -1))
+        if np.ma.isMaskedArray(data):
+            data = np.ma.filled(data.astype(np.float64), np.nan)
+        data = np.asarray(data).reshape((self.nlevels, -1))
+
+        # An extra bin on each level for invalid values, which is discarded
+        nbins = self.counts.shape[1] + 1
+        counts = np.zeros(self.nlevels * nbins)
+
+        step = max(1, chunk_size // max(data.shape[1], 1))
+        for start in range(0, self.nlevels, step):
+            chunk = data[start : start + step]
+            index = self._bin_index(chunk)
+            index += (np.arange(start, start + len(chunk)) * nbins)[:, None]
+
+            if weights is None:
+                chunk_weights = None
+            else:
+                chunk_weights = weights[start : start + step].ravel()
+
+            counts += np.bincount(
+                index.ravel(), weights=chunk_weights, minlength=counts.size
+            )
+
+        self.counts += counts.reshape((self.nlevels, nbins))[:, :-1]
+
+    def _bin_index(self, x):
+        # 0 for underflow, 1 to nbins for the bins, nbins + 1 for overflow and nbins + 2
+        # for invalid values. Uniform bins are found arithmetically, rather than by
+        # searching the edges
+        invalid = ~np.isfinite(x)
+        if self.uniform:
+            width = self.edges[1] - self.edges[0]
+            index = np.floor((x - self.edges[0]) * (1 / width)) + 1
+            np.clip(index, 0, self.nbins + 1, out=index)
+            index[invalid] = self.nbins + 2
+            index = index.astype(np.int64)
+        else:
+            index = np.searchsorted(self.edges, x, side="right")
+            index[invalid] = self.nbins + 2
+
+        return index
+
+    def merge(self, other):
+        """Add the counts from another Histogram with the same bins"""
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("Can only merge histograms with the same bins")
+        self.counts += other.counts
+
+    def frequencies(self, density=False):
+        """The counts in each bin, excluding underflow and overflow
+
+        Args:
+            density (bool): If True, normalise by the total count and bin width so each
+                level integrates to one
+
+        Returns:
+            np.ndarray: Shape (nlevels, nbins)
+        """
+        counts = self.counts[:, 1:-1]
+        if density:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                counts = counts / self.counts.sum(axis=1, keepdims=True)
+            counts = counts / np.diff(self.edges)
+
+        return counts
+
+    def quantiles(self, q):
+        """Approximate quantiles by linear interpolation within bins
+
+        Quantiles that fall in the underflow or overflow are returned as the first or
+        last bin edge
+
+        Args:
+            q (list): Quantiles (0 to 1)
+
+        Returns:
+            np.ndarray: Shape (len(q), nlevels)
+        """
+        q = np.asarray(q)
+        cumulative = np.cumsum(self.counts, axis=1)
+        total = cumulative[:, -1:]
+
+        result = np.empty((len(q), self.nlevels))
+        for n, level in enumerate(cumulative):
+            # Cumulative count at each edge, excluding the overflow
+            result[:, n] = np.interp(q * total[n], level[:-1], self.edges)
+
+        return result
+
+
+class QuantileSketch(object):
+    def __init__(self, relative_accuracy=0.01, nlevels=1, min_value=1e-12, offset=0.0):
+        """
+        Args:
+            relative_accuracy (float): The estimate of a quantile, x, is within
+                relative_accuracy * |x| of the value at that rank. Negative values are
+                counted by magnitude in separate bins, so they have the same accuracy
+            nlevels (int): The number of levels to keep separate sketches for
+            min_value (float): Values with a magnitude smaller than this are counted
+                as zero, so quantiles in this range are returned as exactly zero
+            offset (float | np.ndarray): A reference value for each level that is
+                subtracted before adding values to the sketch, so the relative error
+                applies to the difference from the reference. For fields with a large
+                mean relative to their variability (e.g. temperature) this should be
+                close to the mean
+        """
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.nlevels = nlevels
+        self.min_value = min_value
+        self.offset = np.broadcast_to(np.asarray(offset, dtype=np.float64), (nlevels,))
+
+        self.positive = _Store(nlevels)
+        self.negative = _Store(nlevels)
+        self.zero = np.zeros(nlevels)
+
+    def add(self, data, weights=None):
+        """Add data to the sketch
+
+        As in Histogram.add, the data are binned in blocks of levels with up to
+        chunk_size values, so only a block at a time is copied
+
+        Args:
+            data (np.ndarray): Array with the levels as the first dimension (or any
+                shape if nlevels=1). Masked and NaN values are ignored
+            weights (np.ndarray, optional): Weight of each value, broadcastable to the
+                shape of data
+        """
+        if weights is not None:
+            weights = np.broadcast_to(weights, data.shape).reshape((self.nlevels, -1))
+        data = data.reshape((self.nlevels, -1))
+
+        step = max(1, chunk_size // max(data.shape[1], 1))
+        for start in range(0, self.nlevels, step):
+            chunk = data[start : start + step]
+            levels = np.arange(start, start + len(chunk))
+
+            # Masked and NaN values are not in any of the bins
+            x = np.ma.filled(chunk.astype(np.float64), np.nan)
+            x -= self.offset[levels, None]
+            levels = np.broadcast_to(levels[:, None], x.shape)
+
+            if weights is None:
+                chunk_weights = np.ones(x.shape)
+            else:
+                chunk_weights = weights[start : start + step]
+
+            is_zero = np.abs(x) < self.min_value
+            self.zero += np.bincount(
+                levels[is_zero], weights=chunk_weights[is_zero], minlength=self.nlevels
+            )
+
+            for store, is_sign in [
+                (self.positive, x >= self.min_value),
+                (self.negative, x <= -self.min_value),
+            ]:
+                keys = self._key(np.abs(x[is_sign]))
+                store.add(keys, levels[is_sign], chunk_weights[is_sign])
+
+    def merge(self, other):
+        """Add the counts from another QuantileSketch with the same accuracy"""
+        if other.gamma != self.gamma or not np.array_equal(other.offset, self.offset):
+            raise ValueError(
+                "Can only merge sketches with the same relative accuracy and offset"
+            )
+        self.positive.merge(other.positive)
+        self.negative.merge(other.negative)
+        self.zero += other.zero
+
+    def count(self):
+        """The total weight of values added to each level"""
+        return (
+            self.positive.counts.sum(axis=1)
+            + self.negative.counts.sum(axis=1)
+            + self.zero
+        )
+
+    def quantiles(self, q):
+        """Estimate quantiles from the sketch
+
+        Args:
+            q (list): Quantiles (0 to 1)
+
+        Returns:
+            np.ndarray: Shape (len(q), nlevels). NaN for levels with no data
+        """
+        q = np.asarray(q)
+
+        # Counts and representative values of all bins, from most negative to most
+        # positive
+        counts = np.concatenate(
+            [
+                self.negative.counts[:, ::-1],
+                self.zero[:, None],
+                self.positive.counts,
+            ],
+            axis=1,
+        )
+        values = np.concatenate(
+            [
+                -self._value(self.negative.keys()[::-1]),
+                [0.0],
+                self._value(self.positive.keys()),
+            ]
+        )
+
+        cumulative = np.cumsum(counts, axis=1)
+        total = cumulative[:, -1]
+
+        # The first bin where the cumulative count reaches q * total. Keep the rank
+        # above zero so empty bins below the minimum are skipped
+        rank = np.clip(q[:, None] * total[None, :], 1e-12 * total, total)
+
+        result = np.full((len(q), self.nlevels), np.nan)
+        for n in range(self.nlevels):
+            if total[n] > 0:
+                index = np.searchsorted(cumulative[n], rank[:, n], side="left")
+                index = np.minimum(index, len(values) - 1)
+                result[:, n] = values[index] + self.offset[n]
+
+        return result
+
+    def _key(self, x):
+        return np.ceil(np.log(x) / self.log_gamma).astype(np.int64)
+
+    def _value(self, keys):
+        # The value with the smallest relative error to all values in the bin
+        return 2 * self.gamma ** keys / (self.gamma + 1)
+
+
+class _Store(object):
+    """Counts in bins with contiguous integer keys, extended as needed"""
+
+    def __init__(self, nlevels):
+        self.nlevels = nlevels
+        self.offset = 0
+        self.counts = np.zeros((nlevels, 0))
+
+    def keys(self):
+        return np.arange(self.offset, self.offset + self.counts.shape[1])
+
+    def add(self, keys, levels, weights):
+        if len(keys) == 0:
+            return
+        self._extend(keys.min(), keys.max())
+        nkeys = self.counts.shape[1]
+        self.counts += np.bincount(
+            levels * nkeys + (keys - self.offset),
+            weights=weights,
+            minlength=self.counts.size,
+        ).reshape(self.counts.shape)
+
+    def merge(self, other):
+        if other.counts.shape[1] == 0:
+            return
+        self._extend(other.offset, other.offset + other.counts.shape[1] - 1)
+        start = other.offset - self.offset
+        self.counts[:, start : start + other.counts.shape[1]] += other.counts
+
+    def _extend(self, key_min, key_max):
+        nkeys = self.counts.shape[1]
+        if nkeys == 0:
+            self.offset = key_min
+            self.counts = np.zeros((self.nlevels, key_max - key_min + 1))
+            return
+
+        new_offset = min(self.offset, key_min)
+        new_nkeys = max(self.offset + nkeys - 1, key_max) - new_offset + 1
+        if new_offset != self.offset or new_nkeys != nkeys:
+            counts = np.zeros((self.nlevels, new_nkeys))
+            start = self.offset - new_offset
+            counts[:, start : start + nkeys] = self.counts
+            self.offset = new_offset
+            self.counts = counts
+
+
+def horizontal_sketch(cube, weights=None, relative_accuracy=0.01, offset=0.0):
+    """A QuantileSketch of a cube over its horizontal dimensions
+
+    The sketch is built in a single pass over the data. Sketches of the same variable
+    made with the same relative_accuracy and offset (e.g. at different lead times) can
+    be combined with QuantileSketch.merge
+
+    Args:
+        cube (iris.cube.Cube): A cube with x and y as the last two dimensions
+        weights (np.ndarray, optional): Weights with shape (ny, nx)
+        relative_accuracy (float): See QuantileSketch
+        offset (float | np.ndarray): A fixed reference value for the variable, or for
+            each level, subtracted before the values are added. See QuantileSketch
+
+    Returns:
+        QuantileSketch: With one level for each index of the leading dimensions of
+            the cube
+    """
+    data = cube.data
+    nlevels = int(np.prod(data.shape[:-2]))
+
+    sketch = QuantileSketch(
+        relative_accuracy=relative_accuracy,
+        nlevels=nlevels,
+        offset=np.ravel(offset) if np.ndim(offset) > 0 else offset,
+    )
+    sketch.add(data.reshape((nlevels,) + data.shape[-2:]), weights=weights)
+
+    return sketch
+
+
+def horizontal_percentiles(
+    cube, percent, weights=None, relative_accuracy=0.01, offset=0.0
+):
+    """Percentiles of a cube over its horizontal dimensions, from a QuantileSketch
+
+    Args:
+        cube (iris.cube.Cube): A cube with x and y as the last two dimensions
+        percent (list): The percentiles to calculate
+        weights (np.ndarray, optional): Weights with shape (ny, nx)
+        relative_accuracy (float): See QuantileSketch. The error is relative to the
+            difference from the offset
+        offset (float | np.ndarray): See horizontal_sketch. For fields with a large
+            mean relative to their variability (e.g. temperature) use a typical value
+            of the variable
+
+    Returns:
+        iris.cube.Cube: <name>_percentile with a leading percentile dimension
+    """
+    lon = cube.coord(axis="x", dim_coords=True)
+    lat = cube.coord(axis="y", dim_coords=True)
+    shape = cube.shape[:-2]
+
+    sketch = horizontal_sketch(
+        cube, weights=weights, relative_accuracy=relative_accuracy, offset=offset
+    )
+    values = sketch.quantiles(np.asarray(percent) / 100)
+
+    # Keep the precision of floating point data
+    if cube.dtype.kind == "f":
+        dtype = cube.dtype
+    else:
+        dtype = np.float64
+
+    template = cube[..., 0, 0]
+    template.replace_coord(lon.collapsed())
+    template.replace_coord(lat.collapsed())
+
+    results = iris.cube.CubeList()
+    for n, p in enumerate(percent):
+        result = template.copy(data=values[n].reshape(shape).astype(dtype))
+        result.rename("{}_percentile".format(cube.name()))
+        result.add_aux_coord(AuxCoord(p, long_name="percentile", units="%"))
+        results.append(result)
+
+    return results.merge_cube()
@@ -1,18 +1,37 @@
 """
+Calculate trajectories from one or more seed points through a forecast. All seed
+points are integrated together, with one call to caltra for each direction, and saved
+as a single trajectory ensemble
 
 Usage:
     trajectory.py <path> <start_time> <resolution> <x0> <y0> <z0> <t0> [<output_path>]
+        [--grid] [--band=<z>]
     trajectory.py (-h | --help)
 
 Arguments:
     <path>
     <start_time>
     <resolution>
+    <x0>
+    <y0>
+    <z0>
+        The seed longitudes, latitudes and heights. Each can be a single value or a
+        comma-separated list of values
+    <t0>
+        The lead time (hours) of the seed points
 
 Options:
     -h --help
         Show this screen.
+    --grid
+        Seed a trajectory at every combination of x0, y0 and z0. By default the lists
+        are paired element by element, with single values repeated for every seed
+    --band=<z>
+        Only load the model levels within this distance (m) of the trajectory heights
+        and the horizontal window the trajectories can reach in each time step. See
+        moisture_tracers.trajectory_winds
 """
+from collections import OrderedDict
 import datetime
 import warnings
 
@@ -22,11 +41,13 @@ from twinotter.util.scripting import parse_docopt_arguments
 from pylagranto import caltra
 from pylagranto.datasets import MetUMStaggeredGrid
 
-from moisture_tracers import grey_zone_forecast
+from moisture_tracers import grey_zone_forecast, trajectory_store
+from moisture_tracers.trajectory_winds import caltra_restricted
 
 
 trajectory_filename = "{start_time}_{resolution}_{x0}E_{y0}N_{z0}{units}_" \
-                      "T+{lead_time:02d}.pkl"
+                      "T+{lead_time:02d}.nc"
+ensemble_filename = "{start_time}_{resolution}_{nseeds}_seeds_T+{lead_time:02d}.nc"
 
 # Inner-domain centre: x0=302.5, y0=13.5, t0=48
 # HALO: x0=302.283, y0=13.3
@@ -36,59 +57,202 @@ trajectory_filename = "{start_time}_{resolution}_{x0}E_{y0}N_{z0}{units}_" \
 #   x0=310.0, y0=15.0,  t0=T+48h
 
 
-def _command_line_interface(path, start_time, resolution, x0, y0, z0, t0, output_path="./"):
+def _command_line_interface(
+    path,
+    start_time,
+    resolution,
+    x0,
+    y0,
+    z0,
+    t0,
+    output_path="./",
+    grid=False,
+    band=None,
+):
     forecast = grey_zone_forecast(
         path, start_time, resolution=resolution, grid=None, lead_times=range(1, 48 + 1)
     )
 
+    x0, y0, z0 = [[float(x) for x in arg.split(",")] for arg in (x0, y0, z0)]
+    trainp = seed_points(x0, y0, z0, grid=grid)
+
     traout = calculate_trajectory(
-        forecast, float(x0), float(y0), float(z0), int(t0), "height_above_reference_ellipsoid"
+        forecast,
+        trainp[:, 0],
+        trainp[:, 1],
+        trainp[:, 2],
+        int(t0),
+        "height_above_reference_ellipsoid",
+        band=None if band is None else float(band),
     )
 
-    traout.save(
-        output_path + trajectory_filename.format(
+    if len(trainp) == 1:
+        filename = trajectory_filename.format(
             start_time=forecast.start_time.strftime("%Y%m%d"),
             resolution=resolution,
-            x0=format_float_for_file(x0),
-            y0=format_float_for_file(y0),
-            z0=format_float_for_file(z0),
-            t0=t0,
+            x0=format_float_for_file(x0[0]),
+            y0=format_float_for_file(y0[0]),
+            z0=format_float_for_file(z0[0]),
+            lead_time=int(t0),
             units="m",
         )
+    else:
+        filename = ensemble_filename.format(
+            start_time=forecast.start_time.strftime("%Y%m%d"),
+            resolution=resolution,
+            nseeds=len(trainp),
+            lead_time=int(t0),
+        )
+
+    trajectory_store.save(
+        traout,
+        output_path + filename,
+        start_time=forecast.start_time.isoformat(),
+        resolution=resolution,
+        seed_lead_time=int(t0),
     )
 
 
-def calculate_trajectory(forecast, x0, y0, z0, t0, zcoord):
-    levels = (zcoord, [z0])
-    trainp = np.array([[x0, y0, z0]])
+def seed_points(x0, y0, z0, grid=False):
+    """Combine the seed coordinates into an array of points for caltra
+
+    Args:
+        x0, y0, z0 (float or array_like): The seed coordinates
+        grid (bool): If True, seed a point at every combination of x0, y0 and z0.
+            Otherwise x0, y0 and z0 are broadcast against each other
+
+    Returns:
+        np.ndarray: Array with shape (N, 3) of (x, y, z) for each seed point
+    """
+    x0, y0, z0 = [np.atleast_1d(np.asarray(x, dtype=float)) for x in (x0, y0, z0)]
+    if grid:
+        x0, y0, z0 = np.meshgrid(x0, y0, z0, indexing="ij")
+    else:
+        x0, y0, z0 = np.broadcast_arrays(x0, y0, z0)
+
+    return np.stack([x0.ravel(), y0.ravel(), z0.ravel()], axis=-1)
+
+
+def calculate_trajectory(forecast, x0, y0, z0, t0, zcoord, grid=False, band=None):
+    """Calculate trajectories through the forecast from one or more seed points
+
+    All seed points are integrated together so each wind field is only read once for
+    each direction. If t0 is in the middle of the forecast the backward and forward
+    legs share a cache of the wind fields, so the fields at t0 are only loaded once
+
+    Args:
+        forecast (irise.forecast.Forecast):
+        x0, y0, z0 (float or array_like): The seed coordinates. Arrays are broadcast
+            against each other, or combined as a grid if grid=True
+        t0 (int): The lead time (hours) of the seed points
+        zcoord (str): The name of the vertical coordinate of z0
+        grid (bool): Seed a point at every combination of x0, y0 and z0
+        band (float, optional): If given, only load the winds within this distance
+            of the trajectory heights (in the units of zcoord) and within the
+            horizontal window the trajectories can reach at each time step. See
+            moisture_tracers.trajectory_winds.caltra_restricted
 
-    times = list(forecast._loader.files)
-    datasource = MetUMStaggeredGrid(forecast._loader.files, levels=levels)
+    Returns:
+        pylagranto.trajectory.TrajectoryEnsemble: The trajectories, ordered as in
+            seed_points, covering all times in the forecast
+    """
+    trainp = seed_points(x0, y0, z0, grid=grid)
+    levels = (zcoord, list(np.unique(trainp[:, 2])))
+    files = forecast._loader.files
+
+    if band is None:
+        # One datasource for both legs, so the staggered grid is only set up once and
+        # the fields at the seed time are only loaded once
+        datasource = CachedDataSource(MetUMStaggeredGrid(files, levels=levels))
+
+        def leg(leg_times, fbflag):
+            return caltra.caltra(
+                trainp,
+                leg_times,
+                datasource,
+                fbflag=fbflag,
+                tracers=["x_wind", "y_wind"],
+            )
+
+    else:
+        def leg(leg_times, fbflag):
+            return caltra_restricted(
+                trainp,
+                leg_times,
+                files,
+                levels,
+                fbflag=fbflag,
+                tracers=["x_wind", "y_wind"],
+                band=band,
+            )
 
+    times = list(files)
     time_traj = forecast.start_time + datetime.timedelta(hours=t0)
     if time_traj == times[0]:
-        traout = caltra.caltra(
-            trainp, times, datasource, tracers=["x_wind", "y_wind"]
-        )
+        traout = leg(times, 1)
     elif time_traj == times[-1]:
-        traout = caltra.caltra(
-            trainp, times, datasource, fbflag=-1, tracers=["x_wind", "y_wind"]
-        )
+        traout = leg(times, -1)
     else:
         times_fwd = [time for time in times if time <= time_traj]
-        traout_fwd = caltra.caltra(
-            trainp, times_fwd, datasource, tracers=["x_wind", "y_wind"]
-        )
-
         times_bck = [time for time in times if time >= time_traj]
-        traout_bck = caltra.caltra(
-            trainp, times_bck, datasource, fbflag=-1, tracers=["x_wind", "y_wind"]
-        )
-        traout = traout_bck + traout_fwd
+
+        # The legs are run one after the other. caltra is compiled Fortran that is
+        # not known to release the GIL, so threads would not run them at the same
+        # time, and separate processes could not share the cached fields
+        traout = leg(times_bck, -1) + leg(times_fwd, 1)
 
     return traout
 
 
+class CachedDataSource(object):
+    """Wrap a pylagranto datasource so it can be reused by several calls to caltra
+
+    The results of calls to the methods of the datasource are kept in a
+    least-recently-used cache, so trajectory calculations through overlapping times
+    only load each field once. The cached arrays are shared so they must not be
+    modified by the caller
+
+    Args:
+        datasource: The datasource to wrap (e.g. pylagranto.datasets.MetUMStaggeredGrid)
+        maxsize (int): The maximum number of method results to keep
+    """
+
+    def __init__(self, datasource, maxsize=8):
+        self._datasource = datasource
+        self._maxsize = maxsize
+        self._cache = OrderedDict()
+
+    def __getattr__(self, name):
+        attribute = getattr(self._datasource, name)
+        if not callable(attribute):
+            return attribute
+
+        def cached(*args, **kwargs):
+            key = (name, _hashable(args), _hashable(kwargs))
+            if key in self._cache:
+                self._cache.move_to_end(key)
+            else:
+                self._cache[key] = attribute(*args, **kwargs)
+                if len(self._cache) > self._maxsize:
+                    self._cache.popitem(last=False)
+
+            return self._cache[key]
+
+        return cached
+
+
+def _hashable(x):
+    # Convert the (possibly nested) arguments of a method call to a cache key
+    if isinstance(x, dict):
+        return tuple(sorted((key, _hashable(value)) for key, value in x.items()))
+    elif isinstance(x, (list, tuple)):
+        return tuple(_hashable(value) for value in x)
+    elif isinstance(x, np.ndarray):
+        return x.tobytes(), x.shape
+    else:
+        return x
+
+
 def format_float_for_file(x):
     # Replace decimal point with a p (copying what was done for the UM files)
     return str(x).replace(".", "p")
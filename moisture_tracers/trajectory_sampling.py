@@ -0,0 +1,261 @@
+"""
+Sample model fields along trajectories
+
+The bilinear interpolation indices and weights of the trajectory positions are
+calculated once for each time and grid. For each field only the block of gridpoints
+surrounding the trajectories is read from the file, and the values at all trajectories
+are gathered in one vectorised step. 3D fields are sampled on every model level
+
+Usage:
+    trajectory_sampling.py
+        <path> <start_time> <resolution> <trajectory_filename> <variable>...
+        [--grid=<str>] [--output_path=<path>]
+    trajectory_sampling.py (-h | --help)
+
+Arguments:
+    <path>
+    <start_time>
+    <resolution>
+    <trajectory_filename>
+        A trajectory ensemble saved by trajectory.py
+    <variable>
+        One or more variables to sample. Any variable that can be calculated with
+        irise.convert
+
+Options:
+    -h --help
+        Show this screen.
+    --grid=<str>
+        The grid of the forecast data. By default, use the original model grid
+    --output_path=<path>
+        Where to save the sampled data [default: ./]
+"""
+
+import os
+
+import numpy as np
+import xarray as xr
+
+from irise import convert
+
+from twinotter.util.scripting import parse_docopt_arguments
+
+from moisture_tracers import grey_zone_forecast, trajectory_store
+
+
+def main(
+    path,
+    start_time,
+    resolution,
+    trajectory_filename,
+    variable,
+    grid=None,
+    output_path="./",
+):
+    forecast = grey_zone_forecast(
+        path, start_time=start_time, resolution=resolution, grid=grid
+    )
+    tr = trajectory_store.load(trajectory_filename)
+
+    ds = sample_forecast(forecast, tr, variable)
+
+    ds.to_netcdf(
+        os.path.join(
+            output_path,
+            "sampled_" + os.path.basename(trajectory_filename),
+        )
+    )
+
+
+def sample_forecast(forecast, tr, names):
+    """Sample fields at the trajectory positions at every time in the forecast
+
+    Args:
+        forecast (irise.forecast.Forecast):
+        tr (moisture_tracers.trajectory_store.TrajectoryFile |
+            pylagranto.trajectory.TrajectoryEnsemble):
+        names (list): The names of the fields to sample. Anything that can be
+            calculated with irise.convert.calc
+
+    Returns:
+        xarray.Dataset: Each field with dimensions (trajectory, time) for 2D fields or
+            (trajectory, time, <vertical coordinate>) for 3D fields, and the
+            trajectory positions
+    """
+    sampler = TrajectorySampler(tr)
+    times = [time for time in forecast._loader.files if time in sampler.times]
+
+    samples = {name: [] for name in names}
+    templates = dict()
+    for time in times:
+        print(time)
+        cubes = forecast.set_time(time)
+        for name in names:
+            cube = convert.calc(name, cubes)
+            samples[name].append(sampler.sample(cube, time))
+            templates[name] = cube
+
+    return sampler.to_dataset(times, samples, templates)
+
+
+class TrajectorySampler(object):
+    """Bilinear interpolation of gridded fields to trajectory positions
+
+    Args:
+        tr (moisture_tracers.trajectory_store.TrajectoryFile |
+            pylagranto.trajectory.TrajectoryEnsemble): The trajectories. Indexing by
+            time gives an array (ntra, nvariables) with x and y as the first two
+            variables, in the same units as the horizontal coordinates of the grid
+    """
+
+    def __init__(self, tr):
+        self.tr = tr
+        self.times = list(tr.times)
+        self._weights = dict()
+
+    def positions(self, time):
+        """np.ndarray: The (x, y, z) positions of the trajectories at the time"""
+        return np.asarray(self.tr[time])[:, :3]
+
+    def weights(self, cube, time):
+        """Calculate the interpolation indices and weights on the grid of the cube
+
+        The result is cached for each time and grid
+
+        Args:
+            cube (iris.cube.Cube): A cube with 1D x and y dimension coordinates
+            time (datetime.datetime):
+
+        Returns:
+            tuple: The indices of the block of gridpoints containing the trajectories
+                as (y, x) slices, the indices of the lower-left gridpoint surrounding
+                each trajectory relative to the block as (j, i), the weights of the
+                four surrounding gridpoints with shape (4, ntra), and a mask of
+                trajectories outside the grid
+        """
+        x = cube.coord(axis="x", dim_coords=True).points
+        y = cube.coord(axis="y", dim_coords=True).points
+        key = (time, x.tobytes(), y.tobytes())
+
+        if key not in self._weights:
+            positions = self.positions(time)
+            i, wx, outside_x = _interpolation_weights(x, positions[:, 0])
+            j, wy, outside_y = _interpolation_weights(y, positions[:, 1])
+            outside = outside_x | outside_y
+
+            if outside.all():
+                block = (slice(0, 0), slice(0, 0))
+            else:
+                block = (
+                    slice(j[~outside].min(), j[~outside].max() + 2),
+                    slice(i[~outside].min(), i[~outside].max() + 2),
+                )
+            i = np.where(outside, 0, i - block[1].start)
+            j = np.where(outside, 0, j - block[0].start)
+
+            weights = np.array(
+                [(1 - wy) * (1 - wx), (1 - wy) * wx, wy * (1 - wx), wy * wx]
+            )
+
+            self._weights[key] = (block, (j, i), weights, outside)
+
+        return self._weights[key]
+
+    def sample(self, cube, time):
+        """Interpolate a field to the trajectory positions
+
+        Args:
+            cube (iris.cube.Cube): A field with x and y as the last two dimensions
+            time (datetime.datetime):
+
+        Returns:
+            np.ndarray: Array with the horizontal dimensions of the cube replaced by
+                a trajectory dimension (first). Trajectories outside the grid are NaN
+        """
+        block, (j, i), weights, outside = self.weights(cube, time)
+        ntra = len(outside)
+        if outside.all():
+            return np.full((ntra,) + cube.shape[:-2], np.nan)
+
+        # Only read the gridpoints surrounding the trajectories
+        data = np.ma.filled(cube[(Ellipsis,) + block].data.astype(np.float64), np.nan)
+
+        values = (
+            weights[0] * data[..., j, i]
+            + weights[1] * data[..., j, i + 1]
+            + weights[2] * data[..., j + 1, i]
+            + weights[3] * data[..., j + 1, i + 1]
+        )
+        values[..., outside] = np.nan
+
+        return np.moveaxis(values, -1, 0)
+
+    def to_dataset(self, times, samples, templates):
+        """Combine sampled fields into a dataset
+
+        Args:
+            times (list): The times of the samples
+            samples (dict): A list of samples at each time for each field
+            templates (dict): A cube of each field, used for the vertical
+                coordinates and the units
+
+        Returns:
+            xarray.Dataset:
+        """
+        ds = xr.Dataset(
+            coords=dict(trajectory=np.arange(len(self.positions(times[0]))), time=times)
+        )
+        positions = np.stack([self.positions(time) for time in times], axis=1)
+        for n, name in enumerate(["x", "y", "z"]):
+            ds[name] = (("trajectory", "time"), positions[..., n])
+
+        for name, values in samples.items():
+            cube = templates[name]
+            dims = ["trajectory", "time"]
+            for n in range(cube.ndim - 2):
+                coord = cube.coord(dimensions=n, dim_coords=True)
+                dim = _dimension_name(ds, coord)
+                ds.coords[dim] = coord.points
+                ds[dim].attrs["units"] = str(coord.units)
+                dims.append(dim)
+
+            ds[name] = (tuple(dims), np.stack(values, axis=1))
+            ds[name].attrs["units"] = str(cube.units)
+
+        return ds
+
+
+def _interpolation_weights(points, values):
+    # Index of the grid point before each value and the fractional distance to the next
+    # grid point. Handles increasing or decreasing coordinates
+    if points[0] > points[-1]:
+        index, weight, outside = _interpolation_weights(points[::-1], values)
+        index = len(points) - 2 - index
+        return index, 1 - weight, outside
+
+    index = np.searchsorted(points, values, side="right") - 1
+    index = np.clip(index, 0, len(points) - 2)
+    weight = (values - points[index]) / (points[index + 1] - points[index])
+    outside = ~np.isfinite(values) | (values < points[0]) | (values > points[-1])
+
+    return index, np.where(outside, 0.0, weight), outside
+
+
+def _dimension_name(ds, coord):
+    # Use the coordinate name for the dimension unless the dataset already has a
+    # dimension with that name and different values
+    name = coord.name()
+    n = 0
+    while name in ds.coords and not np.array_equal(ds[name].values, coord.points):
+        n += 1
+        name = "{}_{}".format(coord.name(), n)
+
+    return name
+
+
+if __name__ == "__main__":
+    import warnings
+
+    warnings.filterwarnings("ignore")
+
+    parse_docopt_arguments(main, __doc__)
@@ -0,0 +1,263 @@
+"""
+Save and load trajectory ensembles as netCDF files
+
+Each variable along the trajectories (x, y, z and any tracers) is saved as a separate
+netCDF variable with dimensions (trajectory, time), chunked by trajectory. Loading a file
+only reads the metadata, and each variable is read from disk when it is accessed, so
+reading a single variable or a single trajectory does not need the whole ensemble. Use
+this to convert the .pkl files saved by pylagranto
+
+Usage:
+    trajectory_store.py <filename>...
+    trajectory_store.py (-h | --help)
+
+Arguments:
+    <filename>
+        One or more trajectory ensembles saved as .pkl files by pylagranto. Each is
+        saved as a netCDF file with the same name and a .nc extension
+
+Options:
+    -h --help
+        Show this screen.
+"""
+
+import os
+
+import numpy as np
+import netCDF4
+import cftime
+
+from twinotter.util.scripting import parse_docopt_arguments
+
+time_units = "hours since 1970-01-01 00:00:00"
+calendar = "standard"
+
+
+def main(filename):
+    for fname in filename:
+        print(fname)
+        convert(fname)
+
+
+def convert(filename, output=None):
+    """Convert a trajectory ensemble saved by pylagranto to netCDF
+
+    Args:
+        filename (str): The .pkl file saved by pylagranto
+        output (str, optional): The netCDF filename. Defaults to filename with the
+            extension replaced by .nc
+
+    Returns:
+        str: The netCDF filename
+    """
+    from pylagranto import trajectory
+
+    if output is None:
+        output = os.path.splitext(filename)[0] + ".nc"
+
+    save(trajectory.load(filename), output, source=os.path.basename(filename))
+
+    return output
+
+
+def save(traout, filename, **attributes):
+    """Save a trajectory ensemble to a netCDF file
+
+    Args:
+        traout (pylagranto.trajectory.TrajectoryEnsemble | TrajectoryFile): Any
+            ensemble with times, names and data (ntra, ntimes, nvariables) attributes
+        filename (str):
+        **attributes: Metadata saved as global attributes of the file
+    """
+    data = np.asarray(traout.data)
+    ntra, ntimes, nvariables = data.shape
+
+    with netCDF4.Dataset(filename, "w") as dataset:
+        for key, value in attributes.items():
+            dataset.setncattr(key, value)
+        dataset.setncattr("variables", " ".join(traout.names))
+
+        dataset.createDimension("trajectory", ntra)
+        dataset.createDimension("time", ntimes)
+
+        time = dataset.createVariable("time", "f8", ("time",))
+        time.standard_name = "time"
+        time.units = time_units
+        time.calendar = calendar
+        time[:] = cftime.date2num(list(traout.times), time_units, calendar=calendar)
+
+        for n, name in enumerate(traout.names):
+            var = dataset.createVariable(
+                name, data.dtype, ("trajectory", "time"), chunksizes=(1, ntimes)
+            )
+            var[:] = data[:, :, n]
+
+
+def load(filename):
+    """Open a trajectory ensemble saved with save
+
+    Args:
+        filename (str):
+
+    Returns:
+        TrajectoryFile:
+    """
+    return TrajectoryFile(filename)
+
+
+class TrajectoryFile(object):
+    """A trajectory ensemble in a netCDF file, read on demand
+
+    Indexing follows pylagranto.trajectory.TrajectoryEnsemble:
+
+    >>> tr = load("trajectories.nc")
+    >>> tr["x_wind"]  # Array (ntra, ntimes) of one variable
+    >>> tr[time]      # Array (ntra, nvariables) of all variables at one time
+    >>> tr[0]         # The first trajectory
+
+    Args:
+        filename (str):
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.dataset = netCDF4.Dataset(filename, "r")
+        self.dataset.set_auto_mask(False)
+
+        time = self.dataset.variables["time"]
+        self.times = list(
+            cftime.num2date(
+                time[:],
+                time.units,
+                calendar=time.calendar,
+                only_use_cftime_datetimes=False,
+                only_use_python_datetimes=True,
+            )
+        )
+        self._time_index = {time: n for n, time in enumerate(self.times)}
+        self.names = self.dataset.getncattr("variables").split()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.dataset.close()
+
+    def __len__(self):
+        return len(self.dataset.dimensions["trajectory"])
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.variable(key)
+        elif isinstance(key, (int, np.integer)):
+            return Trajectory(self, range(len(self))[key])
+        else:
+            return self.at_time(key)
+
+    @property
+    def x(self):
+        return self.variable("x")
+
+    @property
+    def y(self):
+        return self.variable("y")
+
+    @property
+    def z(self):
+        return self.variable("z")
+
+    @property
+    def data(self):
+        """np.ndarray: All variables with shape (ntra, ntimes, nvariables)"""
+        return np.stack([self.variable(name) for name in self.names], axis=-1)
+
+    def time_index(self, time):
+        return self._time_index[time]
+
+    def variable(self, name, trajectory=slice(None)):
+        """Read a single variable from the file
+
+        Args:
+            name (str):
+            trajectory (int | slice): The trajectories to read. Default is all
+
+        Returns:
+            np.ndarray: Array with shape (ntra, ntimes), or (ntimes,) for a single
+                trajectory
+        """
+        return self.dataset.variables[name][trajectory, :]
+
+    def at_time(self, time, trajectory=slice(None)):
+        """Read all variables at a single time
+
+        Args:
+            time (datetime.datetime):
+            trajectory (int | slice): The trajectories to read. Default is all
+
+        Returns:
+            np.ndarray: Array with shape (ntra, nvariables), or (nvariables,) for a
+                single trajectory
+        """
+        n = self.time_index(time)
+        return np.stack(
+            [self.dataset.variables[name][trajectory, n] for name in self.names],
+            axis=-1,
+        )
+
+
+class Trajectory(object):
+    """A single trajectory of a TrajectoryFile, read on demand
+
+    Args:
+        ensemble (TrajectoryFile):
+        index (int): The index of the trajectory in the ensemble
+    """
+
+    def __init__(self, ensemble, index):
+        self.ensemble = ensemble
+        self.index = index
+
+    @property
+    def times(self):
+        return self.ensemble.times
+
+    @property
+    def names(self):
+        return self.ensemble.names
+
+    def time_index(self, time):
+        return self.ensemble.time_index(time)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.ensemble.variable(key, self.index)
+        else:
+            return self.ensemble.at_time(key, self.index)
+
+    @property
+    def x(self):
+        return self["x"]
+
+    @property
+    def y(self):
+        return self["y"]
+
+    @property
+    def z(self):
+        return self["z"]
+
+    @property
+    def data(self):
+        """np.ndarray: All variables with shape (ntimes, nvariables)"""
+        return np.stack([self[name] for name in self.names], axis=-1)
+
+
+if __name__ == "__main__":
+    parse_docopt_arguments(main, __doc__)
@@ -0,0 +1,403 @@
+"""
+Calculate trajectories from wind fields restricted to the region the parcels can reach
+
+Rather than giving caltra the full 3D wind fields for every time, the trajectories are
+integrated one output time step at a time. For each step, only the model levels within a
+band around the current parcel heights and the horizontal window that the parcels can
+reach in that step are read from the files and passed to caltra. If any parcel moves
+more than half way to the edge of the band or window in a step, the step is repeated
+with a band and window twice as large
+
+The restricted fields are saved to temporary files twice as large as needed, and the
+same window is used for the following steps for as long as it still covers the region
+the parcels can reach, so the fields at the end of one step are reused for the start of
+the next
+"""
+
+import os
+import tempfile
+
+import numpy as np
+import iris
+from iris.coords import DimCoord
+
+from pylagranto import caltra
+from pylagranto.datasets import MetUMStaggeredGrid
+from pylagranto.trajectory import TrajectoryEnsemble
+
+from moisture_tracers import level_heights
+
+# Earth radius (m)
+a = 6371229.0
+
+# The fields needed by caltra to calculate the trajectories
+wind_names = ["x_wind", "y_wind", "upward_air_velocity"]
+
+
+def caltra_restricted(
+    trainp,
+    times,
+    files,
+    levels,
+    fbflag=1,
+    tracers=None,
+    max_speed=30.0,
+    band=500.0,
+    max_widen=4,
+):
+    """Calculate trajectories with caltra using only the winds the parcels can reach
+
+    Args:
+        trainp (np.ndarray): The seed points with shape (N, 3)
+        times (list): The times to calculate the trajectories over, as passed to
+            caltra.caltra
+        files (dict): The files containing the wind fields at each time
+        levels (tuple): The vertical coordinate of the trajectories and the seed levels,
+            as passed to pylagranto.datasets.MetUMStaggeredGrid
+        fbflag (int): 1 to integrate forward in time from times[0] or -1 to integrate
+            backward in time from times[-1]
+        tracers (list, optional): Names of the fields to output along the trajectories
+        max_speed (float): The horizontal speed (m s-1) used to estimate how far the
+            parcels can travel in one time step
+        band (float): The initial distance above and below the parcel heights to load
+            model levels for, in the units of the vertical coordinate
+        max_widen (int): The maximum number of times to double the band and window for
+            a single time step before loading the full domain
+
+    Returns:
+        pylagranto.trajectory.TrajectoryEnsemble:
+    """
+    if fbflag == -1:
+        order = list(reversed(range(len(times))))
+    else:
+        order = list(range(len(times)))
+
+    zcoord = levels[0]
+    positions = np.asarray(trainp, dtype=float)
+    names, steps = None, []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        subsets = _SubsetCache(files, zcoord, levels, tmpdir)
+        for n_start, n_end in zip(order[:-1], order[1:]):
+            step_times = sorted([times[n_start], times[n_end]])
+            dt = abs((times[n_end] - times[n_start]).total_seconds())
+
+            for n_widen in range(max_widen + 1):
+                factor = 2 ** n_widen
+                required = Window(
+                    positions,
+                    reach=factor * max_speed * dt,
+                    band=factor * band,
+                    full_domain=(n_widen == max_widen),
+                )
+                # A retry always reads a new, larger window
+                datasource = subsets.datasource(required, step_times, renew=n_widen > 0)
+
+                step = caltra.caltra(
+                    positions, step_times, datasource, fbflag=fbflag, tracers=tracers
+                )
+                names = list(step.names)
+                step_times_out = list(step.times)
+                data = np.asarray(step.data)
+                new_positions = data[
+                    :,
+                    step_times_out.index(times[n_end]),
+                    [names.index(coord) for coord in ("x", "y", "z")],
+                ]
+
+                if required.full_domain or required.contains(new_positions):
+                    break
+
+            positions = new_positions
+            steps.append((step_times_out, data))
+
+    # Each step after the first starts at the time the previous step ended, so only
+    # keep the start time of the first step. The times are in the order caltra gives
+    # them for a single step
+    first_times, first_data = steps[0]
+    times_out, data_out = list(first_times), [first_data]
+    for step_times_out, data in steps[1:]:
+        keep = [n for n, time in enumerate(step_times_out) if time not in times_out]
+        times_out += [step_times_out[n] for n in keep]
+        data_out.append(data[:, keep])
+
+    data_out = np.concatenate(data_out, axis=1)
+    reverse = first_times[0] > first_times[-1]
+    index = sorted(range(len(times_out)), key=times_out.__getitem__, reverse=reverse)
+
+    return TrajectoryEnsemble(data_out[:, index], [times_out[n] for n in index], names)
+
+
+def compare_unrestricted(
+    trainp, times, files, levels, fbflag=1, tracers=None, **kwargs
+):
+    """Check caltra_restricted against caltra with the full wind fields
+
+    Args:
+        trainp, times, files, levels, fbflag, tracers: As for caltra_restricted
+        **kwargs: Passed to caltra_restricted
+
+    Returns:
+        dict: The maximum absolute difference between the two sets of trajectories
+            for each trajectory variable. Parcels that leave the domain in only one of
+            the calculations give a difference of infinity
+    """
+    restricted = caltra_restricted(
+        trainp, times, files, levels, fbflag=fbflag, tracers=tracers, **kwargs
+    )
+    full = caltra.caltra(
+        trainp,
+        times,
+        MetUMStaggeredGrid(files, levels=levels),
+        fbflag=fbflag,
+        tracers=tracers,
+    )
+
+    if list(restricted.times) != list(full.times):
+        raise ValueError("The restricted trajectories have different times")
+
+    differences = dict()
+    for name in full.names:
+        x1, x2 = np.asarray(restricted[name]), np.asarray(full[name])
+        mismatch = np.isfinite(x1) != np.isfinite(x2)
+        both = np.isfinite(x1) & np.isfinite(x2)
+        if mismatch.any():
+            differences[name] = np.inf
+        elif both.any():
+            differences[name] = np.abs(x1[both] - x2[both]).max()
+        else:
+            differences[name] = 0.0
+
+    return differences
+
+
+class _SubsetCache(object):
+    # The wind fields restricted to a window for each time, and a datasource for
+    # caltra reading them. A window is reused for as long as it covers the region the
+    # parcels can reach, so the fields at the end of one step are the fields at the
+    # start of the next. New windows are made twice as large as needed, so the parcels
+    # can travel for several steps before the window has to be moved
+    def __init__(self, files, zcoord, levels, tmpdir):
+        self.files = files
+        self.zcoord = zcoord
+        self.levels = levels
+        self.tmpdir = tmpdir
+        self.window = None
+        self.window_files = None
+        self._datasource = None
+        self._count = 0
+
+    def datasource(self, required, step_times, renew=False):
+        # Go back to a restricted window after a step that needed the full domain
+        if (
+            renew
+            or self.window is None
+            or not self.window.covers(required)
+            or self.window.full_domain != required.full_domain
+        ):
+            self._clear()
+            self.window = required.widen(2)
+            self.window_files = dict()
+
+        for time in step_times:
+            if time not in self.window_files:
+                self._count += 1
+                self.window_files[time] = self.window.subset(
+                    self.files[time],
+                    self.zcoord,
+                    os.path.join(self.tmpdir, "winds_{:04d}.nc".format(self._count)),
+                )
+
+        # Only the fields for times still needed are kept. The datasource looks up
+        # the file for each time when that time is loaded, so it is built once for
+        # each window and sees the files added later
+        for time in list(self.window_files):
+            if time not in step_times:
+                self._remove(self.window_files.pop(time))
+
+        if self._datasource is None:
+            self._datasource = MetUMStaggeredGrid(self.window_files, levels=self.levels)
+
+        return self._datasource
+
+    def _clear(self):
+        if self.window_files is not None:
+            for filename in self.window_files.values():
+                self._remove(filename)
+        self._datasource = None
+
+    def _remove(self, filename):
+        if isinstance(filename, str) and filename.startswith(self.tmpdir):
+            os.remove(filename)
+
+
+class Window(object):
+    """The region of the wind fields that parcels can reach in a single time step
+
+    Args:
+        positions (np.ndarray): The (x, y, z) positions of the parcels with shape
+            (N, 3). Longitude and latitude are in degrees
+        reach (float): The maximum horizontal distance (m) the parcels can travel
+        band (float): The maximum vertical distance the parcels can travel, in the units
+            of the vertical coordinate
+        full_domain (bool): If True, don't restrict the fields
+    """
+
+    def __init__(self, positions, reach, band, full_domain=False):
+        self.positions = positions
+        self.reach = reach
+        self.band = band
+
+        # Parcels that have already left the domain are ignored
+        self.valid = np.isfinite(positions).all(axis=1)
+        self.full_domain = full_domain or not self.valid.any()
+        if self.full_domain:
+            return
+
+        x, y, z = positions[self.valid].T
+
+        dy = np.rad2deg(reach / a)
+        dx = dy / np.cos(np.deg2rad(np.abs(y).max() + dy))
+
+        self.x_range = (x.min() - dx, x.max() + dx)
+        self.y_range = (y.min() - dy, y.max() + dy)
+        self.z_range = (z.min() - band, z.max() + band)
+        self.x_inner = (x.min() - dx / 2, x.max() + dx / 2)
+        self.y_inner = (y.min() - dy / 2, y.max() + dy / 2)
+        self.z_inner = (z.min() - band / 2, z.max() + band / 2)
+
+    def widen(self, factor):
+        """Return a window around the same parcels with the reach and band scaled
+
+        Args:
+            factor (float):
+
+        Returns:
+            Window:
+        """
+        return Window(
+            self.positions,
+            reach=factor * self.reach,
+            band=factor * self.band,
+            full_domain=self.full_domain,
+        )
+
+    def covers(self, other):
+        """Check whether this window includes all of another window
+
+        Args:
+            other (Window):
+
+        Returns:
+            bool:
+        """
+        if self.full_domain:
+            return True
+        elif other.full_domain:
+            return False
+
+        return all(
+            lower <= other_lower and other_upper <= upper
+            for (lower, upper), (other_lower, other_upper) in [
+                (self.x_range, other.x_range),
+                (self.y_range, other.y_range),
+                (self.z_range, other.z_range),
+            ]
+        )
+
+    def contains(self, positions):
+        """Check whether the parcels are within the inner half of the window
+
+        Args:
+            positions (np.ndarray): The (x, y, z) positions of the parcels with shape
+                (N, 3)
+
+        Returns:
+            bool: False if any parcel has moved more than half way to the edge of the
+                window, or left the domain
+        """
+        positions = positions[self.valid]
+        if not np.isfinite(positions).all():
+            return False
+
+        x, y, z = positions.T
+        return all(
+            ((lower <= values) & (values <= upper)).all()
+            for values, (lower, upper) in [
+                (x, self.x_inner),
+                (y, self.y_inner),
+                (z, self.z_inner),
+            ]
+        )
+
+    def subset(self, filename, zcoord, output):
+        """Save the winds within the window to a new file
+
+        Only the data within the window are read from the original file
+
+        Args:
+            filename (str | list): The file(s) containing the full wind fields
+            zcoord (str): The name of the vertical coordinate of the window
+            output (str): The filename to save the restricted wind fields to
+
+        Returns:
+            str | list: The output filename, or the original filename if the window is
+                the full domain
+        """
+        if self.full_domain:
+            return filename
+
+        cubes = iris.load(filename, wind_names)
+        cubes = iris.cube.CubeList([self._extract(cube, zcoord) for cube in cubes])
+        iris.save(cubes, output)
+
+        return output
+
+    def _extract(self, cube, zcoord):
+        slices = [slice(None)] * cube.ndim
+        for axis, (lower, upper) in [("x", self.x_range), ("y", self.y_range)]:
+            coord = cube.coord(axis=axis, dim_coords=True)
+            dim = cube.coord_dims(coord)[0]
+            slices[dim] = _index_range(coord, lower, upper)
+
+        cube = cube[tuple(slices)]
+
+        # Keep one level either side of the band for the vertical interpolation
+        zdim, z = _vertical_coordinate(cube, zcoord)
+        if z is not None:
+            lower, upper = self.z_range
+            start = max(np.count_nonzero(z < lower) - 1, 0)
+            stop = min(np.count_nonzero(z <= upper) + 1, len(z))
+
+            slices = [slice(None)] * cube.ndim
+            slices[zdim] = slice(start, stop)
+            cube = cube[tuple(slices)]
+
+        return cube
+
+
+def _index_range(coord, lower, upper):
+    # Slice of the points of a 1D coordinate between lower and upper, plus one point
+    # either side for the interpolation
+    points = coord.points
+    if isinstance(coord, DimCoord) and points[0] > points[-1]:
+        start = max(np.count_nonzero(points > upper) - 1, 0)
+        stop = min(np.count_nonzero(points >= lower) + 1, len(points))
+    else:
+        start = max(np.count_nonzero(points < lower) - 1, 0)
+        stop = min(np.count_nonzero(points <= upper) + 1, len(points))
+
+    return slice(start, stop)
+
+
+def _vertical_coordinate(cube, zcoord):
+    # The vertical dimension of the cube and the minimum value of the vertical
+    # coordinate on each level, or None if the cube does not have model levels
+    zdim, z = level_heights(cube)
+    if zdim is not None and cube.coords(zcoord):
+        coord = cube.coord(zcoord)
+        dims = cube.coord_dims(coord)
+        if zdim in dims:
+            z = np.moveaxis(coord.points, dims.index(zdim), 0)
+            z = z.reshape(len(z), -1).min(axis=1)
+
+    return zdim, z
@@ -18,7 +18,9 @@ requirements = [
     "scipy",
     "twinotter",
     "cmcrameri",
-    "shapely",
+    "shapely>=2.0",
+    "netCDF4",
+    "cftime",
 ]
 
 test_requirements = [